@@ -0,0 +1,58 @@
+from benchmarks.run_benchmarks import measure
+from benchmarks.synthetic_data import generate_expenses
+from utils.aggregation import aggregate_expenses
+from utils.expenses_frame import to_expenses_frame
+from utils.report import create_table
+
+
+"""
+Benchmark of the aggregation of the expenses used by the report:
+the previous approach (one dict comprehension per type within every month, then create_table)
+against utils.aggregation.aggregate_expenses (one single pass over the dicts, and groupby over the DataFrame)
+
+Run:
+    From the root: $ python -m benchmarks.bench_aggregation [number_of_expenses]
+
+"""
+
+
+def legacy_aggregation(expenses):
+    """
+    Aggregation done by create_report before utils.aggregation
+    """
+    expense_types = set()
+    month_dict = {}
+    for k, v in expenses.items():
+        month = str(v.get('date'))[:6]
+        if month not in month_dict:
+            month_dict[month] = {}
+        month_dict[month][k] = v
+        expense_types.add(v.get('expense_type'))
+    result = {}
+    for k, v in month_dict.items():
+        result[k] = {'total_amount': create_table(v).get('total_amount'), 'types': {}}
+        for e_type in expense_types:
+            filtered_expenses = {key: value for key, value in v.items() if value.get('expense_type') == e_type}
+            type_table_dict = create_table(filtered_expenses)
+            if len(type_table_dict.get('table')) > 1:
+                result[k]['types'][e_type] = type_table_dict.get('total_amount')
+    return result
+
+
+def main(number_of_expenses=100000):
+    expenses = generate_expenses(number_of_expenses)
+    legacy_time = measure(legacy_aggregation, expenses, repeat=3)
+    single_pass_time = measure(aggregate_expenses, expenses, repeat=3)
+    frame = to_expenses_frame(expenses)
+    frame_time = measure(aggregate_expenses, frame, repeat=3)
+    print(f"Expenses:      {number_of_expenses}")
+    print(f"Legacy:        {legacy_time * 1000:.1f} ms")
+    print(f"Single pass:   {single_pass_time * 1000:.1f} ms")
+    print(f"DataFrame:     {frame_time * 1000:.1f} ms")
+    print(f"Speedup:       x{legacy_time / single_pass_time:.1f} (single pass), x{legacy_time / frame_time:.1f} (DataFrame)")
+    print(f"Memory:        {frame.memory_usage(deep=True).sum() / 2 ** 20:.1f} MiB (DataFrame)")
+
+
+if __name__ == "__main__":
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,65 @@
+import os
+import tempfile
+from benchmarks.run_benchmarks import measure
+from benchmarks.synthetic_data import generate_expenses
+from utils.aggregation import aggregate_expenses
+from utils.report import render_report, shutdown_render_executor
+
+
+"""
+Benchmark of the parallel rendering of the report months: time to render the same report (no cache)
+with 1, 2, 4... render workers, up to the number of cores, and its speedup over one worker.
+The speedup can only be near-linear while there are enough months per worker: the title, the history
+and the merge of the fragments are not parallel.
+It also shows what the render workers kept between reports save: the time of the same report when the workers
+are started for it (as every report did before)
+
+Run:
+    From the root: $ python -m benchmarks.bench_report_scaling [number_of_expenses] [max_workers]
+
+"""
+# 3 years: the history chart of the report does not fit in one page beyond ~40 months
+MONTHS = 36
+
+
+def get_worker_counts(max_workers):
+    """
+    :return: 1, 2, 4... up to max_workers (included)
+    """
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    if max_workers > 1:
+        counts.append(max_workers)
+    return counts
+
+
+def render_report_with_new_workers(report_path, months, workers):
+    shutdown_render_executor()
+    render_report(report_path, months, None, workers)
+
+
+def main(number_of_expenses=20000, max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    # Aggregated once: only the rendering is measured
+    months = aggregate_expenses(generate_expenses(number_of_expenses, months=MONTHS))
+    print(f"Expenses:      {number_of_expenses} ({len(months)} months)")
+    print(f"Cores:         {os.cpu_count()}")
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        report_path = os.path.join(tmp_folder, "report.pdf")
+        base_time = None
+        for workers in get_worker_counts(max_workers):
+            seconds = measure(render_report, report_path, months, None, workers, repeat=3)
+            base_time = base_time or seconds
+            speedup = base_time / seconds
+            line = f"Workers {workers:>3}:   {seconds * 1000:.1f} ms  x{speedup:.2f} (efficiency {speedup / workers:.0%})"
+            if workers > 1:
+                new_workers_seconds = measure(render_report_with_new_workers, report_path, months, workers, repeat=3)
+                line += f"  | starting the workers per report: {new_workers_seconds * 1000:.1f} ms"
+            print(line)
+    shutdown_render_executor()
+
+
+if __name__ == "__main__":
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else None)
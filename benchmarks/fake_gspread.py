@@ -0,0 +1,139 @@
+import collections
+import re
+import gspread
+from gspread.utils import a1_to_rowcol, column_letter_to_index, rowcol_to_a1
+
+
+"""
+In-memory fake of the gspread client, with the subset of the API used by utils.gdrive.
+It counts the API calls, which is what the quota is about
+"""
+A1_COLUMN_RANGE = re.compile(r"^([A-Z]+):([A-Z]+)$")
+
+
+class FakeClient:
+    def __init__(self):
+        self.spreadsheets = {}
+        self.calls = collections.Counter()
+
+    def open(self, name):
+        self.calls["open"] += 1
+        if name not in self.spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(name)
+        return self.spreadsheets[name]
+
+    def create(self, name):
+        self.calls["create"] += 1
+        self.spreadsheets[name] = FakeSpreadsheet(self, name, len(self.spreadsheets) + 1)
+        return self.spreadsheets[name]
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, title, spreadsheet_id):
+        self.client = client
+        self.title = title
+        self.id = f"spreadsheet-{spreadsheet_id}"
+        self.worksheets = {}
+
+    def share(self, user, perm_type, role):
+        self.client.calls["share"] += 1
+
+    def worksheet(self, name):
+        self.client.calls["worksheet"] += 1
+        if name not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(name)
+        return self.worksheets[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.client.calls["add_worksheet"] += 1
+        self.worksheets[title] = FakeWorksheet(self, title, len(self.worksheets) + 1)
+        return self.worksheets[title]
+
+    def batch_update(self, body):
+        self.client.calls["spreadsheet_batch_update"] += 1
+        worksheets_by_id = {x.id: x for x in self.worksheets.values()}
+        for request in body.get("requests", []):
+            update_cells = request["updateCells"]
+            grid_range = update_cells["range"]
+            wksht = worksheets_by_id[grid_range["sheetId"]]
+            for i, row in enumerate(update_cells["rows"]):
+                for j, cell in enumerate(row["values"]):
+                    if "userEnteredValue" in cell:
+                        value = cell["userEnteredValue"].get("stringValue")
+                        wksht.cells[(grid_range["startRowIndex"] + i + 1, grid_range["startColumnIndex"] + j + 1)] = value
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, worksheet_id):
+        self.spreadsheet_id = spreadsheet.id
+        self.client = spreadsheet.client
+        self.title = title
+        self.id = worksheet_id
+        self.cells = {}
+
+    def _parse_range(self, a1_range):
+        """
+        :return: (first row, first column, last row, last column). Whole columns end in the last used row
+        """
+        match = A1_COLUMN_RANGE.match(a1_range)
+        if match:
+            last_row = max([row for row, _ in self.cells] or [0])
+            return 1, column_letter_to_index(match.group(1)), last_row, column_letter_to_index(match.group(2))
+        first, _, last = a1_range.partition(":")
+        first_row, first_column = a1_to_rowcol(first)
+        last_row, last_column = a1_to_rowcol(last) if last else (first_row, first_column)
+        return first_row, first_column, last_row, last_column
+
+    def _get_values(self, a1_range):
+        first_row, first_column, last_row, last_column = self._parse_range(a1_range)
+        rows = [[self.cells.get((row, column), "") for column in range(first_column, last_column + 1)]
+                for row in range(first_row, last_row + 1)]
+        # Like the API: trailing empty cells and rows are not returned
+        rows = [row[:max([i + 1 for i, v in enumerate(row) if v != ""] or [0])] for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def _set_values(self, a1_range, values):
+        first_row, first_column, _, _ = self._parse_range(a1_range)
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                if value in ("", None):
+                    self.cells.pop((first_row + i, first_column + j), None)
+                else:
+                    self.cells[(first_row + i, first_column + j)] = str(value)
+
+    def row_values(self, row):
+        self.client.calls["row_values"] += 1
+        values = self._get_values(f"A{row}:ZZ{row}")
+        return values[0] if values else []
+
+    def col_values(self, col):
+        self.client.calls["col_values"] += 1
+        column_name = rowcol_to_a1(1, col).rstrip("0123456789")
+        return [row[0] if row else "" for row in self._get_values(f"{column_name}:{column_name}")]
+
+    def batch_get(self, ranges):
+        self.client.calls["batch_get"] += 1
+        return [self._get_values(x) for x in ranges]
+
+    def batch_update(self, data):
+        self.client.calls["batch_update"] += 1
+        for x in data:
+            self._set_values(x["range"], x["values"])
+
+    def batch_clear(self, ranges):
+        self.client.calls["batch_clear"] += 1
+        for a1_range in ranges:
+            first_row, first_column, last_row, last_column = self._parse_range(a1_range)
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    self.cells.pop((row, column), None)
+
+    def update(self, range_name, values):
+        self.client.calls["update"] += 1
+        self._set_values(range_name, values)
+
+    def update_cell(self, row, col, value):
+        self.client.calls["update_cell"] += 1
+        self.cells[(row, col)] = str(value)
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from benchmarks.synthetic_data import iter_expenses, generate_expenses
+from benchmarks.fake_gspread import FakeClient
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists, insert_in_db, insert_many,
+                                         delete_from_db, get_table_content, get_connection, close_connections)
+from utils.report import create_report
+from utils.exporter import export_expenses, get_export_formats, XLSX_FORMAT
+
+
+"""
+Benchmark suite of the hot paths: bot startup (imports), DB, report and Google Sheets sync (against a fake gspread client).
+The results are written to a JSON file and compared with a stored baseline (the run fails if there is none).
+
+Run:
+    From the root: $ python -m benchmarks.run_benchmarks [--sizes 1000,100000,1000000]
+    Store the current results as the baseline: $ python -m benchmarks.run_benchmarks --save-baseline
+
+"""
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ROOT_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+DEFAULT_OUTPUT = os.path.join(BENCHMARKS_FOLDER, "results", "latest.json")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_FOLDER, "baseline.json")
+DEFAULT_SIZES = "1000,100000,1000000"
+# Rendering reports of millions of expenses takes too long to be benchmarked on every run
+DEFAULT_REPORT_MAX_SIZE = 10000
+# Same for the XLSX exports
+XLSX_EXPORT_MAX_SIZE = 100000
+# Modules whose import time is measured: the bot startup and the heavy modules loaded on demand
+IMPORT_MODULES = ["household_expenses_bot", "utils.report", "utils.gdrive"]
+DEFAULT_THRESHOLD = 0.2
+
+
+def measure(func, *args, repeat=1, **kwargs):
+    """
+    :return: Best time of several runs, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def populate_db(db_name, size):
+    """
+    Create a DB with size synthetic expenses (not measured)
+    """
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    conn = get_connection(db_name)
+    conn.executemany("""INSERT INTO EXPENSES (ID, DATE, USER, EXPENSE_TYPE, EXPENSE_DESCRIPTION, EXPENSE_AMOUNT)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                     ((k, v['date'], v['user'], v['expense_type'], v['expense_description'], v['expense_amount'])
+                      for k, v in iter_expenses(size)))
+    conn.commit()
+
+
+def bench_db(size, tmp_folder, samples):
+    """
+    Benchmark insert_in_db, insert_many, delete_from_db, get_table_content and the exports on a DB of size expenses
+
+    :return: Dict benchmark name -> result
+    """
+    db_name = os.path.join(tmp_folder, f"bench_{size}.db")
+    populate_db(db_name, size)
+    new_expenses = [v for _, v in iter_expenses(samples, seed=1)]
+    results = {}
+
+    start = time.perf_counter()
+    new_ids = [insert_in_db(expense, db_name) for expense in new_expenses]
+    results[f"db.insert_in_db[{size}]"] = {"seconds": (time.perf_counter() - start) / samples, "per": "call"}
+
+    start = time.perf_counter()
+    new_ids += insert_many(new_expenses, db_name)
+    results[f"db.insert_many[{size}]"] = {"seconds": (time.perf_counter() - start) / samples, "per": "expense"}
+
+    results[f"db.get_table_content.last5[{size}]"] = {
+        "seconds": measure(get_table_content, db_name, limit=5, repeat=5), "per": "call"}
+    results[f"db.get_table_content.all[{size}]"] = {
+        "seconds": measure(get_table_content, db_name, limit=0), "per": "call"}
+
+    for export_format in get_export_formats():
+        if export_format != XLSX_FORMAT or size <= XLSX_EXPORT_MAX_SIZE:
+            results[f"export.{export_format}[{size}]"] = {
+                "seconds": measure(export_expenses, os.path.join(tmp_folder, f"export_{size}.{export_format}"),
+                                   db_name, export_format), "per": "export"}
+
+    start = time.perf_counter()
+    delete_from_db(new_ids, db_name)
+    results[f"db.delete_from_db[{size}]"] = {"seconds": (time.perf_counter() - start) / len(new_ids), "per": "id"}
+    close_connections()
+    return results
+
+
+def bench_report(size, tmp_folder):
+    """
+    Benchmark create_report with size expenses: from scratch, and with the month fragments cached
+
+    :return: Dict benchmark name -> result
+    """
+    # 3 years: the history chart of the report does not fit in one page beyond ~40 months
+    expenses = generate_expenses(size, months=36)
+    cache_folder = os.path.join(tmp_folder, f"cache_{size}")
+    report_path = os.path.join(tmp_folder, f"report_{size}.pdf")
+    return {
+        f"report.create_report.cold[{size}]": {"seconds": measure(create_report, report_path, expenses, cache_folder),
+                                               "per": "report"},
+        f"report.create_report.cached[{size}]": {"seconds": measure(create_report, report_path, expenses, cache_folder),
+                                                 "per": "report"},
+    }
+
+
+def bench_gdrive(samples):
+    """
+    Benchmark the gdrive functions against a fake gspread client: time and number of API calls
+
+    :return: Dict benchmark name -> result
+    """
+    try:
+        from utils import gdrive
+    except Exception as e:
+        print(f"Skipping the gdrive benchmarks: {e}", file=sys.stderr)
+        return {}
+    from utils.rate_limiter import RateLimiter
+
+    fake_client = FakeClient()
+    gdrive.client = fake_client
+    # Not measuring the quota waits, only the code and the number of calls
+    gdrive.SHEETS_LIMITER = RateLimiter(rate=10 ** 9, period=1)
+    gdrive.invalidate_cache()
+    gdrive_info = {"sheet_name": "bench_sheet", "share_mails": []}
+    expenses = [dict(v, id=k, date=str(v['date'])) for k, v in iter_expenses(samples, seed=2, months=12)]
+    results = {}
+
+    def run(name, func, *args, **kwargs):
+        fake_client.calls.clear()
+        start = time.perf_counter()
+        return_value = func(*args, **kwargs)
+        results[name] = {"seconds": time.perf_counter() - start, "api_calls": sum(fake_client.calls.values())}
+        return return_value
+
+    run("gdrive.bootstrap_worksheet", gdrive.prepare_worksheet, gdrive_info, "2015")
+    run(f"gdrive.insert_in_sheet[{samples}]", lambda: [gdrive.insert_in_sheet(x, gdrive_info) for x in expenses])
+    sheet_cells = run(f"gdrive.insert_many_in_sheet[{samples}]", gdrive.insert_many_in_sheet, expenses, gdrive_info)
+    ids = [x['id'] for x in expenses]
+    run(f"gdrive.delete_from_sheet.indexed[{samples}]", gdrive.delete_from_sheet, ids, gdrive_info,
+        year="2015", sheet_cells=sheet_cells)
+    # The rows were cleared by the indexed delete: written again (not measured), so the scan finds them
+    gdrive.insert_many_in_sheet(expenses, gdrive_info)
+    run(f"gdrive.delete_from_sheet.scan[{samples}]", gdrive.delete_from_sheet, ids, gdrive_info, year="2015")
+    return results
+
+
+def bench_imports(tmp_folder, repeat=3):
+    """
+    Benchmark the import time of IMPORT_MODULES, every one in a new interpreter (nothing cached)
+
+    :return: Dict benchmark name -> result
+    """
+    # The bot reads conf/config.json from the working directory when imported
+    os.makedirs(os.path.join(tmp_folder, "conf"), exist_ok=True)
+    with open(os.path.join(tmp_folder, "conf", "config.json"), "w") as f:
+        json.dump({"output_folder": os.path.join(tmp_folder, "bot_output"), "log_filename": "bot.log",
+                   "db_filename": "bot.db", "texts": {}, "gdrive": {"active": False}}, f)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT_FOLDER, os.environ.get("PYTHONPATH")])))
+
+    results = {}
+    for module in IMPORT_MODULES:
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        times = [float(subprocess.run([sys.executable, "-c", code], cwd=tmp_folder, env=env, check=True,
+                                      capture_output=True, text=True).stdout)
+                 for _ in range(repeat)]
+        results[f"import.{module}"] = {"seconds": min(times), "per": "import"}
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Get the benchmarks slower than the baseline (or with more API calls)
+
+    :param dict results: Current results (benchmark name -> result)
+    :param dict baseline: Baseline results (benchmark name -> result)
+    :param float threshold: Allowed slowdown ratio (0.2: 20% slower)
+    :return: List of (benchmark name, baseline result, current result)
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if (result["seconds"] > reference["seconds"] * (1 + threshold)
+                or result.get("api_calls", 0) > reference.get("api_calls", 0)):
+            regressions.append((name, reference, result))
+    return regressions
+
+
+def format_result(result):
+    """
+    :return str: e.g.: 12.345 ms (3 API calls)
+    """
+    api_calls = f" ({result['api_calls']} API calls)" if "api_calls" in result else ""
+    return f"{result['seconds'] * 1000:.3f} ms{api_calls}"
+
+
+def run_benchmarks(sizes, samples, report_max_size):
+    """
+    :return: Dict benchmark name -> result
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        print("Import benchmarks", file=sys.stderr)
+        results.update(bench_imports(tmp_folder))
+        for size in sizes:
+            print(f"DB benchmarks with {size} expenses", file=sys.stderr)
+            results.update(bench_db(size, tmp_folder, samples))
+            if size <= report_max_size:
+                print(f"Report benchmarks with {size} expenses", file=sys.stderr)
+                results.update(bench_report(size, tmp_folder))
+    print("Google Sheets benchmarks", file=sys.stderr)
+    results.update(bench_gdrive(samples))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the DB, report and Google Sheets hot paths")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated number of expenses in the DB")
+    parser.add_argument("--samples", type=int, default=200, help="Number of inserts/deletes measured")
+    parser.add_argument("--report-max-size", type=int, default=DEFAULT_REPORT_MAX_SIZE,
+                        help="Max number of expenses of the benchmarked reports")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file with the results")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file with the baseline results")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown ratio")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks([int(x) for x in args.sizes.split(",")], args.samples, args.report_max_size)
+    output = {"date": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results}
+    for path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(output, f, indent=2)
+
+    for name, result in results.items():
+        print(f"{name:<45} {format_result(result):>12}")
+
+    if args.save_baseline:
+        return 0
+    if not os.path.exists(args.baseline):
+        # Nothing to compare with: the timings depend on the machine, so the baseline is stored on it first
+        print(f"No baseline in {args.baseline}: run with --save-baseline on this machine first", file=sys.stderr)
+        return 2
+    with open(args.baseline) as f:
+        regressions = compare_with_baseline(results, json.load(f)["results"], args.threshold)
+    for name, reference, result in regressions:
+        print(f"REGRESSION: {name}: {format_result(reference)} -> {format_result(result)}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import random
+
+
+"""
+Synthetic expenses for the benchmarks
+"""
+EXPENSE_TYPES = ["GROCERIES", "HOUSE", "OTHERS", "CAR", "HEALTH", "LEISURE"]
+USERS = ["user1", "user2"]
+
+
+def iter_expenses(number_of_expenses, seed=0, months=120):
+    """
+    Generate synthetic expenses, spread over the months since 2015, oldest first (insertion order)
+
+    :param int number_of_expenses: Number of expenses
+    :param int seed: Random seed, so the data is reproducible
+    :param int months: Number of months covered by the expenses
+    :return: Iterator of (expense_id, expense dict)
+    """
+    rng = random.Random(seed)
+    for expense_id in range(1, number_of_expenses + 1):
+        month_index = (expense_id - 1) * months // number_of_expenses
+        yield expense_id, {
+            'date': (2015 + month_index // 12) * 10000 + (month_index % 12 + 1) * 100 + rng.randint(1, 28),
+            'user': rng.choice(USERS),
+            'expense_type': rng.choice(EXPENSE_TYPES),
+            'expense_description': f"DESCRIPTION {expense_id}",
+            'expense_amount': round(rng.uniform(1, 200), 2)
+        }
+
+
+def generate_expenses(number_of_expenses, seed=0, months=120):
+    """
+    Generate synthetic expenses, newest first (like utils.household_expenses_db.get_table_content)
+
+    :param int number_of_expenses: Number of expenses
+    :param int seed: Random seed, so the data is reproducible
+    :param int months: Number of months covered by the expenses
+    :return: Dict of expenses dicts
+    """
+    return dict(reversed(list(iter_expenses(number_of_expenses, seed, months))))
@@ -1,13 +1,27 @@
+import asyncio
+import dataclasses
+import html
 import logging
 import os
-import json
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
-from utils.household_expenses_db import create_db_if_not_exist, create_table_if_not_exists, insert_in_db, get_table_content, delete_from_db
-from utils.gdrive import insert_in_sheet, delete_from_sheet
-from utils.report import create_report
+import types
+from datetime import datetime, date
+from utils.household_expenses_db import create_db_if_not_exist, create_table_if_not_exists, insert_in_db, get_table_content, delete_from_db, close_connections
+from utils.household_expenses_db import create_sheets_queue_table_if_not_exists, create_sheet_cells_table_if_not_exists
+from utils.household_expenses_db import create_monthly_totals_table_if_not_exists, get_monthly_totals, count_sheet_operations
+from utils.household_expenses_db import create_expenses_version_table_if_not_exists, get_expenses_version
+from utils.sheets_sync import SheetsSyncWorker
+from utils.importer import import_expenses, SUPPORTED_EXTENSIONS
+from utils.exporter import export_expenses, get_export_formats
+from utils.report_scope import get_period_range, parse_period, THIS_MONTH, LAST_MONTH, THIS_YEAR, ALL
+from utils.executor import configure_executors, run_io, run_cpu, shutdown_executors, init_worker, get_worker_initargs
+from utils.config import load_config, ConfigWatcher
+from utils.logs import setup_logging, set_log_levels
+from utils.metrics import Histogram, CallbackMetric, timed, format_stats, start_metrics_server
+from utils.profiling import configure_profiling, profiled, run_profiled
+from utils.report_store import ReportStore
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,118 +32,352 @@ from telegram.ext import (
 )
 
 
-# Load config
+# Load config. The texts and the allowed users are reloaded when the file changes (see SETTINGS),
+# the rest of the config is only read at start
 CONFIG_FILE = "conf/config.json"
-with open(CONFIG_FILE) as f:
-    CONFIG = json.loads(f.read())
+CONFIG = load_config(CONFIG_FILE)
 
-if not os.path.exists(CONFIG.get("output_folder")):
-    os.makedirs(CONFIG.get("output_folder"))
+if not os.path.exists(CONFIG.output_folder):
+    os.makedirs(CONFIG.output_folder)
     
-REPORTS_FOLDER = os.path.join(os.path.join(CONFIG.get("output_folder"),"reports"))
+REPORTS_FOLDER = os.path.join(os.path.join(CONFIG.output_folder,"reports"))
 if not os.path.exists(REPORTS_FOLDER):
     os.makedirs(REPORTS_FOLDER)
+# Month fragments of the reports, reused while the month does not change
+REPORTS_CACHE_FOLDER = os.path.join(REPORTS_FOLDER, "cache")
+# Generated reports, reused while the expenses do not change
+REPORT_STORE = ReportStore(REPORTS_FOLDER, CONFIG.reports.max_files, CONFIG.reports.max_bytes)
 
-DB_PATH = os.path.join(CONFIG.get("output_folder"), CONFIG.get("db_filename"))    
+# Profiles of the reports and handlers (see utils.profiling). Created with the first profile
+PROFILES_FOLDER = os.path.join(CONFIG.output_folder, "profiles")
 
-# Enable logging
-logging.basicConfig(
-    handlers=[RotatingFileHandler(
-                os.path.join(CONFIG.get("output_folder"), CONFIG.get("log_filename")), 
-                maxBytes=20000000, 
-                backupCount=1000)],
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Exported files. They are removed once sent
+EXPORTS_FOLDER = os.path.join(CONFIG.output_folder, "exports")
+if not os.path.exists(EXPORTS_FOLDER):
+    os.makedirs(EXPORTS_FOLDER)
+
+# Files uploaded to be imported. They are removed once imported
+IMPORTS_FOLDER = os.path.join(CONFIG.output_folder, "imports")
+if not os.path.exists(IMPORTS_FOLDER):
+    os.makedirs(IMPORTS_FOLDER)
+
+DB_PATH = CONFIG.db_path
+
+LOG_PATH = os.path.join(CONFIG.output_folder, CONFIG.log_filename)
+# Logging is enabled in main() (see utils.logs)
 logger = logging.getLogger(__name__)
 
 
-NOT_ALLOWED_USER, MAIN_ACTION, EXPENSES_TO_DELETE, CONFIRM_EXPENSES_TO_DELETE, EXPENSE_TYPE, EXPENSE_DESCRIPTION, EXPENSE_AMOUNT, FINISH_GATHERING_INFO = range(8)
+NOT_ALLOWED_USER, MAIN_ACTION, EXPENSES_TO_DELETE, CONFIRM_EXPENSES_TO_DELETE, EXPENSE_TYPE, EXPENSE_DESCRIPTION, EXPENSE_AMOUNT, FINISH_GATHERING_INFO, REPORT_PERIOD, REPORT_FILTER, EXPORT_FORMAT = range(11)
+
+# Buttons of the report periods -> period
+REPORT_PERIODS = {
+    "report_period_this_month": THIS_MONTH,
+    "report_period_last_month": LAST_MONTH,
+    "report_period_this_year": THIS_YEAR,
+    "report_period_all": ALL
+}
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# Metrics (see utils.metrics)
+HANDLER_SECONDS = Histogram("household_expenses_handler_seconds", "Time to handle an update", ["handler"])
+REPORT_SECONDS = Histogram("household_expenses_report_seconds", "Time to create a report, wait for the pool included")
+REPORT_ROWS = Histogram("household_expenses_report_rows", "Expenses read from the DB per report",
+                        buckets=(10, 100, 1000, 10000, 100000, 1000000))
+CallbackMetric("household_expenses_sheets_queue_depth", "Operations waiting in the Google Sheets queue", "gauge",
+               lambda: count_sheet_operations(DB_PATH))
 
 
+def timed_handler(callback):
+    """
+    Decorator: record the time every call of a handler takes in HANDLER_SECONDS.
+    The handler can be profiled too, adding its name to the profiling targets
+    """
+    return timed(HANDLER_SECONDS, handler=callback.__name__)(profiled(callback.__name__)(callback))
+
+
+@dataclasses.dataclass(frozen=True)
+class BotSettings:
+    """
+    What the handlers need of the config, built once per config: the texts, the allowed users,
+    the keyboards and the dispatch tables of the buttons
+    """
+    texts: types.MappingProxyType
+    allowed_users: frozenset
+    admin_users: frozenset
+    # Keyboard name -> ReplyKeyboardMarkup
+    keyboards: types.MappingProxyType
+    # Main action button -> handler
+    main_actions: types.MappingProxyType
+    # Report period button -> period
+    report_periods: types.MappingProxyType
+
+
+def build_settings(config):
+    """
+    :param utils.config.Config config: Config
+    :return BotSettings: Settings of the config
+    """
+    texts = config.texts
+
+    def keyboard(*rows):
+        return ReplyKeyboardMarkup([list(x) for x in rows], one_time_keyboard=True)
+
+    keyboards = {
+        "main_actions": keyboard([texts.get("main_actions_add_expense"), texts.get("main_actions_delete_expense")],
+                                 [texts.get("main_actions_generate_report"), texts.get("main_actions_export")]),
+        "expense_types": keyboard(texts.get("main_type_buttons_text", ())),
+        "yes_no": keyboard([texts.get("yes_button_text"), texts.get("no_button_text")]),
+        "report_periods": keyboard([texts.get(x) for x in REPORT_PERIODS]),
+        "report_filters": keyboard([texts.get("report_filter_all"), texts.get("report_filter_mine")],
+                                   texts.get("main_type_buttons_text", ())),
+        "export_formats": keyboard([x.upper() for x in get_export_formats()]),
+    }
+    main_actions = {
+        texts.get("main_actions_generate_report"): ask_report_period,
+        texts.get("main_actions_export"): ask_export_format,
+        texts.get("main_actions_add_expense"): ask_expense_type,
+        texts.get("main_actions_delete_expense"): ask_expenses_to_delete,
+    }
+    return BotSettings(texts=texts,
+                       allowed_users=config.allowed_users,
+                       admin_users=config.admin_users,
+                       keyboards=types.MappingProxyType(keyboards),
+                       main_actions=types.MappingProxyType(main_actions),
+                       report_periods=types.MappingProxyType({texts.get(k): v for k, v in REPORT_PERIODS.items()}))
+
+
+# Built in main(). Replaced as a whole when the config file changes (see reload_settings): every handler
+# reads it once, so an update is handled with only one version of the config
+SETTINGS = None
+
+
+def reload_settings(config):
+    """
+    Apply a reloaded config. Only the texts, the allowed and admin users and the log levels are applied:
+    the folders, the DB, the log file, Google Drive, the executors, the webhook and the metrics need a restart
+    """
+    global SETTINGS
+    restart_fields = [x.name for x in dataclasses.fields(config)
+                      if x.name not in ("texts", "allowed_users", "admin_users", "logging")
+                      and getattr(config, x.name) != getattr(CONFIG, x.name)]
+    if dataclasses.replace(config.logging, level=CONFIG.logging.level, levels=CONFIG.logging.levels) != CONFIG.logging:
+        restart_fields.append("logging")
+    if restart_fields:
+        logger.warning(f"CONFIG: Restart the bot to apply the changes of: {', '.join(restart_fields)}")
+    set_log_levels(config.logging)
+    SETTINGS = build_settings(config)
+
+
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Entry point
     """
+    settings = SETTINGS
     user = update.effective_user
     context.user_data["user"] = user
 
     # Check the user
-    if user['id'] not in CONFIG.get("allowed_users", []):
+    if user['id'] not in settings.allowed_users:
         logger.info(f"Not Allowed user: '{user['first_name']}' with username '{user['username']}' and id '{user['id']}'")
         return NOT_ALLOWED_USER
     logger.info(f"Started conversation from user: '{user['first_name']}' with username '{user['username']}' and id '{user['id']}'")
     
-    # Create the buttons with the main actions
-    main_actions = [CONFIG.get("texts").get("main_actions_add_expense"),
-                    CONFIG.get("texts").get("main_actions_delete_expense")]
-    buttons = [main_actions, 
-              [CONFIG.get("texts").get("main_actions_generate_report")]]
-    
-    # Send the buttons to the user
-    await update.message.reply_text(CONFIG.get("texts").get("select_main_action"), 
-                                    reply_markup=ReplyKeyboardMarkup(buttons, one_time_keyboard=True))
+    # Send the buttons with the main actions to the user
+    await update.message.reply_text(settings.texts.get("select_main_action"), 
+                                    reply_markup=settings.keyboards["main_actions"])
     return MAIN_ACTION
 
 
+@timed_handler
 async def receive_not_allowed_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Not allowed user
     """
     user = update.message.from_user
     logger.info(f"Not Allowed user {user['id']} message: {update.message.text} ")
-    await update.message.reply_text(CONFIG.get("texts").get("user_not_allowed"), reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text(SETTINGS.texts.get("user_not_allowed"), reply_markup=REMOVE_KEYBOARD)
     return ConversationHandler.END
 
 
+@timed_handler
 async def receive_main_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Get main action
     """
+    settings = SETTINGS
     user = update.message.from_user
     main_action = update.message.text
     logger.info(f"User: {user.id}-{user.first_name} - ACTION: {main_action}")
 
-    # Generate report
-    if CONFIG.get("texts").get("main_actions_generate_report") == main_action:
-        report_name = datetime.now().strftime(f"%Y%m%d-EXPENSES REPORT-{user.id}-%H%M%S.pdf")
-        report_path = os.path.join(REPORTS_FOLDER, report_name)
-        create_report(report_path, get_table_content(DB_PATH, limit=0))
-        document = open(report_path, 'rb')
-        await update.message.reply_document(document)
-        await update.message.reply_text(CONFIG.get("texts").get("restart_text"), reply_markup=ReplyKeyboardRemove())
+    action = settings.main_actions.get(main_action)
+    if action is None:
+        logger.warning(f"User: {user.id}-{user.first_name} - ACTION: {main_action} - NOT SUPPORTED!")
         return ConversationHandler.END
+    return await action(update, settings)
 
-    # Add new expense
-    elif CONFIG.get("texts").get("main_actions_add_expense") == main_action:
-        buttons = [CONFIG.get("texts").get("main_type_buttons_text")]
-        await update.message.reply_text(CONFIG.get("texts").get("start_new_expense"), 
-                                        reply_markup=ReplyKeyboardMarkup(buttons, 
-                                        one_time_keyboard=True))
-        return EXPENSE_TYPE
-    
-    # Delete expense
-    elif CONFIG.get("texts").get("main_actions_delete_expense") == main_action:
-        last_expenses = get_table_content(DB_PATH, limit=5)
-        response_message = CONFIG.get("texts").get("select_expense_to_delete")
-        for expense_id, expense_values in last_expenses.items():
-            response_message += f"""
-                <b>ID:</b> {expense_id}
-                <b>AMOUNT:</b> {expense_values.get("expense_amount","")}
-                <b>DESC.:</b> {expense_values.get("expense_description","")}
-                <b>DATE:</b> {expense_values.get("date","")}
-            """
-        await update.message.reply_text(response_message, parse_mode=ParseMode.HTML)
-        return EXPENSES_TO_DELETE
-    
-    else: 
-        logger.warning(f"User: {user.id}-{user.first_name} - ACTION: {main_action} - NOT SUPPORTED!")
+
+async def ask_report_period(update: Update, settings: BotSettings) -> int:
+    """
+    Generate report: select the period first
+    """
+    await update.message.reply_text(settings.texts.get("report_select_period"),
+                                    reply_markup=settings.keyboards["report_periods"])
+    return REPORT_PERIOD
+
+
+async def ask_export_format(update: Update, settings: BotSettings) -> int:
+    """
+    Export the raw expenses: select the file format
+    """
+    await update.message.reply_text(settings.texts.get("export_select_format"),
+                                    reply_markup=settings.keyboards["export_formats"])
+    return EXPORT_FORMAT
+
+
+async def ask_expense_type(update: Update, settings: BotSettings) -> int:
+    """
+    Add new expense: select the expense type
+    """
+    await update.message.reply_text(settings.texts.get("start_new_expense"), 
+                                    reply_markup=settings.keyboards["expense_types"])
+    return EXPENSE_TYPE
+
+
+async def ask_expenses_to_delete(update: Update, settings: BotSettings) -> int:
+    """
+    Delete expense: show the last ones
+    """
+    last_expenses = await run_io(get_table_content, DB_PATH, limit=5)
+    response_message = settings.texts.get("select_expense_to_delete")
+    for expense_id, expense_values in last_expenses.items():
+        response_message += f"""
+            <b>ID:</b> {expense_id}
+            <b>AMOUNT:</b> {expense_values.get("expense_amount","")}
+            <b>DESC.:</b> {expense_values.get("expense_description","")}
+            <b>DATE:</b> {expense_values.get("date","")}
+        """
+    await update.message.reply_text(response_message, parse_mode=ParseMode.HTML)
+    return EXPENSES_TO_DELETE
+
+
+@timed_handler
+async def receive_report_period(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Get the period of the report
+    """
+    settings = SETTINGS
+    user = update.message.from_user
+    message = update.message.text
+    logger.info(f"User: {user.id}-{user.first_name} - REPORT PERIOD: {message}")
+
+    # A period button, or a period written by the user
+    period = settings.report_periods.get(message)
+    period_range = get_period_range(period) if period is not None else parse_period(message)
+    if period_range is None:
+        message = f'{settings.texts.get("report_period_invalid")} {settings.texts.get("restart_text")}'
+        await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
+        return ConversationHandler.END
+    context.user_data["report_period"] = period_range
+
+    await update.message.reply_text(settings.texts.get("report_select_filter"),
+                                    reply_markup=settings.keyboards["report_filters"])
+    return REPORT_FILTER
+
+
+@timed_handler
+async def receive_report_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Get the expenses filter of the report, and generate it
+    """
+    settings = SETTINGS
+    user = update.message.from_user
+    message = update.message.text
+    logger.info(f"User: {user.id}-{user.first_name} - REPORT FILTER: {message}")
+
+    # All the expenses, only the user ones, or only one expense type
+    date_from, date_to = context.user_data.get("report_period")
+    report_filters = {"date_from": date_from, "date_to": date_to}
+    if message == settings.texts.get("report_filter_mine"):
+        report_filters["user"] = context.user_data.get("user").first_name
+    elif message != settings.texts.get("report_filter_all"):
+        report_filters["expense_types"] = [message.upper()]
+
+    # The same report of the same version of the expenses is rendered once: the requests made while it is being
+    # rendered wait for it, and the later ones get its PDF (see utils.report_store)
+    version = await run_io(get_expenses_version, DB_PATH)
+    report_key = (version, date_from, date_to, report_filters.get("user"), tuple(report_filters.get("expense_types", ())))
+
+    async def render(report_path):
+        # Imported here: ReportLab, pypdf and pandas are only loaded when the first report is requested.
+        # The worker process reads the expenses itself: they are not pickled from the bot to the pool
+        from utils.report import create_report_from_db
+        with REPORT_SECONDS.time():
+            expenses_count = await run_cpu(create_report_from_db, report_path, DB_PATH, REPORTS_CACHE_FOLDER,
+                                           CONFIG.reports.render_workers, **report_filters)
+        REPORT_ROWS.observe(expenses_count)
+        return expenses_count
+
+    report = await REPORT_STORE.get_report(report_key, render)
+    if report.expenses_count == 0:
+        message = f'{settings.texts.get("report_no_expenses")} {settings.texts.get("restart_text")}'
+        await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
+        return ConversationHandler.END
+
+    await send_report(update, report)
+    await update.message.reply_text(settings.texts.get("restart_text"), reply_markup=REMOVE_KEYBOARD)
     return ConversationHandler.END
 
 
+async def send_report(update: Update, report):
+    """
+    Send the PDF of a report. Once uploaded, it is sent again by its Telegram file_id
+    """
+    if report.file_id is not None:
+        try:
+            await update.message.reply_document(report.file_id)
+            return
+        except BadRequest as e:
+            logger.warning(f"REPORTS: Error sending {report.path} by its file_id, uploading it: {e}")
+            report.file_id = None
+    with open(report.path, 'rb') as document:
+        message = await update.message.reply_document(document)
+    report.file_id = message.document.file_id
+
+
+@timed_handler
+async def receive_export_format(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Get the file format, and export all the expenses
+    """
+    settings = SETTINGS
+    user = update.message.from_user
+    export_format = update.message.text.lower()
+    logger.info(f"User: {user.id}-{user.first_name} - EXPORT FORMAT: {export_format}")
+    if export_format not in get_export_formats():
+        message = f'{settings.texts.get("export_format_invalid")} {settings.texts.get("restart_text")}'
+        await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
+        return ConversationHandler.END
+
+    export_path = os.path.join(EXPORTS_FOLDER, datetime.now().strftime(f"%Y%m%d-EXPENSES-{user.id}-%H%M%S.{export_format}"))
+    try:
+        await run_io(export_expenses, export_path, DB_PATH, export_format)
+        with open(export_path, 'rb') as document:
+            await update.message.reply_document(document)
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+    await update.message.reply_text(settings.texts.get("restart_text"), reply_markup=REMOVE_KEYBOARD)
+    return ConversationHandler.END
+
+
+@timed_handler
 async def delete_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Delete expenses
     """
+    settings = SETTINGS
     user = update.message.from_user
     message = update.message.text
     logger.info(f"User: {user.id}-{user.first_name} - DELETION MESSAGE: {message}")
@@ -138,57 +386,60 @@ async def delete_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # If the IDs sent by the user are not numeric
     if len(elems_to_delete) == 0:
         logger.info(f"User: {user.id}-{user.first_name} - WRONG DELETION MESSAGE")
-        message = f'{CONFIG.get("texts").get("no_expenses_to_delete")} {CONFIG.get("texts").get("restart_text")}'
-        await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+        message = f'{settings.texts.get("no_expenses_to_delete")} {settings.texts.get("restart_text")}'
+        await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
         return ConversationHandler.END
 
     elems_to_delete_str = ', '.join(str(x) for x in elems_to_delete)
     context.user_data["elems_to_delete"] = elems_to_delete
     context.user_data["elems_to_delete_str"] = elems_to_delete_str
-    return_message = f"""{CONFIG.get("texts").get("confirm_expenses_to_delete")}
+    return_message = f"""{settings.texts.get("confirm_expenses_to_delete")}
     {elems_to_delete_str}
     """
-    buttons = [[CONFIG.get("texts").get("yes_button_text"), CONFIG.get("texts").get("no_button_text")]]
     await update.message.reply_text(
-        return_message, reply_markup=ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
+        return_message, reply_markup=settings.keyboards["yes_no"]
     )
     return CONFIRM_EXPENSES_TO_DELETE
 
 
+@timed_handler
 async def confirm_delete_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Confirm expenses deletion
     """
+    settings = SETTINGS
     user = update.message.from_user
     logger.info(f"User: {user.id}-{user.first_name} - CONFIRM DELETE EXPENSES: { update.message.text}")
 
     message = ""
 
-    if update.message.text == CONFIG.get("texts").get("yes_button_text"):
-        deletion_result = delete_from_db(context.user_data.get("elems_to_delete"), DB_PATH)
+    if update.message.text == settings.texts.get("yes_button_text"):
+        # GDRIVE: the deletion from sheet is queued in the same transaction. The worker will sync it in background
+        deletion_result = await run_io(delete_from_db, context.user_data.get("elems_to_delete"), DB_PATH,
+                                       queue_sheet_operation=CONFIG.gdrive.active)
+        if CONFIG.gdrive.active:
+            context.bot_data["sheets_sync_worker"].notify()
         
         # If there are no errors during the deletion
         if len(deletion_result) == 0:
-            message +=  CONFIG.get("texts").get("deletion_result_OK").format(expenses=(context.user_data.get("elems_to_delete_str")))
-
-            # GDRIVE: delete from sheet
-            if CONFIG.get("gdrive").get("active"):
-                delete_from_sheet(context.user_data.get("elems_to_delete"), CONFIG.get("gdrive"))
+            message +=  settings.texts.get("deletion_result_OK").format(expenses=(context.user_data.get("elems_to_delete_str")))
         
         # If there are errors
         else:
             expenses_not_deleted = ', '.join(str(x) for x in deletion_result)
-            message +=  CONFIG.get("texts").get("deletion_result_KO").format(expenses=expenses_not_deleted)
+            message +=  settings.texts.get("deletion_result_KO").format(expenses=expenses_not_deleted)
 
-    message +=  CONFIG.get("texts").get("restart_text")
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    message +=  settings.texts.get("restart_text")
+    await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
     return ConversationHandler.END
 
 
+@timed_handler
 async def receive_expense_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Get Expense type
     """
+    settings = SETTINGS
     user = update.message.from_user
     expense_type = update.message.text.upper()
     logger.info(f"User: {user.id}-{user.first_name} - EXPENSE_TYPE: {expense_type}")
@@ -196,15 +447,17 @@ async def receive_expense_type(update: Update, context: ContextTypes.DEFAULT_TYP
     # Save expense type in context
     context.user_data["expense_type"] = expense_type
     
-    message = CONFIG.get("texts").get("receive_expense_type_message").format(expense_type=expense_type)
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    message = settings.texts.get("receive_expense_type_message").format(expense_type=expense_type)
+    await update.message.reply_text(message, reply_markup=REMOVE_KEYBOARD)
     return EXPENSE_DESCRIPTION
     
 
+@timed_handler
 async def receive_expense_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Get the Expense Description
     """
+    settings = SETTINGS
     user = update.message.from_user
     expense_description = update.message.text.upper()
     logger.info(f"User: {user.id}-{user.first_name} - EXPENSE_DESCRIPTION: {expense_description}")
@@ -212,16 +465,18 @@ async def receive_expense_description(update: Update, context: ContextTypes.DEFA
     # Save expense description in context
     context.user_data["expense_description"] = expense_description
     
-    message = CONFIG.get("texts").get("receive_expense_description_message").format(expense_description=expense_description)
+    message = settings.texts.get("receive_expense_description_message").format(expense_description=expense_description)
     await update.message.reply_text(message)
 
     return EXPENSE_AMOUNT
 
 
+@timed_handler
 async def receive_expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Get the Expense Amount
     """
+    settings = SETTINGS
     user = update.message.from_user
     try:
         expense_amount = float(update.message.text.replace(",", "."))
@@ -233,28 +488,28 @@ async def receive_expense_amount(update: Update, context: ContextTypes.DEFAULT_T
     # Save expense amountin context
     context.user_data["expense_amount"] = expense_amount
     
-    buttons = [[CONFIG.get("texts").get("yes_button_text"), CONFIG.get("texts").get("no_button_text")]]
-    message = CONFIG.get("texts").get("receive_expense_amount_message").format(expense_type=context.user_data["expense_type"],
-                                                                               expense_description=context.user_data["expense_description"],
-                                                                               expense_amount=expense_amount)
+    message = settings.texts.get("receive_expense_amount_message").format(expense_type=context.user_data["expense_type"],
+                                                                          expense_description=context.user_data["expense_description"],
+                                                                          expense_amount=expense_amount)
     await update.message.reply_text(
-        message, reply_markup=ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
+        message, reply_markup=settings.keyboards["yes_no"]
     )
     return FINISH_GATHERING_INFO
 
 
+@timed_handler
 async def receive_finish_gathering_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Finish Gatherinf INFO
     """
-
+    settings = SETTINGS
     user = update.message.from_user
     logger.info(f"User: {user.id}-{user.first_name} - FINISH GATHERING INFO: { update.message.text}")
 
     message = ""
 
-    if update.message.text == CONFIG.get("texts").get("yes_button_text"):
-        message = CONFIG.get("texts").get("receive_finish_gathering_info_message")
+    if update.message.text == settings.texts.get("yes_button_text"):
+        message = settings.texts.get("receive_finish_gathering_info_message")
         expense_info = {
             "date": datetime.today().strftime("%Y%m%d"),
             "user": context.user_data.get("user").first_name,
@@ -265,50 +520,229 @@ async def receive_finish_gathering_info(update: Update, context: ContextTypes.DE
         for k, v in expense_info.items():
             message += f" <b>{k}</b>:  {v}\n"        
         
-        insert_result = insert_in_db(expense_info, DB_PATH)
+        # GDRIVE: the insertion in sheet is queued in the same transaction. The worker will sync it in background
+        insert_result = await run_io(insert_in_db, expense_info, DB_PATH, queue_sheet_operation=CONFIG.gdrive.active)
         
         #Insert goes wrong
         if insert_result == -1:
-            message += f'<b>{CONFIG.get("texts").get("insert_result_KO")}</b>\n'
-        # GDRIVE: Add to sheet    
-        elif CONFIG.get("gdrive").get("active"):
-            expense_info["id"] = insert_result
-            insert_in_sheet(expense_info, CONFIG.get("gdrive"))
-            #TODO: Gestionar esto
+            message += f'<b>{settings.texts.get("insert_result_KO")}</b>\n'
+        elif CONFIG.gdrive.active:
+            context.bot_data["sheets_sync_worker"].notify()
 
     else:
         logger.info("User %s SAID NO WHEN GATHERING INFO", user.first_name)
 
-    message += CONFIG.get("texts").get("restart_text")    
+    message += settings.texts.get("restart_text")    
     await update.message.reply_text(
-        message, reply_markup=ReplyKeyboardRemove(),  parse_mode=ParseMode.HTML
+        message, reply_markup=REMOVE_KEYBOARD,  parse_mode=ParseMode.HTML
     )
     return ConversationHandler.END
 
 
+@timed_handler
+async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Totals of a month (default: current month) by expense type, without generating a report.
+    Usage: /summary [yyyymm]
+    """
+    settings = SETTINGS
+    user = update.effective_user
+    if user.id not in settings.allowed_users:
+        logger.info(f"Not Allowed user {user.id} asked for the summary")
+        await update.message.reply_text(settings.texts.get("user_not_allowed"))
+        return
+
+    month = date.today().strftime("%Y%m")
+    if context.args and len(context.args[0]) == 6 and context.args[0].isdigit():
+        month = context.args[0]
+    logger.info(f"User: {user.id}-{user.first_name} - SUMMARY: {month}")
+
+    monthly_totals = await run_io(get_monthly_totals, month, DB_PATH)
+    if len(monthly_totals) == 0:
+        await update.message.reply_text(settings.texts.get("summary_empty").format(month=f"{month[:4]}-{month[4:]}"))
+        return
+
+    totals_by_type = {}
+    for x in monthly_totals:
+        totals_by_type[x.get("expense_type")] = totals_by_type.get(x.get("expense_type"), 0.0) + x.get("total_amount")
+    message = settings.texts.get("summary_title").format(month=f"{month[:4]}-{month[4:]}")
+    for expense_type, total_amount in totals_by_type.items():
+        message += f"<b>{expense_type}</b>: {total_amount:.2f} €\n"
+    message += f'<b>{settings.texts.get("summary_total")}</b>: {sum(totals_by_type.values()):.2f} €'
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+
+
+@timed_handler
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Bulk import of the expenses of an uploaded CSV or XLSX file (see utils.importer).
+    The rows without user are assigned to the user who uploads the file
+    """
+    settings = SETTINGS
+    user = update.effective_user
+    if user.id not in settings.allowed_users:
+        logger.info(f"Not Allowed user {user.id} tried to import a file")
+        await update.message.reply_text(settings.texts.get("user_not_allowed"))
+        return
+
+    document = update.message.document
+    logger.info(f"User: {user.id}-{user.first_name} - IMPORT: {document.file_name}")
+    if not (document.file_name or "").lower().endswith(SUPPORTED_EXTENSIONS):
+        await update.message.reply_text(settings.texts.get("import_wrong_file"))
+        return
+
+    import_path = os.path.join(IMPORTS_FOLDER, datetime.now().strftime(f"%Y%m%d-%H%M%S-{user.id}-") +
+                               os.path.basename(document.file_name))
+    telegram_file = await document.get_file()
+    await telegram_file.download_to_drive(import_path)
+    try:
+        result = await run_io(import_expenses, import_path, DB_PATH, default_user=user.first_name,
+                              sync_sheets=CONFIG.gdrive.active)
+    except ValueError as e:
+        await update.message.reply_text(settings.texts.get("import_result_KO").format(errors=e))
+        return
+    finally:
+        os.remove(import_path)
+
+    if result.get("errors_count"):
+        errors = "\n".join(f"{line}: {error}" for line, error in result.get("errors"))
+        await update.message.reply_text(settings.texts.get("import_result_KO").format(errors=errors))
+        return
+    # GDRIVE: the imported expenses are already queued
+    if CONFIG.gdrive.active:
+        context.bot_data["sheets_sync_worker"].notify()
+    await update.message.reply_text(settings.texts.get("import_result_OK").format(imported=result.get("imported")))
+
+
+@timed_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Admin command: latency, counters and queue depths of the bot (see utils.metrics)
+    """
+    settings = SETTINGS
+    user = update.effective_user
+    if user.id not in settings.admin_users:
+        logger.info(f"Not Allowed user {user.id} asked for the stats")
+        await update.message.reply_text(settings.texts.get("user_not_allowed"))
+        return
+    logger.info(f"User: {user.id}-{user.first_name} - STATS")
+
+    # Some metrics are read from the DB
+    message = await run_io(format_stats)
+    # Message length limit of Telegram
+    await update.message.reply_text(f"<pre>{html.escape(message[:4000], quote=False)}</pre>", parse_mode=ParseMode.HTML)
+
+
+@timed_handler
+async def profile_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Admin command: create a report under the profiler (CPU and memory), and send it with the profile summary.
+    The month cache is not used, so every month is rendered.
+    Usage: /profile_report [yyyy|yyyymm|yyyymmdd-yyyymmdd] (default: current month)
+    """
+    settings = SETTINGS
+    user = update.effective_user
+    if user.id not in settings.admin_users:
+        logger.info(f"Not Allowed user {user.id} asked for a profiled report")
+        await update.message.reply_text(settings.texts.get("user_not_allowed"))
+        return
+
+    period_range = parse_period(context.args[0]) if context.args else get_period_range(THIS_MONTH)
+    if period_range is None:
+        await update.message.reply_text(settings.texts.get("report_period_invalid"))
+        return
+    logger.info(f"User: {user.id}-{user.first_name} - PROFILE REPORT: {period_range}")
+
+    from utils.report import create_report_from_db
+    report_path = os.path.join(REPORTS_FOLDER, datetime.now().strftime(f"%Y%m%d-PROFILED REPORT-{user.id}-%H%M%S.pdf"))
+    date_from, date_to = period_range
+    # No cache and no render workers: all the rendering runs in the profiled process
+    expenses_count, summary_path = await run_cpu(run_profiled, PROFILES_FOLDER, "profile_report", create_report_from_db,
+                                                 report_path, DB_PATH, None, date_from=date_from, date_to=date_to)
+    if expenses_count == 0:
+        await update.message.reply_text(settings.texts.get("report_no_expenses"))
+    else:
+        with open(report_path, 'rb') as document:
+            await update.message.reply_document(document)
+    if summary_path is not None:
+        with open(summary_path, 'rb') as document:
+            await update.message.reply_document(document)
+
+
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Cancel and ends the conversation.
     """
+    settings = SETTINGS
     user = update.message.from_user
     logger.info("User %s canceled the conversation.", user.first_name)
     await update.message.reply_text(
-        CONFIG.get("texts").get("restart_text"), reply_markup=ReplyKeyboardRemove()
+        settings.texts.get("restart_text"), reply_markup=REMOVE_KEYBOARD
     )
     return ConversationHandler.END
 
 
+async def start_config_watcher(application: Application) -> None:
+    """
+    Reload the settings when the config file changes
+    """
+    if CONFIG.config_reload_interval > 0:
+        config_watcher = ConfigWatcher(CONFIG_FILE, reload_settings, CONFIG.config_reload_interval)
+        # Not application.create_task: the application waits for those tasks when it stops
+        application.bot_data["config_watcher_task"] = asyncio.create_task(config_watcher.watch())
+
+
+async def shutdown(application: Application) -> None:
+    """
+    Release the resources held by the bot process
+    """
+    if "config_watcher_task" in application.bot_data:
+        application.bot_data["config_watcher_task"].cancel()
+    if "metrics_server" in application.bot_data:
+        application.bot_data["metrics_server"].shutdown()
+    if "sheets_sync_worker" in application.bot_data:
+        application.bot_data["sheets_sync_worker"].stop()
+    shutdown_executors()
+    close_connections()
+
+
 def main() -> None:
     """
     Run bot
     Based on: https://github.com/python-telegram-bot/python-telegram-bot/blob/master/examples/conversationbot.py
     """
+    # Enable logging. The records are written to the file by a background thread
+    log_listener = setup_logging(LOG_PATH, CONFIG.logging)
+
     # Create and configure DB:
     create_db_if_not_exist(DB_PATH) 
     create_table_if_not_exists(DB_PATH)
+    create_sheets_queue_table_if_not_exists(DB_PATH)
+    create_sheet_cells_table_if_not_exists(DB_PATH)
+    create_monthly_totals_table_if_not_exists(DB_PATH)
+    create_expenses_version_table_if_not_exists(DB_PATH)
+
+    # Size the pools used to keep the blocking work out of the event loop
+    # The worker processes of the CPU pool get the logging and profiling settings when they start
+    profiling = CONFIG.profiling
+    configure_profiling(PROFILES_FOLDER, profiling.sample_rate, profiling.targets, profiling.memory, profiling.top,
+                        profiling.max_profiles)
+    # The workers are not forked from the bot: the report modules are preloaded once by the fork server
+    configure_executors(CONFIG.executor.io_workers, CONFIG.executor.cpu_workers,
+                        cpu_initializer=init_worker, cpu_initargs=get_worker_initargs(),
+                        cpu_preload=["__main__", "utils.report"])
+
+    # Texts, keyboards and dispatch tables of the handlers
+    global SETTINGS
+    SETTINGS = build_settings(CONFIG)
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.environ['TG_BOT_HOUSEHOLD_EXPENSES_TOKEN']).build()
+    application = (Application.builder()
+                   .token(os.environ['TG_BOT_HOUSEHOLD_EXPENSES_TOKEN'])
+                   .post_init(start_config_watcher)
+                   .post_shutdown(shutdown)
+                   .build())
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -320,14 +754,50 @@ def main() -> None:
             EXPENSE_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_expense_type)],
             EXPENSE_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_expense_description)],
             EXPENSE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_expense_amount)],
-            FINISH_GATHERING_INFO: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_finish_gathering_info)]
+            FINISH_GATHERING_INFO: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_finish_gathering_info)],
+            REPORT_PERIOD: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_report_period)],
+            REPORT_FILTER: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_report_filter)],
+            EXPORT_FORMAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_export_format)]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("summary", summary))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profile_report", profile_report))
+    application.add_handler(MessageHandler(filters.Document.ALL, import_document))
+
+    # Prometheus endpoint
+    if CONFIG.metrics.active:
+        application.bot_data["metrics_server"] = start_metrics_server(CONFIG.metrics.listen, CONFIG.metrics.port)
+
+    # GDRIVE: Start the worker that syncs the queued operations with the sheet
+    if CONFIG.gdrive.active:
+        sheets_sync_worker = SheetsSyncWorker(DB_PATH, CONFIG.gdrive.as_dict(),
+                                              batch_size=CONFIG.gdrive.sync_batch_size,
+                                              max_attempts=CONFIG.gdrive.sync_max_attempts)
+        sheets_sync_worker.start()
+        application.bot_data["sheets_sync_worker"] = sheets_sync_worker
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    try:
+        if CONFIG.webhook.active:
+            # Telegram pushes the updates to the embedded server
+            webhook = CONFIG.webhook
+            logger.info(f"WEBHOOK: Listening on {webhook.listen}:{webhook.port}/{webhook.url_path}")
+            application.run_webhook(listen=webhook.listen,
+                                    port=webhook.port,
+                                    url_path=webhook.url_path,
+                                    webhook_url=webhook.webhook_url,
+                                    secret_token=webhook.secret_token,
+                                    max_connections=webhook.max_connections,
+                                    cert=webhook.cert,
+                                    key=webhook.key)
+        else:
+            application.run_polling()
+    finally:
+        # Write the records still in the queue
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+from pytest import approx
+from utils.aggregation import aggregate_expenses
+from utils.household_expenses_db import ExpenseRow
+from benchmarks.bench_aggregation import legacy_aggregation
+from benchmarks.synthetic_data import generate_expenses
+
+
+"""
+Tests of the single pass aggregation of the expenses
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+def test_aggregate_expenses():
+    expenses = {
+        3: {'date': 20200201, 'user': 'user1', 'expense_type': 'TYPE_1', 'expense_description': 'D3', 'expense_amount': 5.0},
+        2: {'date': 20200102, 'user': 'user2', 'expense_type': 'TYPE_2', 'expense_description': 'D2', 'expense_amount': 21.0},
+        1: {'date': 20200101, 'user': 'user1', 'expense_type': 'TYPE_1', 'expense_description': 'D1', 'expense_amount': 12.0},
+    }
+    months = aggregate_expenses(expenses)
+    assert list(months) == ['202002', '202001']
+    assert months['202001']['expenses'] == {2: ExpenseRow(2, 20200102, 'user2', 'TYPE_2', 'D2', 21.0),
+                                            1: ExpenseRow(1, 20200101, 'user1', 'TYPE_1', 'D1', 12.0)}
+    assert months['202001']['total_amount'] == 33.0
+    assert months['202001']['types'] == {'TYPE_2': {'ids': [2], 'total_amount': 21.0},
+                                         'TYPE_1': {'ids': [1], 'total_amount': 12.0}}
+    assert months['202001']['users'] == {'user2': 21.0, 'user1': 12.0}
+
+
+def test_same_totals_as_legacy_aggregation():
+    expenses = generate_expenses(2000)
+    legacy = legacy_aggregation(expenses)
+    months = aggregate_expenses(expenses)
+    assert list(months) == list(legacy)
+    for month, month_summary in months.items():
+        assert month_summary['total_amount'] == approx(legacy[month]['total_amount'])
+        assert {k: v['total_amount'] for k, v in month_summary['types'].items()} == approx(legacy[month]['types'])
+
+
+def test_aggregate_expense_rows():
+    rows = [ExpenseRow(2, 20200102, 'user2', 'TYPE_2', 'D2', 21.0), ExpenseRow(1, 20200101, 'user1', 'TYPE_1', 'D1', 12.0)]
+    months = aggregate_expenses(iter(rows))
+    assert months['202001']['expenses'] == {2: rows[0], 1: rows[1]}
+    assert months['202001']['total_amount'] == 33.0
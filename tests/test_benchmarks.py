@@ -0,0 +1,37 @@
+from benchmarks.run_benchmarks import compare_with_baseline, format_result
+
+
+"""
+Tests of the regression detection of the benchmark suite
+
+Run:
+    From the root: $ pytest
+
+"""
+BASELINE = {
+    "db.insert_in_db[1000]": {"seconds": 0.010},
+    "gdrive.insert_many_in_sheet[200]": {"seconds": 0.010, "api_calls": 2},
+}
+
+
+def test_no_regressions():
+    results = {
+        "db.insert_in_db[1000]": {"seconds": 0.011},
+        "gdrive.insert_many_in_sheet[200]": {"seconds": 0.005, "api_calls": 2},
+        "db.new_benchmark[1000]": {"seconds": 1.0},
+    }
+    assert compare_with_baseline(results, BASELINE, threshold=0.2) == []
+
+
+def test_regressions():
+    results = {
+        "db.insert_in_db[1000]": {"seconds": 0.013},
+        "gdrive.insert_many_in_sheet[200]": {"seconds": 0.005, "api_calls": 3},
+    }
+    regressions = compare_with_baseline(results, BASELINE, threshold=0.2)
+    assert [name for name, _, _ in regressions] == ["db.insert_in_db[1000]", "gdrive.insert_many_in_sheet[200]"]
+
+
+def test_format_result():
+    assert format_result({"seconds": 0.0123}) == "12.300 ms"
+    assert format_result({"seconds": 0.005, "api_calls": 3}) == "5.000 ms (3 API calls)"
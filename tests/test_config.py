@@ -0,0 +1,116 @@
+import dataclasses
+import json
+import os
+import pytest
+from utils.config import load_config, parse_config, ConfigWatcher, GdriveConfig, DEFAULT_TEXTS
+
+
+"""
+Tests of the config parsing and of its hot reload
+
+Run:
+    From the root: $ pytest
+
+"""
+RAW_CONFIG = {
+    "output_folder": "_output",
+    "log_filename": "household_expenses.log",
+    "db_filename": "household_expenses.db",
+    "allowed_users": [1, 2],
+    "texts": {"yes_button_text": "YES", "main_type_buttons_text": ["GROCERIES", "HOUSE"]},
+    "gdrive": {"active": True, "sheet_name": "test_sheet", "share_mails": ["mail1@gmail.com"], "unknown": 1},
+    "executor": {"io_workers": 4}
+}
+
+
+def _write_config(filename, raw_config):
+    with open(filename, "w") as f:
+        json.dump(raw_config, f)
+
+
+def test_parse_config():
+    config = parse_config(RAW_CONFIG)
+    assert config.db_path == os.path.join("_output", "household_expenses.db")
+    assert config.allowed_users == frozenset([1, 2])
+    assert config.texts["main_type_buttons_text"] == ("GROCERIES", "HOUSE")
+    assert config.gdrive == GdriveConfig(active=True, sheet_name="test_sheet", share_mails=("mail1@gmail.com",))
+    assert config.gdrive.as_dict()["sync_batch_size"] == 200
+    assert (config.executor.io_workers, config.executor.cpu_workers) == (4, None)
+
+
+def test_parse_config_defaults():
+    config = parse_config({"output_folder": "_output", "db_filename": "household_expenses.db"})
+    assert config.log_filename == "household_expenses.log"
+    assert set(config.texts) == set(DEFAULT_TEXTS)
+    assert not config.gdrive.active
+    assert not config.webhook.active and config.webhook.max_connections == 40
+    assert config.config_reload_interval == 5.0
+
+
+def test_missing_texts_have_defaults():
+    config = parse_config(dict(RAW_CONFIG, texts={"main_actions_export": "EXPORTAR"}))
+    assert config.texts["main_actions_export"] == "EXPORTAR"
+    assert config.texts["export_select_format"] == DEFAULT_TEXTS["export_select_format"]
+    assert config.texts["report_filter_mine"] == DEFAULT_TEXTS["report_filter_mine"]
+    assert all(config.texts.get(k) for k in DEFAULT_TEXTS)
+    assert config.texts["summary_empty"].format(month="2024-03") == "There are no expenses in 2024-03."
+
+
+def test_config_is_immutable():
+    config = parse_config(RAW_CONFIG)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.output_folder = "other"
+    with pytest.raises(TypeError):
+        config.texts["yes_button_text"] = "NO"
+
+
+def test_parse_config_missing_fields():
+    with pytest.raises(ValueError, match="db_filename"):
+        parse_config({"output_folder": "_output"})
+
+
+@pytest.mark.parametrize("secret_token", [None, "", "change_me", "wrong token!"])
+def test_active_webhook_needs_a_secret_token(secret_token):
+    with pytest.raises(ValueError, match="secret_token"):
+        parse_config(dict(RAW_CONFIG, webhook={"active": True, "secret_token": secret_token}))
+    # Not used while the webhook is not active
+    assert not parse_config(dict(RAW_CONFIG, webhook={"active": False, "secret_token": secret_token})).webhook.active
+    assert parse_config(dict(RAW_CONFIG, webhook={"active": True, "secret_token": "s3cr3t-T0ken"})).webhook.active
+
+
+def test_watcher_reloads_changed_file(tmp_path):
+    filename = os.path.join(tmp_path, "config.json")
+    _write_config(filename, RAW_CONFIG)
+    reloaded = []
+    watcher = ConfigWatcher(filename, reloaded.append, interval=0)
+    assert not watcher.check()
+
+    _write_config(filename, dict(RAW_CONFIG, allowed_users=[1, 2, 3]))
+    os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1))
+    assert watcher.check()
+    assert reloaded[0].allowed_users == frozenset([1, 2, 3])
+    assert reloaded[0] == load_config(filename)
+    assert not watcher.check()
+
+
+def test_watcher_keeps_config_if_file_is_wrong(tmp_path):
+    filename = os.path.join(tmp_path, "config.json")
+    _write_config(filename, RAW_CONFIG)
+    reloaded = []
+    watcher = ConfigWatcher(filename, reloaded.append, interval=0)
+
+    # Half written file
+    with open(filename, "w") as f:
+        f.write('{"output_folder": ')
+    assert not watcher.check()
+    # Missing fields
+    _write_config(filename, {"output_folder": "_output"})
+    os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1))
+    assert not watcher.check()
+    assert reloaded == []
+
+    # Fixed: applied
+    _write_config(filename, RAW_CONFIG)
+    os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1))
+    assert watcher.check()
+    assert len(reloaded) == 1
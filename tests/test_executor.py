@@ -0,0 +1,182 @@
+import asyncio
+import gc
+import importlib.util
+import json
+import os
+import time
+import types
+import pytest
+from utils import report
+from utils.executor import configure_executors, run_io, run_cpu, shutdown_executors
+
+
+"""
+Concurrency tests of the execution layer:
+many simulated updates doing blocking work at the same time must not stall the event loop
+
+Run:
+    From the root: $ pytest
+
+"""
+SIMULATED_UPDATES = 40
+BLOCKING_TIME = 0.2
+CPU_WORKERS = 4
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TEXTS = {"yes_button_text": "YES", "receive_finish_gathering_info_message": "Saved:\n", "insert_result_KO": "KO",
+             "restart_text": "/start", "main_type_buttons_text": ["GROCERIES", "HOUSE"]}
+
+
+def blocking_backend_call(value):
+    # Simulates a DB or Google Sheets call
+    time.sleep(BLOCKING_TIME)
+    return value
+
+
+def cpu_bound_call(value):
+    return sum(i * i for i in range(value))
+
+
+async def simulated_handler(update_id):
+    return await run_io(blocking_backend_call, update_id)
+
+
+async def measure_loop_lag(stop_event, lags):
+    # A "fast" user: a handler that does not block. Measures how late it is scheduled
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+
+async def drive_updates():
+    stop_event = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop_event, lags))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(simulated_handler(i) for i in range(SIMULATED_UPDATES)))
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    await lag_task
+    return results, elapsed, lags
+
+
+def test_concurrent_updates_bounded_latency():
+    shutdown_executors()
+    configure_executors(io_workers=SIMULATED_UPDATES)
+    # A full collection of the objects left by the previous tests would be counted as lag
+    gc.collect()
+    try:
+        results, elapsed, lags = asyncio.run(drive_updates())
+    finally:
+        shutdown_executors()
+    assert results == list(range(SIMULATED_UPDATES))
+    # Sequentially it would take SIMULATED_UPDATES * BLOCKING_TIME (8 seconds)
+    assert elapsed < BLOCKING_TIME * 5
+    # The event loop keeps serving other users while the backend calls are running
+    assert max(lags) < 0.1
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    """
+    The bot module, with its config file and output folder in a temporary folder
+    """
+    tmp_path = tmp_path_factory.mktemp("bot")
+    os.makedirs(tmp_path / "conf")
+    with open(tmp_path / "conf" / "config.json", "w") as f:
+        json.dump({"output_folder": str(tmp_path / "_output"), "db_filename": "household_expenses.db",
+                   "texts": BOT_TEXTS}, f)
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        spec = importlib.util.spec_from_file_location("household_expenses_bot",
+                                                      os.path.join(ROOT_FOLDER, "household_expenses_bot.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    module.SETTINGS = module.build_settings(module.CONFIG)
+    return module
+
+
+def slow_create_report(filename, db_name, cache_folder=None, workers=1, **filters):
+    # Simulates the report rendering, in the CPU pool
+    time.sleep(BLOCKING_TIME)
+    with open(filename, "wb") as f:
+        f.write(b"%PDF")
+    return 1
+
+
+class FakeMessage:
+    def __init__(self, text, replies):
+        self.text = text
+        self.from_user = types.SimpleNamespace(id=1, first_name="Nook")
+        self.replies = replies
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(document)
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id=f"file-{len(self.replies)}"))
+
+
+def fake_update(text, user_data, replies):
+    context = types.SimpleNamespace(user_data=dict(user_data, user=types.SimpleNamespace(first_name="Nook")),
+                                    bot_data={})
+    return types.SimpleNamespace(message=FakeMessage(text, replies)), context
+
+
+def test_concurrent_handlers_bounded_latency(bot, monkeypatch):
+    def slow_db_call(*args, **kwargs):
+        time.sleep(BLOCKING_TIME)
+        return 1
+    monkeypatch.setattr(bot, "insert_in_db", slow_db_call)
+    monkeypatch.setattr(bot, "get_expenses_version", slow_db_call)
+    monkeypatch.setattr(report, "create_report_from_db", slow_create_report)
+    replies = []
+    expense = {"expense_type": "GROCERIES", "expense_description": "Bread", "expense_amount": 1.5}
+    period = {"report_period": (20240101, 20241231)}
+
+    async def drive_handlers():
+        stop_event = asyncio.Event()
+        lags = []
+        lag_task = asyncio.create_task(measure_loop_lag(stop_event, lags))
+        start = time.perf_counter()
+        # Different filters: the reports are not coalesced
+        await asyncio.gather(*(bot.receive_finish_gathering_info(*fake_update("YES", expense, replies))
+                               for _ in range(SIMULATED_UPDATES // 2)),
+                             *(bot.receive_report_filter(*fake_update(f"TYPE{i}", period, replies))
+                               for i in range(SIMULATED_UPDATES // 2)))
+        elapsed = time.perf_counter() - start
+        stop_event.set()
+        await lag_task
+        return elapsed, lags
+
+    shutdown_executors()
+    configure_executors(io_workers=SIMULATED_UPDATES, cpu_workers=CPU_WORKERS)
+
+    # The start of the CPU pool processes is not counted
+    async def start_cpu_pool():
+        await asyncio.gather(*(run_cpu(slow_create_report, os.path.join(bot.REPORTS_FOLDER, f"warm_up_{i}.pdf"), None)
+                               for i in range(CPU_WORKERS)))
+    asyncio.run(start_cpu_pool())
+    gc.collect()
+    try:
+        elapsed, lags = asyncio.run(drive_handlers())
+    finally:
+        shutdown_executors()
+    # Every update got its answer: the expense, or the report and the restart text
+    assert sum(x.startswith("Saved") for x in replies if isinstance(x, str)) == SIMULATED_UPDATES // 2
+    assert sum(not isinstance(x, str) for x in replies) == SIMULATED_UPDATES // 2
+    # Sequentially it would take 3 blocking calls per pair of updates (12 seconds). The reports are rendered
+    # CPU_WORKERS at a time (1 second)
+    assert elapsed < BLOCKING_TIME * 10
+    assert max(lags) < 0.1
+
+
+def test_run_cpu():
+    try:
+        assert asyncio.run(run_cpu(cpu_bound_call, 10)) == cpu_bound_call(10)
+    finally:
+        shutdown_executors()
@@ -0,0 +1,60 @@
+import os
+from pytest import approx
+from utils.aggregation import aggregate_expenses
+from utils.expenses_frame import get_expenses_frame, to_expenses_frame
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists, insert_in_db,
+                                         get_table_content, close_connections)
+from utils.report import create_table
+from benchmarks.synthetic_data import generate_expenses
+
+
+"""
+Tests of the columnar DataFrame of the expenses
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+def test_get_expenses_frame(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    for expense in generate_expenses(50, months=3).values():
+        insert_in_db(expense, db_name)
+
+    frame = get_expenses_frame(db_name, date_from=20000101)
+    assert str(frame['date'].dtype) == 'int32'
+    assert str(frame['user'].dtype) == 'category'
+    assert str(frame['expense_type'].dtype) == 'category'
+    assert str(frame['expense_amount'].dtype) == 'float64'
+    # Same rows, in the same order, as get_table_content
+    expenses = get_table_content(db_name, limit=0)
+    assert frame['id'].tolist() == list(expenses)
+    assert len(get_expenses_frame(db_name, limit=5)) == 5
+    assert len(get_expenses_frame(db_name, date_from=21000101)) == 0
+    close_connections()
+
+
+def test_frame_aggregation_matches_dict_aggregation():
+    expenses = generate_expenses(2000)
+    months = aggregate_expenses(expenses)
+    frame_months = aggregate_expenses(to_expenses_frame(expenses))
+    assert list(frame_months) == list(months)
+    for month, month_summary in frame_months.items():
+        assert month_summary['expenses'] == months[month]['expenses']
+        assert month_summary['total_amount'] == approx(months[month]['total_amount'])
+        assert list(month_summary['types']) == list(months[month]['types'])
+        for expense_type, type_summary in month_summary['types'].items():
+            assert type_summary['ids'] == months[month]['types'][expense_type]['ids']
+            assert type_summary['total_amount'] == approx(months[month]['types'][expense_type]['total_amount'])
+        assert month_summary['users'] == approx(months[month]['users'])
+
+
+def test_create_table_from_frame():
+    expenses = generate_expenses(20)
+    table_dict = create_table(expenses)
+    frame_table_dict = create_table(to_expenses_frame(expenses))
+    assert frame_table_dict['table'] == table_dict['table']
+    assert frame_table_dict['total_amount'] == approx(table_dict['total_amount'])
@@ -0,0 +1,71 @@
+import csv
+import os
+import openpyxl
+import pytest
+from utils.exporter import export_expenses, get_export_formats, CSV_FORMAT, XLSX_FORMAT, PARQUET_FORMAT
+from utils.importer import import_expenses
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists, insert_many,
+                                         get_table_content, close_connections)
+from benchmarks.synthetic_data import iter_expenses
+
+
+"""
+Tests of the export of the expenses
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+def _create_db(tmp_path, name='test.db', size=30):
+    db_name = os.path.join(tmp_path, name)
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    insert_many((v for _, v in iter_expenses(size)), db_name)
+    return db_name
+
+
+def test_export_csv_can_be_imported_again(tmp_path):
+    db_name = _create_db(tmp_path)
+    filename = os.path.join(tmp_path, 'expenses.csv')
+    assert export_expenses(filename, db_name, CSV_FORMAT) == 30
+    with open(filename) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['id', 'date', 'user', 'expense_type', 'expense_description', 'expense_amount']
+    assert len(rows) == 31
+
+    other_db_name = _create_db(tmp_path, 'other.db', size=0)
+    assert import_expenses(filename, other_db_name)['imported'] == 30
+    assert (sorted(get_table_content(other_db_name, limit=0).values(), key=str)
+            == sorted(get_table_content(db_name, limit=0).values(), key=str))
+    close_connections()
+
+
+def test_export_xlsx(tmp_path):
+    db_name = _create_db(tmp_path)
+    filename = os.path.join(tmp_path, 'expenses.xlsx')
+    assert export_expenses(filename, db_name, XLSX_FORMAT, date_from=20000101, user='user1') == len(
+        get_table_content(db_name, limit=0, user='user1'))
+    rows = list(openpyxl.load_workbook(filename, read_only=True).active.iter_rows(values_only=True))
+    assert [x[0] for x in rows[1:]] == list(get_table_content(db_name, limit=0, user='user1'))
+    assert export_expenses(filename, db_name, XLSX_FORMAT, date_from=21000101) == 0
+    close_connections()
+
+
+def test_export_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    assert PARQUET_FORMAT in get_export_formats()
+    db_name = _create_db(tmp_path)
+    filename = os.path.join(tmp_path, 'expenses.parquet')
+    assert export_expenses(filename, db_name, PARQUET_FORMAT) == 30
+    table = pq.read_table(filename)
+    assert table.column('id').to_pylist() == list(get_table_content(db_name, limit=0))
+    assert export_expenses(filename, db_name, PARQUET_FORMAT, date_from=21000101) == 0
+    assert pq.read_table(filename).num_rows == 0
+    close_connections()
+
+
+def test_unsupported_format(tmp_path):
+    with pytest.raises(ValueError):
+        export_expenses(os.path.join(tmp_path, 'expenses.pdf'), export_format='pdf')
@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from utils import gdrive
+from utils.rate_limiter import RateLimiter
+from benchmarks.fake_gspread import FakeClient
+
+
+"""
+Tests of the Google Sheets functions, against an in-memory fake of the gspread client
+
+Run:
+    From the root: $ pytest
+
+"""
+GDRIVE_INFO = {"sheet_name": "test_sheet", "share_mails": ["mail1@gmail.com"], "credentials_file": "test_credentials.json"}
+
+
+def _expense(expense_id, date="20240328"):
+    return {"id": expense_id, "date": date, "user": "Nook", "expense_type": "OTROS",
+            "expense_description": "SSSAAA", "expense_amount": 211.0}
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(gdrive, "client", client)
+    monkeypatch.setattr(gdrive, "SHEETS_LIMITER", RateLimiter(rate=10 ** 9, period=1))
+    gdrive.invalidate_cache()
+    yield client
+    gdrive.invalidate_cache()
+
+
+def test_client_is_authorized_on_first_use(monkeypatch):
+    authorized = []
+    monkeypatch.setattr(gdrive, "client", None)
+    monkeypatch.setattr(gdrive.gspread, "service_account",
+                        lambda filename, scopes: authorized.append(filename) or FakeClient())
+    assert authorized == []
+    client = gdrive.get_client("test_credentials.json")
+    assert gdrive.get_client() is client
+    assert authorized == ["test_credentials.json"]
+
+
+def test_insert_and_delete(fake_client):
+    expenses = [_expense(1), _expense(2, "20240401"), _expense(3)]
+    sheet_cells = gdrive.insert_many_in_sheet(expenses, GDRIVE_INFO)
+    wksht = fake_client.spreadsheets["test_sheet"].worksheets["2024"]
+    assert sheet_cells == {1: ("2024", 3, 11), 3: ("2024", 4, 11), 2: ("2024", 3, 16)}
+    assert [wksht.cells[(3, x)] for x in range(11, 16)] == ["1", "20240328", "OTROS", "SSSAAA", "211.0"]
+    assert wksht.cells[(2, 11)] == "ID"
+
+    # Indexed, and searched in the worksheet
+    gdrive.delete_from_sheet([1], GDRIVE_INFO, sheet_cells=sheet_cells)
+    gdrive.delete_from_sheet([2, 3], GDRIVE_INFO, year="2024")
+    assert not [k for k in wksht.cells if k[0] > 2]
+
+
+def test_written_worksheets_are_reported(fake_client):
+    written = []
+    sheet_cells = gdrive.insert_many_in_sheet([_expense(1), _expense(2, "20250102")], GDRIVE_INFO,
+                                              on_written=written.append)
+    assert written == [{1: sheet_cells[1]}, {2: sheet_cells[2]}]
+
+
+def test_not_indexed_expenses_are_searched_in_their_year(fake_client):
+    gdrive.insert_many_in_sheet([_expense(1, "20230105"), _expense(2)], GDRIVE_INFO)
+    gdrive.delete_from_sheet([1, 2], GDRIVE_INFO, expense_dates={1: 20230105, 2: 20240328})
+    for year in ("2023", "2024"):
+        assert not [k for k in fake_client.spreadsheets["test_sheet"].worksheets[year].cells if k[0] > 2]
+
+
+def test_headers_written_after_a_failed_bootstrap(fake_client, monkeypatch):
+    sheet = fake_client.create("test_sheet")
+    batch_update = type(sheet).batch_update
+
+    def failing_batch_update(self, body):
+        monkeypatch.setattr(type(sheet), "batch_update", batch_update)
+        raise ConnectionError("Connection reset")
+    monkeypatch.setattr(type(sheet), "batch_update", failing_batch_update)
+    # The worksheet is created, but not its headers
+    with pytest.raises(ConnectionError):
+        gdrive.insert_many_in_sheet([_expense(1)], GDRIVE_INFO)
+    assert sheet.worksheets["2024"].cells == {}
+
+    assert gdrive.insert_many_in_sheet([_expense(1)], GDRIVE_INFO) == {1: ("2024", 3, 11)}
+    assert sheet.worksheets["2024"].cells[(2, 11)] == "ID"
+
+
+def test_incomplete_month_layout_is_not_cached(fake_client):
+    gdrive.insert_many_in_sheet([_expense(1)], GDRIVE_INFO)
+    wksht = fake_client.spreadsheets["test_sheet"].worksheets["2024"]
+    # Headers of the last months removed by hand
+    for column in range(31, 61):
+        wksht.cells.pop((2, column), None)
+    gdrive.invalidate_cache()
+
+    # The default layout is used, and the headers are read again until they are complete
+    assert gdrive.insert_many_in_sheet([_expense(2, "20241201")], GDRIVE_INFO) == {2: ("2024", 3, 56)}
+    reads = fake_client.calls["row_values"]
+    gdrive.insert_many_in_sheet([_expense(3, "20241201")], GDRIVE_INFO)
+    assert fake_client.calls["row_values"] == reads + 1
+
+
+def test_stale_index_falls_back_to_scan(fake_client):
+    sheet_cells = gdrive.insert_many_in_sheet([_expense(1), _expense(2)], GDRIVE_INFO)
+    wksht = fake_client.spreadsheets["test_sheet"].worksheets["2024"]
+    # Rows swapped by hand
+    for column in range(11, 16):
+        wksht.cells[(3, column)], wksht.cells[(4, column)] = wksht.cells[(4, column)], wksht.cells[(3, column)]
+    gdrive.delete_from_sheet([1], GDRIVE_INFO, year="2024", sheet_cells={1: sheet_cells[1]})
+    assert wksht.cells[(3, 11)] == "2"
+    assert (4, 11) not in wksht.cells
+
+
+class FakeCredentials:
+    def __init__(self, expiry):
+        self.valid = expiry is not None
+        self.expiry = expiry
+        self.refreshed = 0
+
+    def refresh(self, request):
+        self.refreshed += 1
+        self.valid = True
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+
+@pytest.mark.parametrize("expires_in, refreshed", [(None, 1), (timedelta(minutes=1), 1), (timedelta(hours=1), 0)])
+def test_refresh_token(fake_client, expires_in, refreshed):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    credentials = FakeCredentials(now + expires_in if expires_in else None)
+    fake_client.http_client = type("FakeHTTPClient", (), {"auth": credentials})()
+    assert gdrive.refresh_token(GDRIVE_INFO) == bool(refreshed)
+    assert credentials.refreshed == refreshed
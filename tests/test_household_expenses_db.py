@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import pytest
+from utils import household_expenses_db
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists, insert_in_db, insert_many,
+                                         delete_from_db, get_table_content, iter_table_content, get_connection, close_connections,
+                                         create_monthly_totals_table_if_not_exists, get_monthly_totals,
+                                         create_expenses_version_table_if_not_exists, get_expenses_version,
+                                         create_sheets_queue_table_if_not_exists, get_pending_sheet_operations)
+
+
+"""
+Tests of the SQLite layer
+
+Run:
+    From the root: $ pytest
+
+"""
+EXPENSE = {
+    'date': 20240328,
+    'user': 'Nook',
+    'expense_type': 'OTROS',
+    'expense_description': 'SSSAAA',
+    'expense_amount': 211.0
+}
+
+
+def _create_db(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    return db_name
+
+
+def test_connection_is_reused_and_configured(tmp_path):
+    db_name = _create_db(tmp_path)
+    conn = get_connection(db_name)
+    assert get_connection(db_name) is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    close_connections()
+    assert get_connection(db_name) is not conn
+    close_connections()
+
+
+def test_connection_per_thread(tmp_path):
+    db_name = _create_db(tmp_path)
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(get_connection(db_name)))
+    thread.start()
+    thread.join()
+    assert connections[0] is not get_connection(db_name)
+    close_connections()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="fork is not available")
+def test_connections_are_not_inherited_by_forked_children(tmp_path):
+    db_name = _create_db(tmp_path)
+    insert_in_db(EXPENSE, db_name)
+    parent_conn = get_connection(db_name)
+    pid = os.fork()
+    if pid == 0:
+        # Child: its own connection, and the one of the parent is not closed nor used
+        conn = get_connection(db_name)
+        ok = conn is not parent_conn and conn.execute("SELECT COUNT(*) FROM EXPENSES").fetchone()[0] == 1
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert get_connection(db_name) is parent_conn
+    assert len(get_table_content(db_name)) == 1
+    close_connections()
+
+
+def test_insert_get_delete(tmp_path):
+    db_name = _create_db(tmp_path)
+    expense_id = insert_in_db(EXPENSE, db_name)
+    assert expense_id > 0
+    assert get_table_content(db_name).get(expense_id) == EXPENSE
+    assert delete_from_db([expense_id, 9999], db_name) == [9999]
+    assert get_table_content(db_name) == {}
+    close_connections()
+
+
+def test_sheet_operations_are_queued_in_the_same_transaction(tmp_path):
+    db_name = _create_db(tmp_path)
+    # Without the queue table, the expense is not inserted either
+    with pytest.raises(sqlite3.OperationalError):
+        insert_in_db(EXPENSE, db_name, queue_sheet_operation=True)
+    assert get_table_content(db_name) == {}
+
+    create_sheets_queue_table_if_not_exists(db_name)
+    expense_id = insert_in_db(EXPENSE, db_name, queue_sheet_operation=True)
+    other_id = insert_in_db(dict(EXPENSE, date=20230105), db_name)
+    assert delete_from_db([expense_id, other_id, 9999], db_name, queue_sheet_operation=True) == [9999]
+    assert [(x["operation"], x["payload"]) for x in get_pending_sheet_operations(db_name)] == [
+        ("insert", dict(EXPENSE, id=expense_id)),
+        ("delete", [{"id": expense_id, "date": 20240328}, {"id": other_id, "date": 20230105}])]
+
+    # Nothing deleted, nothing queued
+    assert delete_from_db([9999], db_name, queue_sheet_operation=True) == [9999]
+    assert len(get_pending_sheet_operations(db_name)) == 2
+    close_connections()
+
+
+def test_quotes_are_stored_as_is(tmp_path):
+    db_name = _create_db(tmp_path)
+    expense = dict(EXPENSE, user="O'Neil", expense_description="Pan'); DROP TABLE EXPENSES; --")
+    expense_id = insert_in_db(expense, db_name)
+    assert get_table_content(db_name).get(expense_id) == expense
+    close_connections()
+
+
+def test_insert_many_and_batched_delete(tmp_path, monkeypatch):
+    monkeypatch.setattr(household_expenses_db, "DELETE_BATCH_SIZE", 3)
+    db_name = _create_db(tmp_path)
+    expenses = [dict(EXPENSE, expense_amount=float(i)) for i in range(7)]
+    expense_ids = insert_many(iter(expenses), db_name, batch_size=3)
+    assert len(expense_ids) == 7
+    content = get_table_content(db_name, limit=0)
+    assert [content[x] for x in expense_ids] == expenses
+
+    assert delete_from_db(expense_ids[:5] + [9999], db_name) == [9999]
+    assert list(get_table_content(db_name, limit=0)) == expense_ids[:4:-1]
+    assert insert_many([], db_name) == []
+    close_connections()
+
+
+def test_iter_table_content(tmp_path):
+    db_name = _create_db(tmp_path)
+    ids = [insert_in_db(dict(EXPENSE, date=20240301 + i), db_name) for i in range(5)]
+    # Smaller batches than rows: the rows keep coming in order
+    rows = list(iter_table_content(db_name, batch_size=2))
+    assert [x.id for x in rows] == ids[::-1]
+    assert rows[0].date == 20240305 and rows[0].expense_amount == 211.0
+    assert [x.id for x in iter_table_content(db_name, limit=2, batch_size=1)] == ids[:2:-1]
+    close_connections()
+
+
+def test_get_table_content_filters(tmp_path):
+    db_name = _create_db(tmp_path)
+    march_id = insert_in_db(EXPENSE, db_name)
+    april_id = insert_in_db(dict(EXPENSE, date=20240402, user='Fede'), db_name)
+    other_type_id = insert_in_db(dict(EXPENSE, date=20240403, expense_type='CASA'), db_name)
+
+    assert list(get_table_content(db_name, limit=0, date_from=20240401, date_to=20240430)) == [other_type_id, april_id]
+    assert list(get_table_content(db_name, limit=0, date_to=20240331)) == [march_id]
+    assert list(get_table_content(db_name, limit=0, expense_types=['OTROS'])) == [april_id, march_id]
+    assert list(get_table_content(db_name, limit=0, user='Fede')) == [april_id]
+    assert list(get_table_content(db_name, limit=1, date_from=20240301)) == [other_type_id]
+
+    # The date range is resolved with the index
+    plan = get_connection(db_name).execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM EXPENSES WHERE DATE BETWEEN 20240401 AND 20240430").fetchall()
+    assert "EXPENSES_DATE_IDX" in str(plan)
+    close_connections()
+
+
+def test_monthly_totals(tmp_path):
+    db_name = _create_db(tmp_path)
+    first_id = insert_in_db(EXPENSE, db_name)
+    # The table is filled with the existing expenses when it is created
+    create_monthly_totals_table_if_not_exists(db_name)
+    assert get_monthly_totals(202403, db_name) == [
+        {"expense_type": "OTROS", "user": "Nook", "total_amount": 211.0, "expenses_count": 1}]
+
+    # Kept by the triggers
+    second_id = insert_in_db(dict(EXPENSE, expense_amount=9.0), db_name)
+    insert_in_db(dict(EXPENSE, expense_type='CASA', date=20240401), db_name)
+    assert get_monthly_totals(202403, db_name) == [
+        {"expense_type": "OTROS", "user": "Nook", "total_amount": 220.0, "expenses_count": 2}]
+    delete_from_db([first_id], db_name)
+    assert get_monthly_totals(202403, db_name) == [
+        {"expense_type": "OTROS", "user": "Nook", "total_amount": 9.0, "expenses_count": 1}]
+    delete_from_db([second_id], db_name)
+    assert get_monthly_totals(202403, db_name) == []
+    assert len(get_monthly_totals(202404, db_name)) == 1
+
+    # Created only once
+    create_monthly_totals_table_if_not_exists(db_name)
+    assert len(get_monthly_totals(202404, db_name)) == 1
+    close_connections()
+
+
+def test_expenses_version(tmp_path):
+    db_name = _create_db(tmp_path)
+    create_expenses_version_table_if_not_exists(db_name)
+    assert get_expenses_version(db_name) == 0
+
+    expense_id = insert_in_db(EXPENSE, db_name)
+    assert get_expenses_version(db_name) == 1
+    insert_many([EXPENSE, EXPENSE], db_name)
+    assert get_expenses_version(db_name) == 3
+    delete_from_db([expense_id], db_name)
+    assert get_expenses_version(db_name) == 4
+
+    # Created only once
+    create_expenses_version_table_if_not_exists(db_name)
+    assert get_expenses_version(db_name) == 4
+    close_connections()
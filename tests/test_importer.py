@@ -0,0 +1,99 @@
+import os
+import openpyxl
+from datetime import datetime
+from pytest import raises
+from utils.importer import import_expenses, main
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists,
+                                         create_sheets_queue_table_if_not_exists, get_table_content,
+                                         get_pending_sheet_operations, close_connections)
+
+
+"""
+Tests of the bulk import of expenses
+
+Run:
+    From the root: $ pytest
+
+"""
+CSV_CONTENT = """date;user;expense_type;expense_description;expense_amount
+20240301;Nook;groceries;Market;12,5
+2024-03-02;;house;Rent;700
+
+02/03/2024;Fede;OTHERS;;3
+"""
+
+
+def _create_db(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    create_sheets_queue_table_if_not_exists(db_name)
+    return db_name
+
+
+def _write_csv(tmp_path, content):
+    filename = os.path.join(tmp_path, 'expenses.csv')
+    with open(filename, 'w') as f:
+        f.write(content)
+    return filename
+
+
+def test_import_csv(tmp_path):
+    db_name = _create_db(tmp_path)
+    result = import_expenses(_write_csv(tmp_path, CSV_CONTENT), db_name, default_user='Default',
+                             sync_sheets=True, batch_size=2)
+    assert result == {'imported': 3, 'errors_count': 0, 'errors': []}
+    expenses = list(get_table_content(db_name).values())[::-1]
+    assert expenses == [
+        {'date': 20240301, 'user': 'Nook', 'expense_type': 'GROCERIES', 'expense_description': 'MARKET', 'expense_amount': 12.5},
+        {'date': 20240302, 'user': 'Default', 'expense_type': 'HOUSE', 'expense_description': 'RENT', 'expense_amount': 700.0},
+        {'date': 20240302, 'user': 'Fede', 'expense_type': 'OTHERS', 'expense_description': '', 'expense_amount': 3.0}]
+    # Queued for Google Sheets, with their IDs
+    operations = get_pending_sheet_operations(db_name)
+    assert [x['payload'] for x in operations] == [dict(x, id=k) for k, x in reversed(get_table_content(db_name).items())]
+    close_connections()
+
+
+def test_wrong_rows_are_not_imported(tmp_path):
+    db_name = _create_db(tmp_path)
+    filename = _write_csv(tmp_path, CSV_CONTENT + "20241301;Nook;HOUSE;X;1\n20240101;Nook;HOUSE;X;abc\n")
+    result = import_expenses(filename, db_name, default_user='Default')
+    assert result == {'imported': 0, 'errors_count': 2,
+                      'errors': [(6, 'Wrong date: 20241301'), (7, 'Wrong amount: abc')]}
+    assert get_table_content(db_name) == {}
+
+    # Unless they are skipped
+    assert import_expenses(filename, db_name, default_user='Default', skip_invalid=True)['imported'] == 3
+    assert len(get_table_content(db_name)) == 3
+    close_connections()
+
+
+def test_wrong_files(tmp_path):
+    with raises(ValueError):
+        import_expenses(_write_csv(tmp_path, "date,amount\n20240101,1\n"))
+    with raises(ValueError):
+        import_expenses(os.path.join(tmp_path, 'expenses.txt'))
+
+
+def test_import_xlsx(tmp_path):
+    db_name = _create_db(tmp_path)
+    filename = os.path.join(tmp_path, 'expenses.xlsx')
+    workbook = openpyxl.Workbook()
+    workbook.active.append(['Date', 'Expense_Type', 'Expense_Amount', 'Notes'])
+    workbook.active.append([datetime(2024, 3, 1), 'house', 10, 'not imported'])
+    workbook.active.append([20240302, 'house', 2.5, None])
+    workbook.save(filename)
+
+    assert import_expenses(filename, db_name, default_user='Nook')['imported'] == 2
+    assert [(x['date'], x['expense_amount']) for x in get_table_content(db_name).values()] == [(20240302, 2.5), (20240301, 10.0)]
+    close_connections()
+
+
+def test_cli(tmp_path, capsys):
+    config = os.path.join(tmp_path, 'config.json')
+    with open(config, 'w') as f:
+        f.write(f'{{"output_folder": "{tmp_path}", "db_filename": "cli.db", "gdrive": {{"active": false}}}}')
+    assert main([_write_csv(tmp_path, CSV_CONTENT), '--config', config, '--user', 'Nook']) == 0
+    assert "3 expenses imported" in capsys.readouterr().out
+    assert len(get_table_content(os.path.join(tmp_path, 'cli.db'))) == 3
+    close_connections()
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import types
+import pytest
+from utils.config import LoggingConfig
+from utils.logs import setup_logging, set_log_levels, SamplingFilter
+from utils.executor import configure_executors, get_cpu_executor, shutdown_executors, init_worker, get_worker_initargs
+from utils.executor import DEFAULT_CPU_WORKERS
+
+
+"""
+Tests of the queued logging pipeline
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+@pytest.fixture
+def root_logger():
+    root_logger = logging.getLogger()
+    handlers, level = root_logger.handlers[:], root_logger.level
+    yield root_logger
+    root_logger.handlers = handlers
+    root_logger.setLevel(level)
+    set_log_levels(LoggingConfig(levels=types.MappingProxyType({})))
+
+
+def _read_lines(filename):
+    with open(filename, encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def test_json_records_written_by_listener(tmp_path, root_logger):
+    filename = os.path.join(tmp_path, "bot.log")
+    listener = setup_logging(filename, LoggingConfig(format="json"))
+    logger = logging.getLogger("utils.test_logs")
+    values = [1, 2]
+    logger.info("Values: %s", values)
+    # The message is built when logged, not when written
+    values.append(3)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Error")
+    listener.stop()
+
+    records = [json.loads(x) for x in _read_lines(filename)]
+    assert [(x["level"], x["logger"], x["message"]) for x in records] == [
+        ("INFO", "utils.test_logs", "Values: [1, 2]"), ("ERROR", "utils.test_logs", "Error")]
+    assert "ValueError: boom" in records[1]["exception"]
+
+
+def test_per_module_levels(tmp_path, root_logger):
+    filename = os.path.join(tmp_path, "bot.log")
+    config = LoggingConfig(levels=types.MappingProxyType({"utils.verbose": "DEBUG", "utils.quiet": "WARNING"}))
+    listener = setup_logging(filename, config)
+    logging.getLogger("utils.verbose").debug("verbose debug")
+    logging.getLogger("utils.quiet").info("quiet info")
+    logging.getLogger("utils.other").debug("other debug")
+    logging.getLogger("utils.other").info("other info")
+
+    # A logger removed from the config goes back to the root level
+    set_log_levels(LoggingConfig(levels=types.MappingProxyType({"utils.verbose": "DEBUG"})))
+    logging.getLogger("utils.quiet").info("quiet info again")
+    listener.stop()
+
+    messages = [x.split(" - ")[-1] for x in _read_lines(filename)]
+    assert messages == ["verbose debug", "other info", "quiet info again"]
+
+
+def _log_in_worker(message):
+    logging.getLogger("utils.worker").info(message)
+    logging.getLogger("utils.worker").debug("worker debug")
+    return os.getpid()
+
+
+def test_worker_processes_log_to_the_bot_file(tmp_path, root_logger):
+    filename = os.path.join(tmp_path, "bot.log")
+    listener = setup_logging(filename, LoggingConfig())
+    shutdown_executors()
+    configure_executors(cpu_workers=1, cpu_initializer=init_worker, cpu_initargs=get_worker_initargs())
+    try:
+        worker_pid = get_cpu_executor().submit(_log_in_worker, "from the worker").result()
+    finally:
+        shutdown_executors()
+        configure_executors(cpu_workers=DEFAULT_CPU_WORKERS)
+    listener.stop()
+
+    assert worker_pid != os.getpid()
+    assert [x.split(" - ")[-1] for x in _read_lines(filename) if " - utils.worker - " in x] == ["from the worker"]
+
+
+def test_sampling_filter():
+    sampling_filter = SamplingFilter(["utils.household_expenses_db"], 10)
+
+    def record(name, level):
+        return logging.LogRecord(name, level, __file__, 0, "msg", None, None)
+
+    kept = [sampling_filter.filter(record("utils.household_expenses_db", logging.DEBUG)) for _ in range(100)]
+    assert sum(kept) == 10
+    assert all(sampling_filter.filter(record("utils.household_expenses_db", logging.INFO)) for _ in range(10))
+    assert all(sampling_filter.filter(record("utils.gdrive", logging.DEBUG)) for _ in range(10))
+
+
+def test_wrong_logging_config():
+    with pytest.raises(ValueError, match="VERBOSE"):
+        LoggingConfig(levels=types.MappingProxyType({"utils": "VERBOSE"}))
+    with pytest.raises(ValueError, match="xml"):
+        LoggingConfig(format="xml")
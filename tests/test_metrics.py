@@ -0,0 +1,116 @@
+import asyncio
+import urllib.request
+import pytest
+from utils import metrics
+from utils.metrics import Counter, Gauge, Histogram, CallbackMetric, timed, render_metrics, format_stats
+
+
+"""
+Tests of the metrics and of their Prometheus endpoint
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+@pytest.fixture
+def registry():
+    """
+    Remove the metrics created by the test from the global registry
+    """
+    names = {x.name for x in metrics.get_metrics()}
+    yield
+    for metric in metrics.get_metrics():
+        if metric.name not in names:
+            metrics.unregister(metric.name)
+
+
+def test_counter_and_gauge(registry):
+    counter = Counter("test_requests_total", "Requests", ["status"])
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=429)
+    gauge = Gauge("test_tasks", "Tasks")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    output = render_metrics()
+    assert "# TYPE test_requests_total counter" in output
+    assert 'test_requests_total{status="200"} 3' in output
+    assert 'test_requests_total{status="429"} 1' in output
+    assert "test_tasks 1" in output
+
+
+def test_wrong_labels(registry):
+    counter = Counter("test_calls_total", "Calls", ["operation"])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        Counter("test_calls_total", "Duplicated")
+
+
+def test_histogram(registry):
+    histogram = Histogram("test_seconds", "Latency", ["operation"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, operation="get")
+
+    output = render_metrics()
+    assert 'test_seconds_bucket{operation="get",le="0.1"} 1' in output
+    assert 'test_seconds_bucket{operation="get",le="1"} 3' in output
+    assert 'test_seconds_bucket{operation="get",le="+Inf"} 4' in output
+    assert 'test_seconds_sum{operation="get"} 6.05' in output
+    assert 'test_seconds_count{operation="get"} 4' in output
+    assert histogram.get_summary() == [({"operation": "get"}, 4, pytest.approx(1.5125), float("inf"))]
+
+
+def test_timed(registry):
+    histogram = Histogram("test_handler_seconds", "Latency", ["handler"])
+
+    @timed(histogram, handler="sync")
+    def sync_func(x):
+        return x * 2
+
+    @timed(histogram, handler="async")
+    async def async_func(x):
+        await asyncio.sleep(0)
+        return x * 3
+
+    @timed(histogram, handler="error")
+    def failing_func():
+        return 1 / 0
+
+    assert sync_func(2) == 4
+    assert asyncio.run(async_func(2)) == 6
+    # The failed calls are timed too
+    with pytest.raises(ZeroDivisionError):
+        failing_func()
+    assert async_func.__name__ == "async_func"
+    assert sorted((labels["handler"], count) for labels, count, _, _ in histogram.get_summary()) == [
+        ("async", 1), ("error", 1), ("sync", 1)]
+
+
+def test_stats_and_failing_callbacks(registry):
+    Histogram("test_db_seconds", "Latency", ["operation"]).observe(0.02, operation="insert")
+    CallbackMetric("test_queue_depth", "Depth", "gauge", lambda: 7)
+    CallbackMetric("test_broken", "Broken", "gauge", lambda: 1 / 0)
+
+    stats = format_stats()
+    assert 'test_db_seconds{operation="insert"}: n=1 avg=20.0ms p95<=25ms' in stats
+    assert "test_queue_depth: 7" in stats
+    assert "test_broken" not in stats
+    assert "test_broken" not in render_metrics()
+
+
+def test_metrics_server(registry):
+    Counter("test_scraped_total", "Scraped").inc()
+    server = metrics.start_metrics_server("127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "test_scraped_total 1" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
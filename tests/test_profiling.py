@@ -0,0 +1,122 @@
+import asyncio
+import os
+import pytest
+from utils import profiling
+from utils.profiling import configure_profiling, profiled, run_profiled, remove_old_profiles, Profile
+from utils.executor import configure_executors, run_cpu, shutdown_executors, DEFAULT_CPU_WORKERS
+from utils.household_expenses_db import create_db_if_not_exist, create_table_if_not_exists, insert_many, close_connections
+from utils.report import create_report_from_db
+from benchmarks.synthetic_data import iter_expenses
+
+
+"""
+Tests of the opt-in profiling
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+@pytest.fixture
+def profiles_folder(tmp_path):
+    folder = os.path.join(tmp_path, "profiles")
+    yield folder
+    configure_profiling(None)
+
+
+def _profiles(folder):
+    return sorted(os.listdir(folder)) if os.path.exists(folder) else []
+
+
+def _busy_function(n):
+    return sum(str(x).count("1") for x in range(n))
+
+
+def test_sampled_calls(profiles_folder):
+    func = profiled("busy")(_busy_function)
+    configure_profiling(profiles_folder, sample_rate=0.0, targets=["busy"])
+    assert func(1000) == _busy_function(1000)
+    assert _profiles(profiles_folder) == []
+
+    # Not a target
+    configure_profiling(profiles_folder, sample_rate=1.0, targets=["other"])
+    func(1000)
+    assert _profiles(profiles_folder) == []
+
+    configure_profiling(profiles_folder, sample_rate=1.0, targets=["busy"])
+    func(1000)
+    files = _profiles(profiles_folder)
+    assert [os.path.splitext(x)[1] for x in files] == [".prof", ".txt"]
+    with open(os.path.join(profiles_folder, files[1])) as f:
+        assert "_busy_function" in f.read()
+
+
+def test_async_and_nested_calls(profiles_folder):
+    configure_profiling(profiles_folder, sample_rate=1.0, targets=["outer", "inner"])
+    inner = profiled("inner")(_busy_function)
+
+    @profiled("outer")
+    async def outer():
+        await asyncio.sleep(0)
+        return inner(1000)
+
+    assert asyncio.run(outer()) == _busy_function(1000)
+    # The inner call is part of the outer profile: cProfile can not be nested
+    assert [x for x in _profiles(profiles_folder) if x.endswith(".txt")][0].split("-")[-2] == "outer"
+    assert len(_profiles(profiles_folder)) == 2
+
+
+def test_memory_profile(profiles_folder):
+    result, summary_path = run_profiled(profiles_folder, "memory", lambda: [str(x) * 10 for x in range(10000)])
+    assert len(result) == 10000
+    with open(summary_path) as f:
+        assert "allocations" in f.read()
+
+    # Another profile running: the call is not profiled
+    with Profile("running", folder=profiles_folder):
+        assert run_profiled(profiles_folder, "skipped", _busy_function, 10) == (_busy_function(10), None)
+
+
+def test_remove_old_profiles(profiles_folder):
+    configure_profiling(profiles_folder, sample_rate=1.0, targets=["busy"], max_profiles=2)
+    func = profiled("busy")(_busy_function)
+    for _ in range(4):
+        func(10)
+    assert len(_profiles(profiles_folder)) == 4
+    remove_old_profiles(profiles_folder, 1)
+    assert len(_profiles(profiles_folder)) == 2
+
+
+def test_report_profiled_in_process_pool(tmp_path, profiles_folder):
+    db_name = os.path.join(tmp_path, "test.db")
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    # One month: the history chart of the report only fits a few years
+    insert_many((dict(v, date=20240301) for _, v in iter_expenses(200)), db_name)
+    close_connections()
+
+    shutdown_executors()
+    configure_executors(cpu_workers=1, cpu_initializer=configure_profiling,
+                        cpu_initargs=(profiles_folder, 1.0, ["create_report"]))
+    try:
+        report_path = os.path.join(tmp_path, "report.pdf")
+        assert asyncio.run(run_cpu(create_report_from_db, report_path, db_name)) == 200
+    finally:
+        shutdown_executors()
+        configure_executors(cpu_workers=DEFAULT_CPU_WORKERS)
+    summaries = [x for x in _profiles(profiles_folder) if x.endswith(".txt")]
+    assert len(summaries) == 1 and "-create_report-" in summaries[0]
+    # The bot process is not profiled
+    assert profiling._sample_rate == 0.0
+
+
+def test_months_profiled_in_the_render_workers(tmp_path, profiles_folder):
+    from utils.report import create_report
+    configure_profiling(profiles_folder, sample_rate=1.0, targets=["render_month_section"])
+    expenses = {k: dict(v, date=20240105 + k % 2 * 100) for k, v in iter_expenses(20)}
+    create_report(os.path.join(tmp_path, "report.pdf"), expenses, workers=2)
+    summaries = [x for x in _profiles(profiles_folder) if x.endswith(".txt")]
+    assert len(summaries) == 2 and all("-render_month_section-" in x for x in summaries)
+    # Rendered and profiled in the worker processes
+    assert str(os.getpid()) not in [x[:-len(".txt")].split("-")[-1] for x in summaries]
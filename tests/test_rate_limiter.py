@@ -0,0 +1,108 @@
+import pytest
+from utils.rate_limiter import RateLimiter
+
+
+"""
+Tests of the token bucket used for the Google Sheets calls, against a fake gspread client
+and a fake clock (no real waits)
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeAPIError(Exception):
+    # Same shape as gspread.exceptions.APIError
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"APIError: [{status_code}]")
+        self.response = FakeResponse(status_code, headers)
+        self.code = status_code
+
+
+class FakeWorksheet:
+    def __init__(self, errors=None):
+        self.errors = list(errors or [])
+        self.updates = []
+
+    def update(self, range_name, values):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.updates.append((range_name, values))
+
+
+def _limiter(fake_clock, **kwargs):
+    return RateLimiter(clock=fake_clock.clock, sleep=fake_clock.sleep, **kwargs)
+
+
+def test_no_wait_under_the_quota():
+    fake_clock = FakeClock()
+    limiter = _limiter(fake_clock, rate=60, period=60)
+    wksht = FakeWorksheet()
+    for i in range(60):
+        limiter.call(wksht.update, range_name=f"A{i}", values=[[i]])
+    assert len(wksht.updates) == 60
+    assert fake_clock.sleeps == []
+    assert limiter.usage()["requests_last_period"] == 60
+
+
+def test_wait_when_the_bucket_is_empty():
+    fake_clock = FakeClock()
+    limiter = _limiter(fake_clock, rate=60, period=60)
+    for _ in range(90):
+        limiter.acquire()
+    # 30 requests over the burst at 1 req/s
+    assert sum(fake_clock.sleeps) == pytest.approx(30)
+    assert limiter.usage()["throttled"] == 30
+
+
+def test_retry_after_is_honoured():
+    fake_clock = FakeClock()
+    limiter = _limiter(fake_clock, rate=60, period=60)
+    wksht = FakeWorksheet(errors=[FakeAPIError(429, {"Retry-After": "7"})])
+    limiter.call(wksht.update, range_name="A1", values=[[1]])
+    assert wksht.updates == [("A1", [[1]])]
+    assert fake_clock.sleeps[0] == 7
+    usage = limiter.usage()
+    assert usage["quota_errors"] == 1
+    assert usage["retries"] == 1
+
+
+def test_exponential_backoff():
+    fake_clock = FakeClock()
+    limiter = _limiter(fake_clock, rate=600, period=60, base_backoff=1, max_retries=3)
+    wksht = FakeWorksheet(errors=[FakeAPIError(503), FakeAPIError(503), FakeAPIError(503), FakeAPIError(503)])
+    with pytest.raises(FakeAPIError):
+        limiter.call(wksht.update, range_name="A1", values=[[1]])
+    backoffs = fake_clock.sleeps
+    assert len(backoffs) == 3
+    for attempt, wait in enumerate(backoffs):
+        assert 2 ** attempt <= wait <= 1.5 * 2 ** attempt
+
+
+def test_other_errors_are_not_retried():
+    fake_clock = FakeClock()
+    limiter = _limiter(fake_clock)
+    wksht = FakeWorksheet(errors=[FakeAPIError(400)])
+    with pytest.raises(FakeAPIError):
+        limiter.call(wksht.update, range_name="A1", values=[[1]])
+    assert limiter.usage()["retries"] == 0
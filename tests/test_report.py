@@ -1,5 +1,9 @@
+import asyncio
 import os
-from utils.report import create_report
+from utils import report
+from utils.report import create_report, create_report_from_db
+from utils.household_expenses_db import create_db_if_not_exist, create_table_if_not_exists, insert_in_db, close_connections
+from utils.executor import run_cpu
 
 
 """
@@ -151,4 +155,108 @@ def test_create_report():
     # Create the Report
     create_report(TEST_TILENAME, EXPENSES)
         
-    assert os.path.exists(TEST_TILENAME)
\ No newline at end of file
+    assert os.path.exists(TEST_TILENAME)
+
+def test_create_report_reuses_cached_months(tmp_path, monkeypatch):
+    cache_folder = os.path.join(tmp_path, 'cache')
+    rendered_months = []
+    render_month_section = report.render_month_section
+    def counting_render(month, month_summary):
+        rendered_months.append(month)
+        return render_month_section(month, month_summary)
+    monkeypatch.setattr(report, 'render_month_section', counting_render)
+
+    create_report(os.path.join(tmp_path, 'report_1.pdf'), EXPENSES, cache_folder)
+    assert sorted(rendered_months) == sorted({str(v['date'])[:6] for v in EXPENSES.values()})
+
+    # Nothing changed: no month is rendered again
+    rendered_months.clear()
+    create_report(os.path.join(tmp_path, 'report_2.pdf'), EXPENSES, cache_folder)
+    assert rendered_months == []
+
+    # Only the month of the new expense is rendered again
+    new_expenses = {21: dict(EXPENSES[20], expense_description='NEW'), **EXPENSES}
+    create_report(os.path.join(tmp_path, 'report_3.pdf'), new_expenses, cache_folder)
+    assert rendered_months == [str(EXPENSES[20]['date'])[:6]]
+    assert os.path.exists(os.path.join(tmp_path, 'report_3.pdf'))
+
+def test_create_report_from_db(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    for expense in EXPENSES.values():
+        insert_in_db(expense, db_name)
+    report_path = os.path.join(tmp_path, 'report.pdf')
+    assert create_report_from_db(report_path, db_name) == len(EXPENSES)
+    assert os.path.exists(report_path)
+
+    # No expenses in the period: no report
+    os.remove(report_path)
+    assert create_report_from_db(report_path, db_name, date_from=21000101) == 0
+    assert not os.path.exists(report_path)
+    close_connections()
+
+def test_create_report_with_render_workers(tmp_path, monkeypatch):
+    expenses = {k: dict(EXPENSES[20], date=20240128 + k * 100) for k in range(4)}
+    cache_folder = os.path.join(tmp_path, 'cache')
+    report.create_report(os.path.join(tmp_path, 'report_1.pdf'), expenses, cache_folder, workers=2)
+    assert len(os.listdir(cache_folder)) == 4
+
+    # The fragments rendered in parallel are the ones the next reports reuse
+    def failing_render(month, month_summary):
+        raise AssertionError(month)
+    monkeypatch.setattr(report, 'render_month_section', failing_render)
+    report.create_report(os.path.join(tmp_path, 'report_2.pdf'), expenses, cache_folder, workers=2)
+    assert os.path.exists(os.path.join(tmp_path, 'report_2.pdf'))
+
+def test_render_workers_are_reused(tmp_path, monkeypatch):
+    started = []
+    executor_class = report.ProcessPoolExecutor
+    def counting_executor(*args, **kwargs):
+        started.append(kwargs["max_workers"])
+        return executor_class(*args, **kwargs)
+    monkeypatch.setattr(report, 'ProcessPoolExecutor', counting_executor)
+    report.shutdown_render_executor()
+
+    # Started with the first report only
+    expenses = {k: dict(EXPENSES[20], date=20240128 + k * 100) for k in range(3)}
+    for k in range(3):
+        report.create_report(os.path.join(tmp_path, f'report_{k}.pdf'), expenses, workers=2)
+    assert started == [2]
+    report.create_report(os.path.join(tmp_path, 'report_3.pdf'), expenses, workers=3)
+    assert started == [2, 3]
+    report.shutdown_render_executor()
+
+def test_render_workers_started_from_the_cpu_pool(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    for k in range(3):
+        insert_in_db(dict(EXPENSES[20], date=20240128 + k * 100), db_name)
+    # The bot renders the reports in a worker of the pool, which starts the render workers
+    report_path = os.path.join(tmp_path, 'report.pdf')
+    assert asyncio.run(run_cpu(report.create_report_from_db, report_path, db_name, None, 2)) == 3
+    assert os.path.exists(report_path)
+    close_connections()
+
+def test_cached_versions_of_a_month(tmp_path, monkeypatch):
+    cache_folder = os.path.join(tmp_path, 'cache')
+    mine = {20: EXPENSES[20]}
+    everybody = {21: dict(EXPENSES[20], user='Other'), **mine}
+    rendered_months = []
+    render_month_section = report.render_month_section
+    def counting_render(month, month_summary):
+        rendered_months.append(month)
+        return render_month_section(month, month_summary)
+    monkeypatch.setattr(report, 'render_month_section', counting_render)
+
+    # The reports of the same month with different filters do not replace each other
+    for expenses in (mine, everybody, mine, everybody):
+        create_report(os.path.join(tmp_path, 'report.pdf'), expenses, cache_folder)
+    assert len(rendered_months) == 2
+    assert len(os.listdir(cache_folder)) == 2
+
+    # Only the last used versions are kept
+    monkeypatch.setattr(report, 'MONTH_CACHE_VERSIONS', 2)
+    create_report(os.path.join(tmp_path, 'report.pdf'), {22: EXPENSES[20]}, cache_folder)
+    assert len(os.listdir(cache_folder)) == 2
@@ -0,0 +1,29 @@
+from datetime import date
+from utils.report_scope import get_period_range, parse_period, THIS_MONTH, LAST_MONTH, THIS_YEAR, ALL
+
+
+"""
+Tests of the periods of the scoped reports
+
+Run:
+    From the root: $ pytest
+
+"""
+TODAY = date(2024, 1, 15)
+
+
+def test_get_period_range():
+    assert get_period_range(THIS_MONTH, TODAY) == (20240101, 20240131)
+    assert get_period_range(LAST_MONTH, TODAY) == (20231201, 20231231)
+    assert get_period_range(THIS_YEAR, TODAY) == (20240101, 20241231)
+    assert get_period_range(ALL, TODAY) == (None, None)
+
+
+def test_parse_period():
+    assert parse_period("2023") == (20230101, 20231231)
+    assert parse_period("202402") == (20240201, 20240229)
+    assert parse_period(" 20240110 - 20240220 ") == (20240110, 20240220)
+    assert parse_period("202413") is None
+    assert parse_period("20240230-20240301") is None
+    assert parse_period("20240301-20240201") is None
+    assert parse_period("march") is None
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import pytest
+from utils.report_store import ReportStore
+
+
+"""
+Tests of the reuse of the generated reports
+
+Run:
+    From the root: $ pytest
+
+"""
+
+
+class FakeRenderer:
+    """
+    Render function that writes <size> bytes, and counts its calls
+    """
+
+    def __init__(self, expenses_count=3, size=10, delay=0.01):
+        self.expenses_count = expenses_count
+        self.size = size
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self, path):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.expenses_count:
+            with open(path, "wb") as f:
+                f.write(b"x" * self.size)
+        return self.expenses_count
+
+
+def _set_mtimes(paths):
+    # Distinct modification times, in the order of the paths
+    for index, path in enumerate(paths):
+        os.utime(path, (1000 + index, 1000 + index))
+
+
+def test_concurrent_requests_are_coalesced(tmp_path):
+    store = ReportStore(str(tmp_path))
+    render = FakeRenderer()
+
+    async def requests():
+        return await asyncio.gather(*(store.get_report((1, "all"), render) for _ in range(5)),
+                                    store.get_report((1, "mine"), render))
+
+    reports = asyncio.run(requests())
+    assert render.calls == 2
+    assert len({id(x) for x in reports[:5]}) == 1
+    assert reports[5].path != reports[0].path
+    assert all(os.path.exists(x.path) for x in reports)
+
+
+def test_report_is_reused_until_the_version_changes(tmp_path):
+    store = ReportStore(str(tmp_path))
+    render = FakeRenderer()
+
+    first = asyncio.run(store.get_report((1, "all"), render))
+    first.file_id = "telegram-file-id"
+    assert asyncio.run(store.get_report((1, "all"), render)) is first
+    assert render.calls == 1
+
+    assert asyncio.run(store.get_report((2, "all"), render)).file_id is None
+    assert render.calls == 2
+
+    # Removed from the folder by someone else: rendered again
+    os.remove(first.path)
+    assert asyncio.run(store.get_report((1, "all"), render)) is not first
+    assert render.calls == 3
+
+
+def test_reports_without_expenses_are_not_stored(tmp_path):
+    store = ReportStore(str(tmp_path))
+    render = FakeRenderer(expenses_count=0)
+    assert asyncio.run(store.get_report((1, "all"), render)).expenses_count == 0
+    asyncio.run(store.get_report((1, "all"), render))
+    assert render.calls == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_render_is_shared_and_not_stored(tmp_path):
+    store = ReportStore(str(tmp_path))
+    calls = []
+
+    async def failing_render(path):
+        calls.append(path)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("render error")
+
+    async def requests():
+        return await asyncio.gather(*(store.get_report((1, "all"), failing_render) for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(requests())
+    assert len(calls) == 1
+    assert all(isinstance(x, RuntimeError) for x in results)
+    with pytest.raises(RuntimeError):
+        asyncio.run(store.get_report((1, "all"), failing_render))
+    assert len(calls) == 2
+
+
+def test_retention_by_count_and_size(tmp_path):
+    store = ReportStore(str(tmp_path), max_files=3, max_bytes=1000)
+    render = FakeRenderer(size=100)
+    reports = [asyncio.run(store.get_report((version, "all"), render)) for version in range(3)]
+    _set_mtimes([reports[1].path, reports[0].path, reports[2].path])
+
+    # The least recently used one is removed, and so it is rendered again
+    asyncio.run(store.get_report((3, "all"), render))
+    assert not os.path.exists(reports[1].path)
+    assert len(os.listdir(tmp_path)) == 3
+    asyncio.run(store.get_report((1, "all"), render))
+    assert render.calls == 5
+
+    # Over the size limit, only the last one is kept, even if it is bigger
+    store.max_bytes = 150
+    big_report = asyncio.run(store.get_report((4, "all"), FakeRenderer(size=200)))
+    assert os.listdir(tmp_path) == [os.path.basename(big_report.path)]
@@ -0,0 +1,263 @@
+import os
+import types
+import pytest
+from datetime import date
+from utils.household_expenses_db import (create_db_if_not_exist, create_sheets_queue_table_if_not_exists,
+                                         create_sheet_cells_table_if_not_exists, enqueue_sheet_operation,
+                                         count_sheet_operations, get_pending_sheet_operations,
+                                         get_sheet_cells, get_failed_sheet_operations, close_connections)
+from utils.sheets_sync import SheetsSyncWorker, INSERT_OPERATION, DELETE_OPERATION, is_retryable
+
+
+"""
+Tests of the Google Sheets write-behind queue, using fake Google Sheets backends
+
+Run:
+    From the root: $ pytest
+
+"""
+GDRIVE_INFO = {"active": True, "sheet_name": "test_sheet"}
+
+
+def _expense(expense_id, expense_date="20240328"):
+    return {"id": expense_id, "date": expense_date, "user": "Nook", "expense_type": "OTROS",
+            "expense_description": "SSSAAA", "expense_amount": 211.0}
+
+
+class FakeAPIError(Exception):
+    """
+    Like gspread.exceptions.APIError: the HTTP response is in the error
+    """
+
+    def __init__(self, status_code):
+        super().__init__(f"APIError: [{status_code}]")
+        self.response = types.SimpleNamespace(status_code=status_code)
+
+
+class FakeSheet:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.fail_year = None
+        # Expenses rejected by the API (e.g.: a worksheet protected by hand)
+        self.rejected_ids = set()
+        self.insert_calls = []
+        self.delete_calls = []
+        self.delete_cells = []
+        self.delete_dates = []
+        self.next_row = 3
+
+    def insert(self, expenses, gdrive_info, on_written=None):
+        if self.fail:
+            raise Exception("429 Quota exceeded")
+        if self.rejected_ids & {x["id"] for x in expenses}:
+            raise FakeAPIError(400)
+        self.insert_calls.append(expenses)
+        sheet_cells = {}
+        for expense in expenses:
+            year = str(expense["date"])[:4]
+            # A worksheet that can not be written
+            if year == self.fail_year:
+                raise Exception(f"Error writing {year}")
+            sheet_cells[expense["id"]] = (year, self.next_row, 11)
+            self.next_row += 1
+            if on_written is not None:
+                on_written({expense["id"]: sheet_cells[expense["id"]]})
+        return sheet_cells
+
+    def delete(self, expense_ids, gdrive_info, sheet_cells=None, expense_dates=None):
+        if self.fail:
+            raise Exception("429 Quota exceeded")
+        self.delete_calls.append(expense_ids)
+        self.delete_cells.append(sheet_cells)
+        self.delete_dates.append(expense_dates)
+
+
+def _create_db(tmp_path):
+    db_name = os.path.join(tmp_path, 'test.db')
+    create_db_if_not_exist(db_name)
+    create_sheets_queue_table_if_not_exists(db_name)
+    create_sheet_cells_table_if_not_exists(db_name)
+    return db_name
+
+
+def test_operations_are_coalesced(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet()
+    for expense_id in (1, 2, 3):
+        enqueue_sheet_operation(INSERT_OPERATION, _expense(expense_id), db_name)
+    enqueue_sheet_operation(DELETE_OPERATION, [2, 10], db_name)
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, insert_func=sheet.insert, delete_func=sheet.delete)
+
+    assert worker.run_once() == 4
+    # One batched call of each kind. Expense 2 never reaches the sheet
+    assert sheet.insert_calls == [[_expense(1), _expense(3)]]
+    assert sheet.delete_calls == [[10]]
+    assert count_sheet_operations(db_name) == 0
+    close_connections()
+
+
+def test_deletes_use_the_cells_index(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet()
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, insert_func=sheet.insert, delete_func=sheet.delete)
+    for expense_id in (1, 2):
+        enqueue_sheet_operation(INSERT_OPERATION, _expense(expense_id), db_name)
+    worker.run_once()
+    assert get_sheet_cells([1, 2], db_name) == {1: ("2024", 3, 11), 2: ("2024", 4, 11)}
+
+    enqueue_sheet_operation(DELETE_OPERATION, [{"id": 2, "date": 20240328}, {"id": 7, "date": 20230105}], db_name)
+    worker.run_once()
+    # Expense 7 was not indexed: delete_from_sheet will search it in the worksheet of its year
+    assert sheet.delete_calls == [[2, 7]]
+    assert sheet.delete_cells == [{2: ("2024", 4, 11)}]
+    assert sheet.delete_dates == [{2: 20240328, 7: 20230105}]
+    assert get_sheet_cells([1, 2], db_name) == {1: ("2024", 3, 11)}
+    close_connections()
+
+
+def test_failed_operations_are_kept_and_postponed(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet(fail=True)
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(1), db_name)
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, insert_func=sheet.insert, delete_func=sheet.delete)
+
+    assert worker.run_once() == 0
+    assert count_sheet_operations(db_name) == 1
+    # Postponed: not ready to be retried yet
+    assert get_pending_sheet_operations(db_name) == []
+    close_connections()
+
+    # A new process (restart) gets the operation and syncs it once Google is back
+    sheet.fail = False
+    pending = get_pending_sheet_operations(db_name, now=float("inf"))
+    assert pending[0]["attempts"] == 1
+    assert pending[0]["payload"] == _expense(1)
+    close_connections()
+
+
+def test_operations_wait_for_the_postponed_ones(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet(fail=True)
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, insert_func=sheet.insert, delete_func=sheet.delete)
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(1), db_name)
+    worker.run_once()
+
+    # The delete of the expense can not be done before its insert
+    sheet.fail = False
+    enqueue_sheet_operation(DELETE_OPERATION, [1], db_name)
+    assert worker.run_once() == 0
+    assert sheet.delete_calls == []
+
+    pending = get_pending_sheet_operations(db_name, now=float("inf"))
+    assert [x["operation"] for x in pending] == [INSERT_OPERATION, DELETE_OPERATION]
+    close_connections()
+
+
+@pytest.mark.parametrize("error, retryable", [(FakeAPIError(429), True), (FakeAPIError(503), True),
+                                              (ConnectionError("Connection reset"), True), (FakeAPIError(400), False),
+                                              (FakeAPIError(403), False), (KeyError("date"), False)])
+def test_retryable_errors(error, retryable):
+    assert is_retryable(error) == retryable
+
+
+def test_rejected_operations_do_not_block_the_queue(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet()
+    sheet.rejected_ids = {2}
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, insert_func=sheet.insert, delete_func=sheet.delete)
+    for expense_id in (1, 2, 3):
+        enqueue_sheet_operation(INSERT_OPERATION, _expense(expense_id), db_name)
+
+    # The batch is retried one by one: only the rejected expense fails, and it is not retried
+    assert worker.run_once() == 3
+    assert sheet.insert_calls == [[_expense(1)], [_expense(3)]]
+    assert count_sheet_operations(db_name) == 0
+    failed = get_failed_sheet_operations(db_name)
+    assert [(x["payload"], x["attempts"]) for x in failed] == [(_expense(2), 1)]
+    assert "400" in failed[0]["error"]
+    close_connections()
+
+
+def test_operations_are_given_up_after_max_attempts(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet(fail=True)
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, base_backoff=0, max_attempts=3,
+                              insert_func=sheet.insert, delete_func=sheet.delete)
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(1), db_name)
+    assert [worker.run_once() for _ in range(3)] == [0, 0, 1]
+    assert [x["attempts"] for x in get_failed_sheet_operations(db_name)] == [3]
+
+    # The next operations are not held back
+    sheet.fail = False
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(2), db_name)
+    assert worker.run_once() == 1
+    assert sheet.insert_calls == [[_expense(2)]]
+    close_connections()
+
+
+def test_retried_inserts_are_not_written_twice(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet()
+    sheet.fail_year = "2025"
+    # Retried right away
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, base_backoff=0, insert_func=sheet.insert, delete_func=sheet.delete)
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(1), db_name)
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(2, "20250102"), db_name)
+    assert worker.run_once() == 0
+    # The 2024 worksheet was written before the error
+    assert get_sheet_cells([1, 2], db_name) == {1: ("2024", 3, 11)}
+
+    sheet.fail_year = None
+    assert worker.run_once() == 2
+    assert sheet.insert_calls[-1] == [_expense(2, "20250102")]
+    assert set(get_sheet_cells([1, 2], db_name)) == {1, 2}
+    close_connections()
+
+
+def test_worker_thread(tmp_path):
+    db_name = _create_db(tmp_path)
+    sheet = FakeSheet()
+    worker = SheetsSyncWorker(db_name, GDRIVE_INFO, idle_interval=5,
+                              insert_func=sheet.insert, delete_func=sheet.delete, refresh_func=lambda gdrive_info: False)
+    worker.start()
+    enqueue_sheet_operation(INSERT_OPERATION, _expense(1), db_name)
+    worker.notify()
+    worker.stop()
+    # The worker was woken up before stopping, so the operation was handled
+    assert sheet.insert_calls == [[_expense(1)]]
+    close_connections()
+
+
+def test_next_year_worksheet_is_prepared_in_december(tmp_path):
+    prepared = []
+    refreshed = []
+    worker = SheetsSyncWorker(os.path.join(tmp_path, 'test.db'), GDRIVE_INFO,
+                              prepare_func=lambda gdrive_info, name: prepared.append(name),
+                              refresh_func=refreshed.append)
+    worker.run_maintenance(today=date(2024, 11, 30))
+    assert prepared == []
+    worker.run_maintenance(today=date(2024, 12, 1))
+    worker.run_maintenance(today=date(2024, 12, 2))
+    assert prepared == ["2025"]
+    # The access token is checked on every idle round
+    assert refreshed == [GDRIVE_INFO] * 3
+
+
+def test_failed_worksheet_preparation_backs_off(tmp_path):
+    attempts = []
+
+    def failing_prepare(gdrive_info, name):
+        attempts.append(name)
+        raise Exception("429 Quota exceeded")
+
+    worker = SheetsSyncWorker(os.path.join(tmp_path, 'test.db'), GDRIVE_INFO, base_backoff=60,
+                              prepare_func=failing_prepare, refresh_func=lambda gdrive_info: False)
+    for _ in range(3):
+        worker.run_maintenance(today=date(2024, 12, 1))
+    assert attempts == ["2025"]
+
+    # Once the wait is over, it is tried again
+    worker._prepare_retry_at = 0.0
+    worker.run_maintenance(today=date(2024, 12, 1))
+    assert attempts == ["2025", "2025"]
+    assert worker._prepare_failures == 2
@@ -0,0 +1,80 @@
+import asyncio
+import socket
+import pytest
+from telegram import Bot, Update
+from telegram.ext import Updater
+from utils.config import WebhookConfig
+from utils.webhook import build_text_update, post_update
+
+
+"""
+Tests of the webhook mode: synthetic updates posted to the embedded server of python-telegram-bot
+
+Run:
+    From the root: $ pytest
+
+"""
+SECRET_TOKEN = "s3cret"
+
+
+class OfflineBot(Bot):
+    """
+    Bot that does not call the Telegram API
+    """
+    async def initialize(self):
+        pass
+
+    async def set_webhook(self, *args, **kwargs):
+        return True
+
+    async def delete_webhook(self, *args, **kwargs):
+        return True
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_build_text_update():
+    update = Update.de_json(build_text_update("/summary 202403", 1, "Nook", update_id=7), None)
+    assert update.update_id == 7
+    assert update.effective_user.id == 1
+    assert update.effective_chat.id == 1
+    assert update.message.text == "/summary 202403"
+    assert update.message.entities[0].type == "bot_command" and update.message.entities[0].length == 8
+
+    update = Update.de_json(build_text_update("ADD EXPENSE", 1), None)
+    assert update.message.entities == ()
+
+
+def test_local_url():
+    assert WebhookConfig(port=8000).local_url == "http://127.0.0.1:8000/telegram"
+    assert WebhookConfig(listen="0.0.0.0", url_path="bot", cert="cert.pem").local_url == "https://127.0.0.1:8443/bot"
+
+
+def test_post_update_to_webhook_server():
+    pytest.importorskip("tornado")
+
+    async def run():
+        webhook_config = WebhookConfig(active=True, port=_free_port(), secret_token=SECRET_TOKEN)
+        update_queue = asyncio.Queue()
+        updater = Updater(OfflineBot("123:TOKEN"), update_queue)
+        await updater.initialize()
+        await updater.start_webhook(listen=webhook_config.listen, port=webhook_config.port,
+                                    url_path=webhook_config.url_path, secret_token=webhook_config.secret_token,
+                                    max_connections=webhook_config.max_connections)
+        try:
+            statuses = [
+                await asyncio.to_thread(post_update, webhook_config.local_url, build_text_update("/start", 1), x)
+                for x in (SECRET_TOKEN, "wrong", None)]
+            return statuses, [update_queue.get_nowait() for _ in range(update_queue.qsize())]
+        finally:
+            await updater.stop()
+            await updater.shutdown()
+
+    statuses, updates = asyncio.run(run())
+    # Only the update with the secret token is accepted
+    assert statuses == [200, 403, 403]
+    assert [x.message.text for x in updates] == ["/start"]
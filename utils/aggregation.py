@@ -0,0 +1,106 @@
+import itertools
+import sys
+from utils.household_expenses_db import ExpenseRow
+
+
+def is_dataframe(expenses):
+    """
+    :return bool: True if expenses is a pandas DataFrame. pandas is not imported for it:
+                  if nobody has imported it, it can not be a DataFrame
+    """
+    pandas = sys.modules.get("pandas")
+    return pandas is not None and isinstance(expenses, pandas.DataFrame)
+
+
+def iter_expense_rows(expenses):
+    """
+    Iterate the expenses as ExpenseRow, whatever their origin
+
+    :param expenses: Dict of expenses dicts (see utils.report.create_report), DataFrame of expenses
+                     (see utils.expenses_frame) or iterable of ExpenseRow
+                     (e.g.: utils.household_expenses_db.iter_table_content)
+    :return: Iterator of ExpenseRow
+    """
+    if is_dataframe(expenses):
+        # tolist: Python values, not NumPy scalars
+        yield from itertools.starmap(ExpenseRow, zip(*(expenses[x].tolist() for x in ExpenseRow._fields)))
+    elif isinstance(expenses, dict):
+        for expense_id, expense in expenses.items():
+            yield ExpenseRow(expense_id, expense.get('date'), expense.get('user'), expense.get('expense_type'),
+                             expense.get('expense_description'), expense.get('expense_amount'))
+    else:
+        yield from expenses
+
+
+def aggregate_expenses(expenses):
+    """
+    Group and total the expenses by month, by month and type and by month and user,
+    in one single pass over the expenses
+
+    :param expenses: Dict of expenses dicts (see utils.report.create_report), DataFrame of expenses
+                     (see utils.expenses_frame) or iterable of ExpenseRow
+    :return dict: Dict with one entry per month (yyyymm), in order of appearance. e.g.:
+    {
+        '202001': {
+            'expenses': {2: ExpenseRow(2, ...), 1: ExpenseRow(1, ...)},
+            'total_amount': 33.0,
+            'types': {
+                'TYPE_1': {'ids': [1], 'total_amount': 12.0},
+                'TYPE_2': {'ids': [2], 'total_amount': 21.0}
+            },
+            'users': {'user1': 12.0, 'user2': 21.0}
+        }
+    }
+    """
+    if is_dataframe(expenses):
+        return aggregate_expenses_frame(expenses)
+
+    months = {}
+    for expense in iter_expense_rows(expenses):
+        month = str(expense.date)[:6]
+        month_summary = months.get(month)
+        if month_summary is None:
+            month_summary = months[month] = {'expenses': {}, 'total_amount': 0.0, 'types': {}, 'users': {}}
+        amount = expense.expense_amount
+        month_summary['expenses'][expense.id] = expense
+        month_summary['total_amount'] += amount
+
+        type_summary = month_summary['types'].get(expense.expense_type)
+        if type_summary is None:
+            type_summary = month_summary['types'][expense.expense_type] = {'ids': [], 'total_amount': 0.0}
+        type_summary['ids'].append(expense.id)
+        type_summary['total_amount'] += amount
+
+        month_summary['users'][expense.user] = month_summary['users'].get(expense.user, 0.0) + amount
+    return months
+
+
+def aggregate_expenses_frame(frame):
+    """
+    Same as aggregate_expenses, with the totals computed vectorially with groupby
+
+    :param DataFrame frame: Expenses (see utils.expenses_frame)
+    :return dict: See aggregate_expenses
+    """
+    months = {}
+    # Grouping by the yyyymm int is faster than by its str
+    month_keys = frame['date'] // 100
+    amounts = frame['expense_amount']
+    for month, total_amount in amounts.groupby(month_keys, sort=False).sum().items():
+        months[str(month)] = {'expenses': {}, 'total_amount': float(total_amount), 'types': {}, 'users': {}}
+    by_type = amounts.groupby([month_keys, frame['expense_type']], sort=False, observed=True).sum()
+    for (month, expense_type), total_amount in by_type.items():
+        months[str(month)]['types'][expense_type] = {'ids': [], 'total_amount': float(total_amount)}
+    by_user = amounts.groupby([month_keys, frame['user']], sort=False, observed=True).sum()
+    for (month, user), total_amount in by_user.items():
+        months[str(month)]['users'][user] = float(total_amount)
+
+    # The rows of every month are still needed by the tables of the report
+    rows = list(iter_expense_rows(frame))
+    ids = frame['id'].to_numpy()
+    for month, positions in month_keys.groupby(month_keys, sort=False).indices.items():
+        months[str(month)]['expenses'] = {x.id: x for x in map(rows.__getitem__, positions.tolist())}
+    by_type_positions = month_keys.groupby([month_keys, frame['expense_type']], sort=False, observed=True).indices
+    for (month, expense_type), positions in by_type_positions.items():
+        months[str(month)]['types'][expense_type]['ids'] = ids[positions].tolist()
+    return months
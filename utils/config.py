@@ -0,0 +1,294 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import re
+import types
+from typing import Mapping, Optional
+
+
+"""
+Typed, immutable configuration of the bot (see conf/README.md), parsed once from conf/config.json,
+and the watcher that reloads it when the file changes
+"""
+logger = logging.getLogger(__name__)
+DEFAULT_RELOAD_INTERVAL = 5.0
+# Secret tokens accepted by Telegram (setWebhook)
+SECRET_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+# Placeholder of conf/config_example.json
+EXAMPLE_SECRET_TOKEN = "change_me"
+# Texts of the features added after the first config files: the config files without them keep working
+DEFAULT_TEXTS = {
+    "main_actions_export": "EXPORT DATA",
+    "export_select_format": "Which file format?",
+    "export_format_invalid": "Wrong file format.",
+    "report_select_period": "Which period? (You can also write YYYY, YYYYMM or YYYYMMDD-YYYYMMDD)",
+    "report_period_this_month": "THIS MONTH",
+    "report_period_last_month": "LAST MONTH",
+    "report_period_this_year": "THIS YEAR",
+    "report_period_all": "ALL",
+    "report_period_invalid": "Wrong period.",
+    "report_select_filter": "Which expenses? (You can also write an expense type)",
+    "report_filter_all": "ALL TYPES",
+    "report_filter_mine": "ONLY MINE",
+    "report_no_expenses": "There are no expenses to report.",
+    "summary_title": "Expenses of {month}:\n",
+    "summary_total": "TOTAL",
+    "summary_empty": "There are no expenses in {month}.",
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class GdriveConfig:
+    active: bool = False
+    credentials_file: str = "conf/gdrive_credentials.json"
+    sheet_name: str = "household_expenses_sheet"
+    share_mails: tuple = ()
+    sync_batch_size: int = 200
+    sync_max_attempts: int = 20
+
+    def as_dict(self):
+        """
+        :return: dict gdrive_info, as used by utils.gdrive and utils.sheets_sync
+        """
+        return dataclasses.asdict(self)
+
+
+@dataclasses.dataclass(frozen=True)
+class ExecutorConfig:
+    io_workers: Optional[int] = None
+    cpu_workers: Optional[int] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class LoggingConfig:
+    level: str = "INFO"
+    # Logger name -> level, e.g.: {"utils.household_expenses_db": "DEBUG"}. httpx logs every request to Telegram
+    levels: Mapping = dataclasses.field(default_factory=lambda: types.MappingProxyType({"httpx": "WARNING"}))
+    # "text" or "json" (one JSON object per line)
+    format: str = "text"
+    max_bytes: int = 20000000
+    backup_count: int = 1000
+    # Only 1 of every debug_sample_rate DEBUG lines of these loggers is written
+    sampled_loggers: tuple = ("utils.household_expenses_db",)
+    debug_sample_rate: int = 100
+
+    def __post_init__(self):
+        wrong_levels = [x for x in (self.level, *self.levels.values()) if not isinstance(logging.getLevelName(x), int)]
+        if wrong_levels:
+            raise ValueError(f"Wrong log levels: {', '.join(map(str, wrong_levels))}")
+        if self.format not in ("text", "json"):
+            raise ValueError(f"Wrong log format: {self.format}")
+
+
+@dataclasses.dataclass(frozen=True)
+class WebhookConfig:
+    # False: the bot polls Telegram for updates
+    active: bool = False
+    listen: str = "127.0.0.1"
+    port: int = 8443
+    url_path: str = "telegram"
+    # Public URL registered in Telegram (e.g.: https://bot.example.com/telegram). None: built of listen, port, url_path
+    webhook_url: Optional[str] = None
+    # Sent by Telegram in the header X-Telegram-Bot-Api-Secret-Token. Updates without it are rejected
+    secret_token: Optional[str] = None
+    max_connections: int = 40
+    # TLS certificate and key. None: plain HTTP (e.g.: behind a reverse proxy)
+    cert: Optional[str] = None
+    key: Optional[str] = None
+
+    def __post_init__(self):
+        # Without a secret token, anyone who finds the URL can send fake updates to the bot
+        if not self.active:
+            return
+        if not self.secret_token or self.secret_token == EXAMPLE_SECRET_TOKEN:
+            raise ValueError("The webhook needs a secret_token (not the one of the example config)")
+        if not SECRET_TOKEN_PATTERN.match(self.secret_token):
+            raise ValueError("Wrong webhook secret_token: 1-256 characters A-Z, a-z, 0-9, _ and -")
+
+    @property
+    def local_url(self):
+        """
+        :return str: URL of the embedded server, as reachable from this machine
+        """
+        host = "127.0.0.1" if self.listen in ("0.0.0.0", "") else self.listen
+        return f"{'https' if self.cert else 'http'}://{host}:{self.port}/{self.url_path}"
+
+
+@dataclasses.dataclass(frozen=True)
+class MetricsConfig:
+    # Serve the metrics in the Prometheus format on http://<listen>:<port>/metrics
+    active: bool = False
+    listen: str = "127.0.0.1"
+    port: int = 9464
+
+
+@dataclasses.dataclass(frozen=True)
+class ProfilingConfig:
+    # Fraction of the calls of the targets profiled (see utils.profiling). 0: only /profile_report
+    sample_rate: float = 0.0
+    # create_report, render_month_section (one month, also in the render workers) and the handler names
+    # (e.g.: receive_report_filter)
+    targets: tuple = ("create_report", "render_month_section")
+    # Trace the memory allocations too (tracemalloc). It makes the profiled calls much slower
+    memory: bool = False
+    # Lines of every section of the summaries
+    top: int = 30
+    max_profiles: int = 100
+
+
+@dataclasses.dataclass(frozen=True)
+class ReportsConfig:
+    # Reports kept in the reports folder. The least recently used ones are removed
+    max_files: int = 50
+    max_bytes: int = 100000000
+    # Processes rendering the months of every report in parallel. 1: no parallel rendering
+    render_workers: int = 1
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    output_folder: str
+    db_filename: str
+    log_filename: str = "household_expenses.log"
+    allowed_users: frozenset = frozenset()
+    # Users allowed to use the admin commands (e.g.: /stats)
+    admin_users: frozenset = frozenset()
+    texts: Mapping = dataclasses.field(default_factory=lambda: types.MappingProxyType({}))
+    gdrive: GdriveConfig = GdriveConfig()
+    executor: ExecutorConfig = ExecutorConfig()
+    webhook: WebhookConfig = WebhookConfig()
+    logging: LoggingConfig = LoggingConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    profiling: ProfilingConfig = ProfilingConfig()
+    reports: ReportsConfig = ReportsConfig()
+    # Seconds between checks of the config file. 0: no hot reload
+    config_reload_interval: float = DEFAULT_RELOAD_INTERVAL
+
+    @property
+    def db_path(self):
+        return os.path.join(self.output_folder, self.db_filename)
+
+
+def load_config(filename):
+    """
+    Load and validate the config file
+
+    :param str filename: Config file path
+    :return Config: Config
+    :raise ValueError: If the file is not valid JSON or the config is not valid
+    """
+    with open(filename) as f:
+        return parse_config(json.loads(f.read()))
+
+
+def parse_config(raw_config):
+    """
+    Build the Config of the content of the config file
+
+    :param dict raw_config: Content of the config file
+    :return Config: Config
+    :raise ValueError: If the config is not valid
+    """
+    missing_fields = [x for x in ("output_folder", "db_filename") if not raw_config.get(x)]
+    if missing_fields:
+        raise ValueError(f"Missing config fields: {', '.join(missing_fields)}")
+    texts = {**DEFAULT_TEXTS, **raw_config.get("texts", {})}
+    try:
+        return Config(
+            output_folder=raw_config["output_folder"],
+            db_filename=raw_config["db_filename"],
+            log_filename=raw_config.get("log_filename", Config.log_filename),
+            allowed_users=frozenset(raw_config.get("allowed_users", [])),
+            admin_users=frozenset(raw_config.get("admin_users", [])),
+            # The lists (e.g.: the expense type buttons) become tuples, so nothing can be changed
+            texts=types.MappingProxyType({k: freeze(v) for k, v in texts.items()}),
+            gdrive=build_section(GdriveConfig, raw_config.get("gdrive")),
+            executor=build_section(ExecutorConfig, raw_config.get("executor")),
+            webhook=build_section(WebhookConfig, raw_config.get("webhook")),
+            logging=build_section(LoggingConfig, raw_config.get("logging")),
+            metrics=build_section(MetricsConfig, raw_config.get("metrics")),
+            profiling=build_section(ProfilingConfig, raw_config.get("profiling")),
+            reports=build_section(ReportsConfig, raw_config.get("reports")),
+            config_reload_interval=float(raw_config.get("config_reload_interval", DEFAULT_RELOAD_INTERVAL)),
+        )
+    except TypeError as e:
+        raise ValueError(f"Wrong config: {e}")
+
+
+def build_section(section_class, raw_section):
+    """
+    Build the dataclass of a config section. Unknown fields are ignored, lists become tuples
+    and dicts read-only mappings
+
+    :param section_class: Dataclass of the section
+    :param dict raw_section: Section of the config file (None: defaults)
+    :return: Instance of section_class
+    """
+    fields = {x.name for x in dataclasses.fields(section_class)}
+    return section_class(**{k: freeze(v) for k, v in (raw_section or {}).items() if k in fields})
+
+
+def freeze(value):
+    """
+    :return: The value, with the lists as tuples and the dicts as read-only mappings
+    """
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return types.MappingProxyType(value)
+    return value
+
+
+class ConfigWatcher:
+    """
+    Reload the config when its file changes (polling its modification time and size).
+    A config file with errors is not applied: the current config is kept
+    """
+
+    def __init__(self, filename, on_reload, interval=DEFAULT_RELOAD_INTERVAL):
+        """
+        :param str filename: Config file path
+        :param on_reload: func(Config) called with the new config
+        :param float interval: Seconds between checks
+        """
+        self.filename = filename
+        self.on_reload = on_reload
+        self.interval = interval
+        self._stamp = self._get_stamp()
+
+    def _get_stamp(self):
+        stat = os.stat(self.filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self):
+        """
+        Reload the config if the file changed since the last check
+
+        :return bool: True if the new config has been applied
+        """
+        try:
+            stamp = self._get_stamp()
+        except OSError as e:
+            logger.warning(f"CONFIG: Can not read {self.filename}: {e}")
+            return False
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            config = load_config(self.filename)
+        except (OSError, ValueError) as e:
+            logger.warning(f"CONFIG: {self.filename} not reloaded, the current config is kept: {e}")
+            return False
+        self.on_reload(config)
+        logger.info(f"CONFIG: {self.filename} reloaded")
+        return True
+
+    async def watch(self):
+        """
+        Check the file every interval seconds, until cancelled
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from utils.metrics import Gauge
+
+
+logger = logging.getLogger(__name__)
+
+
+# Blocking work must never run in the event loop, it would freeze the bot for every user:
+# - I/O bound work (SQLite, Google Sheets, files) goes to a thread pool
+# - CPU bound work (PDF rendering) goes to a process pool
+DEFAULT_IO_WORKERS = 8
+DEFAULT_CPU_WORKERS = 2
+# The worker processes are never forked from the bot: it runs several threads (log listener, Sheets sync worker,
+# I/O pool, metrics server...), and a forked child can inherit a lock held by one of them (or a SQLite connection)
+CPU_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_io_workers = DEFAULT_IO_WORKERS
+_cpu_workers = DEFAULT_CPU_WORKERS
+_io_executor = None
+_cpu_executor = None
+# Function run by every new worker process, and its arguments (e.g.: settings of the worker modules)
+_cpu_initializer = None
+_cpu_initargs = ()
+# Modules imported once by the fork server, so the worker processes start with them already imported
+_cpu_preload = ()
+
+EXECUTOR_TASKS = Gauge("household_expenses_executor_tasks", "Tasks queued or running in the pools", ["pool"])
+
+
+def configure_executors(io_workers=None, cpu_workers=None, cpu_initializer=None, cpu_initargs=(), cpu_preload=()):
+    """
+    Set the size of the pools. Must be called before the first task is submitted
+
+    :param int io_workers: Number of threads for I/O bound tasks
+    :param int cpu_workers: Number of processes for CPU bound tasks
+    :param cpu_initializer: Picklable function run by every process of the CPU pool when it starts
+    :param tuple cpu_initargs: Arguments of cpu_initializer
+    :param cpu_preload: Names of the modules preloaded by the fork server (e.g.: utils.report). Only with forkserver
+    """
+    global _io_workers, _cpu_workers, _cpu_initializer, _cpu_initargs, _cpu_preload
+    if io_workers:
+        _io_workers = io_workers
+    if cpu_workers:
+        _cpu_workers = cpu_workers
+    _cpu_initializer, _cpu_initargs, _cpu_preload = cpu_initializer, tuple(cpu_initargs), tuple(cpu_preload)
+
+
+def get_io_executor():
+    """
+    Get (creating it if needed) the thread pool used for I/O bound tasks
+    """
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=_io_workers, thread_name_prefix="io")
+        logger.info(f"EXECUTOR: I/O pool started with {_io_workers} threads")
+    return _io_executor
+
+
+def get_cpu_executor():
+    """
+    Get (creating it if needed) the process pool used for CPU bound tasks
+    """
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=_cpu_workers, mp_context=get_mp_context(_cpu_preload),
+                                            initializer=_cpu_initializer, initargs=_cpu_initargs)
+        logger.info(f"EXECUTOR: CPU pool started with {_cpu_workers} processes")
+    return _cpu_executor
+
+
+def get_mp_context(preload=()):
+    """
+    :param preload: Names of the modules preloaded by the fork server, if it is not running yet
+    :return: multiprocessing context of the process pools (see CPU_START_METHOD)
+    """
+    context = multiprocessing.get_context(CPU_START_METHOD)
+    if preload and CPU_START_METHOD == "forkserver":
+        context.set_forkserver_preload(list(preload))
+    return context
+
+
+def init_worker(logging_args=None, profiling_settings=None):
+    """
+    Initializer of the worker processes: log to the file of the bot, and profile like the process that started them
+
+    :param tuple logging_args: See utils.logs.setup_worker_logging. None: no logging
+    :param tuple profiling_settings: See utils.profiling.configure_profiling. None: no profiling
+    """
+    # Imported here: utils.logs uses this module
+    from utils.logs import setup_worker_logging
+    from utils.profiling import configure_profiling
+    if logging_args is not None:
+        setup_worker_logging(*logging_args)
+    if profiling_settings is not None:
+        configure_profiling(*profiling_settings)
+
+
+def get_worker_initargs():
+    """
+    :return tuple: Arguments of init_worker with the logging and profiling settings of the current process
+    """
+    from utils.logs import get_worker_logging_args
+    from utils.profiling import get_profiling_settings
+    return get_worker_logging_args(), get_profiling_settings()
+
+
+async def run_io(func, *args, **kwargs):
+    """
+    Run a blocking I/O bound function in the thread pool without blocking the event loop
+
+    :return: The value returned by func
+    """
+    loop = asyncio.get_running_loop()
+    EXECUTOR_TASKS.inc(pool="io")
+    try:
+        return await loop.run_in_executor(get_io_executor(), partial(func, *args, **kwargs))
+    finally:
+        EXECUTOR_TASKS.dec(pool="io")
+
+
+async def run_cpu(func, *args, **kwargs):
+    """
+    Run a CPU bound function in the process pool without blocking the event loop.
+    func and its arguments must be picklable (module level function, plain data)
+
+    :return: The value returned by func
+    """
+    loop = asyncio.get_running_loop()
+    EXECUTOR_TASKS.inc(pool="cpu")
+    try:
+        return await loop.run_in_executor(get_cpu_executor(), partial(func, *args, **kwargs))
+    finally:
+        EXECUTOR_TASKS.dec(pool="cpu")
+
+
+def shutdown_executors(wait=True):
+    """
+    Stop both pools. Meant to be called once, on shutdown.
+
+    :param bool wait: Wait for the pending tasks to finish
+    """
+    global _io_executor, _cpu_executor
+    if _io_executor is not None:
+        _io_executor.shutdown(wait=wait)
+        _io_executor = None
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=wait)
+        _cpu_executor = None
+    logger.info("EXECUTOR: Pools stopped")
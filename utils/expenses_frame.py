@@ -0,0 +1,51 @@
+import logging
+import pandas as pd
+from utils.aggregation import iter_expense_rows
+from utils.household_expenses_db import ExpenseRow, build_expenses_query, get_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+# Columnar layout of the expenses: the repeated users and types are stored once (categorical),
+# the dates as int32 (yyyymmdd) and the amounts as float64
+EXPENSES_FRAME_DTYPES = {
+    "id": "int64",
+    "date": "int32",
+    "user": "category",
+    "expense_type": "category",
+    "expense_amount": "float64",
+}
+
+
+def get_expenses_frame(db_name='household_expenses.db', limit=0, date_from=None, date_to=None,
+                       expense_types=None, user=None):
+    """
+    Load the last <limit> rows of the table EXPENSES, optionally filtered (see
+    utils.household_expenses_db.get_table_content), into a DataFrame in one bulk read
+
+    :return: DataFrame with the columns of ExpenseRow, in the same order as get_table_content
+    """
+    query, parameters = build_expenses_query(limit, date_from, date_to, expense_types, user)
+    frame = pd.read_sql_query(query, get_connection(db_name), params=parameters)
+    frame.columns = list(ExpenseRow._fields)
+    logger.info(f"GET: {len(frame)} rows")
+    logger.debug("GET: Query: %s %s", query, parameters)
+    return compact_frame(frame)
+
+
+def to_expenses_frame(expenses):
+    """
+    Build the DataFrame of the expenses
+
+    :param expenses: Dict of expenses dicts (see utils.report.create_report), or iterable of ExpenseRow
+    :return: DataFrame with the columns of ExpenseRow
+    """
+    return compact_frame(pd.DataFrame.from_records(list(iter_expense_rows(expenses)), columns=ExpenseRow._fields))
+
+
+def compact_frame(frame):
+    """
+    :return: DataFrame with the types of EXPENSES_FRAME_DTYPES
+    """
+    return frame.astype(EXPENSES_FRAME_DTYPES)
@@ -0,0 +1,105 @@
+import csv
+import importlib.util
+import itertools
+import logging
+import xlsxwriter
+from utils.household_expenses_db import ExpenseRow, iter_table_content
+
+
+"""
+Export of the raw expenses to CSV, XLSX or Parquet.
+The rows are streamed from SQLite into the file, so the memory used does not depend on the size of the table.
+The columns are the ones of utils.importer, so an exported file can be imported again
+"""
+logger = logging.getLogger(__name__)
+CSV_FORMAT = "csv"
+XLSX_FORMAT = "xlsx"
+PARQUET_FORMAT = "parquet"
+EXPORT_HEADERS = list(ExpenseRow._fields)
+# Rows per Parquet row group
+PARQUET_BATCH_SIZE = 50000
+
+
+def get_export_formats():
+    """
+    :return: List of the available formats. Parquet needs the optional dependency pyarrow
+    """
+    export_formats = [CSV_FORMAT, XLSX_FORMAT]
+    if importlib.util.find_spec("pyarrow") is not None:
+        export_formats.append(PARQUET_FORMAT)
+    return export_formats
+
+
+def export_expenses(filename, db_name='household_expenses.db', export_format=CSV_FORMAT, **filters):
+    """
+    Export the expenses to a file
+
+    :param str filename: File path
+    :param str db_name: path of the database file
+    :param str export_format: CSV_FORMAT, XLSX_FORMAT or PARQUET_FORMAT
+    :param filters: date_from, date_to, expense_types and user (see utils.household_expenses_db.get_table_content)
+    :return int: Number of exported expenses
+    """
+    writers = {CSV_FORMAT: write_csv, XLSX_FORMAT: write_xlsx, PARQUET_FORMAT: write_parquet}
+    if export_format not in writers:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    rows_count = writers[export_format](filename, iter_table_content(db_name, limit=0, **filters))
+    logger.info(f"EXPORT: {rows_count} expenses exported to {filename}")
+    return rows_count
+
+
+def write_csv(filename, rows):
+    """
+    :param str filename: File path
+    :param rows: Iterable of ExpenseRow
+    :return int: Number of rows written
+    """
+    counter = itertools.count()
+    with open(filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_HEADERS)
+        # The rows are tuples: written as they come, counted on the way
+        writer.writerows(row for row, _ in zip(rows, counter))
+    return next(counter)
+
+
+def write_xlsx(filename, rows):
+    """
+    :param str filename: File path
+    :param rows: Iterable of ExpenseRow
+    :return int: Number of rows written
+    """
+    # constant_memory: every row is flushed to disk once the next one is written
+    workbook = xlsxwriter.Workbook(filename, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet("expenses")
+        worksheet.write_row(0, 0, EXPORT_HEADERS, workbook.add_format({"bold": True}))
+        rows_count = 0
+        for rows_count, row in enumerate(rows, start=1):
+            worksheet.write_row(rows_count, 0, row)
+    finally:
+        workbook.close()
+    return rows_count
+
+
+def write_parquet(filename, rows):
+    """
+    :param str filename: File path
+    :param rows: Iterable of ExpenseRow
+    :return int: Number of rows written
+    """
+    # Optional dependency (see get_export_formats)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("id", pa.int64()), ("date", pa.int32()), ("user", pa.dictionary(pa.int32(), pa.string())),
+                        ("expense_type", pa.dictionary(pa.int32(), pa.string())),
+                        ("expense_description", pa.string()), ("expense_amount", pa.float64())])
+    rows = iter(rows)
+    rows_count = 0
+    with pq.ParquetWriter(filename, schema) as writer:
+        # One row group per batch of rows, converted column by column
+        for batch in iter(lambda: list(itertools.islice(rows, PARQUET_BATCH_SIZE)), []):
+            columns = [pa.array(x, type=schema.field(i).type) for i, x in enumerate(zip(*batch))]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            rows_count += len(batch)
+    return rows_count
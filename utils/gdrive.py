@@ -1,26 +1,159 @@
 import calendar
-import time
+import functools
 import gspread
 import logging
-import pandas as pd
-from datetime import date
+import threading
+from datetime import date, datetime, timedelta, timezone
 from xlsxwriter.utility import xl_col_to_name
-from oauth2client.service_account import ServiceAccountCredentials
+from utils.rate_limiter import RateLimiter
+from utils.metrics import Histogram, CallbackMetric, timed
+
+
+logger = logging.getLogger(__name__)
 
 # https://docs.gspread.org/en/latest/user-guide.html#deleting-a-worksheet
 
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
+          "https://www.googleapis.com/auth/drive"]
+DEFAULT_CREDENTIALS_FILE = "conf/gdrive_credentials.json"
+# The access token is refreshed in background when it expires in less than this
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Columns of every month in the year worksheets
+SHEET_HEADERS = ["ID", "DATE", "TYPE", "DESCRIPTION", "AMOUNT"]
+# ID column of every month in the year worksheets: {1: 1, 2: 6, ..., 12: 56}
+DEFAULT_MONTH_COLUMNS = {i+1: (i*len(SHEET_HEADERS)) + 1 for i in range(12)}
+
+# We have a quota of 60 req/min. Every call to Google goes through this limiter
+SHEETS_REQUESTS_PER_MINUTE = 60
+SHEETS_LIMITER = RateLimiter(rate=SHEETS_REQUESTS_PER_MINUTE, period=60)
+
+SHEETS_SECONDS = Histogram("household_expenses_sheets_seconds", "Time of the Google Sheets operations, waits included",
+                           ["operation"])
+
+
+def get_limiter_counter(name):
+    """
+    :return: func() -> Counter <name> of SHEETS_LIMITER (see RateLimiter.usage)
+    """
+    return lambda: SHEETS_LIMITER.usage()[name]
+
+
+CallbackMetric("household_expenses_sheets_requests_total", "Requests sent to Google Sheets", "counter",
+               get_limiter_counter("requests"))
+CallbackMetric("household_expenses_sheets_throttled_total", "Requests delayed by the rate limiter", "counter",
+               get_limiter_counter("throttled"))
+CallbackMetric("household_expenses_sheets_quota_errors_total", "Quota errors (HTTP 429) returned by Google Sheets",
+               "counter", get_limiter_counter("quota_errors"))
+CallbackMetric("household_expenses_sheets_retries_total", "Requests retried after a quota or transient error",
+               "counter", get_limiter_counter("retries"))
+
 
-def get_sheet(sheet_name, users_to_share=None): 
+def sheets_call(func, *args, **kwargs):
+    """
+    Call a gspread function through the shared rate limiter
+    """
+    return SHEETS_LIMITER.call(func, *args, **kwargs)
+
+
+def get_quota_usage():
+    """
+    Get the current usage of the Google Sheets quota
+    """
+    return SHEETS_LIMITER.usage()
+
+
+# Authorized gspread client. Google is only contacted once it is needed (see get_client)
+client = None
+_client_lock = threading.Lock()
+
+
+def get_client(credentials_file=None):
+    """
+    Get the gspread client, authorizing the service account on first use
+
+    :param str credentials_file: Service account credentials (default: DEFAULT_CREDENTIALS_FILE)
+    :return: gspread Client
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                client = gspread.service_account(filename=credentials_file or DEFAULT_CREDENTIALS_FILE, scopes=SCOPES)
+                logger.info("GDRIVE: Client authorized")
+    return client
+
+
+def refresh_token(gdrive_info):
+    """
+    Refresh the access token of the client if it is about to expire, so no sync call waits for it.
+    Called by the sync worker when it is idle
+
+    :param dict gdrive_info: gdrive section of the config
+    :return bool: True if the token has been refreshed
+    """
+    credentials = getattr(getattr(get_client(gdrive_info.get("credentials_file")), "http_client", None), "auth", None)
+    if credentials is None:
+        return False
+    # google-auth expiry: naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if credentials.valid and credentials.expiry and credentials.expiry - now > TOKEN_REFRESH_MARGIN:
+        return False
+    # Imported here: only needed by the real client
+    from google.auth.transport.requests import Request
+    credentials.refresh(Request())
+    logger.info(f"GDRIVE: Access token refreshed. Expiry: {credentials.expiry}")
+    return True
+
+
+# In-process cache of the opened spreadsheets, the year worksheets and their month columns,
+# so every sync operation does not search and open them again
+_cache = {"sheets": {}, "worksheets": {}, "month_columns": {}}
+_cache_lock = threading.Lock()
+
+
+def invalidate_cache():
+    """
+    Forget every cached spreadsheet, worksheet and layout
+    """
+    with _cache_lock:
+        for cached_values in _cache.values():
+            cached_values.clear()
+    logger.info("GDRIVE: Cache invalidated")
+
+
+def invalidate_cache_on_error(func):
+    """
+    Decorator: invalidate the cache if Google says that something cached does not exist anymore,
+    or on any API error, so the next call starts from scratch
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound,
+                gspread.exceptions.APIError):
+            invalidate_cache()
+            raise
+    return wrapper
+
+
+def get_sheet(sheet_name, users_to_share=None, credentials_file=None): 
     """
     Get sheet by name. 
     If the sheet does not exist, creates it and share with users
     """
+    sht = _cache["sheets"].get(sheet_name)
+    if sht is not None:
+        return sht
     try:
-        sht = client.open(sheet_name)
+        sht = sheets_call(get_client(credentials_file).open, sheet_name)
     except gspread.exceptions.SpreadsheetNotFound:
-        sht = client.create(sheet_name)
-        for user in users_to_share:
-            sht.share(user, perm_type='user', role='writer')
+        sht = sheets_call(get_client(credentials_file).create, sheet_name)
+        for user in users_to_share or []:
+            sheets_call(sht.share, user, perm_type='user', role='writer')
+    with _cache_lock:
+        _cache["sheets"][sheet_name] = sht
     return sht
 
 
@@ -29,26 +162,117 @@ def get_worksheet(sheet, worksheet_name):
     Gets worksheet_name from sheet.
     Creates that worksheet if it does not exist and configure it
     """
+    cache_key = (sheet.id, worksheet_name)
+    wksht = _cache["worksheets"].get(cache_key)
+    if wksht is not None:
+        return wksht
     try:
-        wksht = sheet.worksheet(worksheet_name)
+        wksht = sheets_call(sheet.worksheet, worksheet_name)
     except gspread.exceptions.WorksheetNotFound:
-        wksht = sheet.add_worksheet(worksheet_name, 1000, 80)
-        months = [calendar.month_name[i].upper() for i in range(1,13)]
-        for i,v in enumerate(months):
-            month_cell_column = (i*5) + 1
-            update_cell(wksht, 1, month_cell_column, v)
-
-            # Add month columns headers
-            update_values(wksht, 2, month_cell_column, ["ID", "DATE", "TYPE", "DESCRIPTION", "AMOUNT"])
+        wksht = sheets_call(sheet.add_worksheet, worksheet_name, 1000, 80)
+        write_worksheet_headers(sheet, wksht)
+    else:
+        # The worksheet may have been created by a call whose headers write failed: they are written now
+        month_columns = read_month_columns(wksht)
+        if not month_columns:
+            logger.warning(f"GDRIVE: Worksheet {worksheet_name} without headers. Writing them")
+            write_worksheet_headers(sheet, wksht)
+        elif len(month_columns) == len(DEFAULT_MONTH_COLUMNS):
+            # Already read: no need to read it again on the first insert
+            with _cache_lock:
+                _cache["month_columns"][(wksht.spreadsheet_id, wksht.id)] = month_columns
 
-    # We have a quota of 60 req/min, so we need to batch the write requests.
-    # time.sleep(61)
+    with _cache_lock:
+        _cache["worksheets"][cache_key] = wksht
     return wksht
 
 
+def write_worksheet_headers(sheet, wksht):
+    """
+    Write the month titles and the columns headers of a year worksheet, and cache its layout
+    """
+    # Month titles, columns headers and their format in one single request
+    sheets_call(sheet.batch_update, {"requests": [get_worksheet_headers_request(wksht.id)]})
+
+    # The layout is already known, no need to read it
+    with _cache_lock:
+        _cache["month_columns"][(wksht.spreadsheet_id, wksht.id)] = dict(DEFAULT_MONTH_COLUMNS)
+
+
+def get_worksheet_headers_request(worksheet_id):
+    """
+    Build the Sheets API request that writes the month titles (row 1) and the
+    columns headers (row 2) of a year worksheet, in bold
+
+    :param int worksheet_id: ID of the worksheet (sheetId)
+    :return: dict with an updateCells request
+    """
+    def bold_cell(value):
+        return {"userEnteredValue": {"stringValue": value},
+                "userEnteredFormat": {"textFormat": {"bold": True}}}
+
+    titles_row = []
+    headers_row = []
+    for i in range(1, 13):
+        titles_row += [bold_cell(calendar.month_name[i].upper())] + [{}] * (len(SHEET_HEADERS) - 1)
+        headers_row += [bold_cell(x) for x in SHEET_HEADERS]
+    return {"updateCells": {
+        "range": {"sheetId": worksheet_id, "startRowIndex": 0, "endRowIndex": 2,
+                  "startColumnIndex": 0, "endColumnIndex": len(headers_row)},
+        "rows": [{"values": titles_row}, {"values": headers_row}],
+        "fields": "userEnteredValue,userEnteredFormat.textFormat.bold"}}
+
+
+@timed(SHEETS_SECONDS, operation="prepare_worksheet")
+def prepare_worksheet(gdrive_info, worksheet_name):
+    """
+    Create (if needed) a year worksheet in advance, so no user request pays the bootstrap cost
+
+    :param dict gdrive_info: gdrive section of the config
+    :param str worksheet_name: Worksheet name (the year)
+    """
+    sht = get_sheet(gdrive_info.get("sheet_name"), gdrive_info.get("share_mails"), gdrive_info.get("credentials_file"))
+    get_worksheet(sht, worksheet_name)
+
+
+def read_month_columns(wksht):
+    """
+    Read the ID column (the first column) of every month of the worksheet from its headers row.
+    e.g.: {1: 1, 2: 6, ..., 12: 56}. Empty if the worksheet has no headers
+
+    :return: Dict month number -> column number
+    """
+    id_columns = [i+1 for i,v in enumerate(sheets_call(wksht.row_values, 2)) if v == "ID"]
+    return {i+1: v for i,v in enumerate(id_columns)}
+
+
+def get_month_columns(wksht):
+    """
+    Get the ID column (the first column) of every month of the worksheet.
+    Only a complete layout (12 months) is cached: an incomplete one (e.g.: headers not written yet, or edited by hand)
+    is read again next time, and the default layout is used meanwhile
+
+    :return: Dict month number -> column number
+    """
+    cache_key = (wksht.spreadsheet_id, wksht.id)
+    month_columns = _cache["month_columns"].get(cache_key)
+    if month_columns is None:
+        month_columns = read_month_columns(wksht)
+        if len(month_columns) == len(DEFAULT_MONTH_COLUMNS):
+            with _cache_lock:
+                _cache["month_columns"][cache_key] = month_columns
+        else:
+            logger.warning(f"GDRIVE: Worksheet {wksht.title} with {len(month_columns)} month headers. "
+                           f"Using the default layout")
+            month_columns = dict(DEFAULT_MONTH_COLUMNS)
+    return month_columns
+
+
+@timed(SHEETS_SECONDS, operation="insert")
 def insert_in_sheet(expense, gdrive_info):
     """
-    Insert expense in worksheet
+    Insert expense in worksheet.
+    Returns the cell where the expense was written: (worksheet, row, ID column)
     Example of expense:
     {
         "id": 5,
@@ -58,98 +282,137 @@ def insert_in_sheet(expense, gdrive_info):
         "expense_amount": 123.45
     }
     """
-    
-    # Get sheet
-    sht = get_sheet(gdrive_info.get("sheet_name"), gdrive_info.get("share_mails"))
-    # Get the year from date, and then open the correspondant worksheet
-    year = expense.get('date')[:4]
-    wksht = get_worksheet(sht, year)
-    
-    # Get the month from date, in order to write in the appropiate columns
-    month = expense.get('date')[4:6]
-    month_date_column =  ((int(month) -1) * 5) + 1
-    
-    # Get the elements of the DATE column of the month in order to get the first empty row
-    next_empty_row = len(wksht.col_values(month_date_column)) + 1
+    return insert_many_in_sheet([expense], gdrive_info).get(expense.get("id"))
 
-    # Fill the empty row with the info:
-    update_values(wksht, next_empty_row, month_date_column, [expense.get("id", None),
-                                                                int(expense.get("date", 0)),
-                                                                expense.get("expense_type", None),
-                                                                expense.get("expense_description", None),
-                                                                expense.get("expense_amount", None)])
 
+@invalidate_cache_on_error
+@timed(SHEETS_SECONDS, operation="insert_many")
+def insert_many_in_sheet(expenses, gdrive_info, on_written=None):
+    """
+    Insert several expenses in their worksheets.
+    Only one read (first empty rows) and one write (batch_update) per worksheet (year)
 
-def delete_from_sheet(expenses_list, gdrive_info, year=None):
+    :param list expenses: List of expense dicts (see insert_in_sheet)
+    :param dict gdrive_info: gdrive section of the config
+    :param on_written: func(sheet_cells) called after every worksheet is written, with its cells. If a later
+                       worksheet fails, the expenses already written are known (e.g.: so they are not written twice)
+    :return: Dict expense ID -> (worksheet, row, ID column) where each expense was written
     """
-    Delete an expense given its ID
+    # Group the expenses by year (worksheet) and month (columns)
+    expenses_by_year = {}
+    for expense in expenses:
+        expense_date = str(expense.get('date'))
+        year_expenses = expenses_by_year.setdefault(expense_date[:4], {})
+        year_expenses.setdefault(expense_date[4:6], []).append(expense)
+
+    # Get sheet
+    sht = get_sheet(gdrive_info.get("sheet_name"), gdrive_info.get("share_mails"), gdrive_info.get("credentials_file"))
+    sheet_cells = {}
+    for year, expenses_by_month in expenses_by_year.items():
+        year_cells = {}
+        # The worksheet name is the year
+        wksht = get_worksheet(sht, year)
+
+        # Get the elements of the first column of every month in order to get the first empty rows
+        month_columns = get_month_columns(wksht)
+        month_date_columns = {month: month_columns[int(month)] for month in expenses_by_month}
+        columns_values = sheets_call(wksht.batch_get, [f"{xl_col_to_name(x-1)}:{xl_col_to_name(x-1)}"
+                                          for x in month_date_columns.values()])
+
+        # Fill the empty rows with the info
+        data = []
+        for (month, month_date_column), column_values in zip(month_date_columns.items(), columns_values):
+            # Never above the month title and the headers (rows 1 and 2), even if they were removed by hand
+            next_empty_row = max(len(column_values), 2) + 1
+            rows = [[expense.get("id", None),
+                     int(expense.get("date", 0)),
+                     expense.get("expense_type", None),
+                     expense.get("expense_description", None),
+                     expense.get("expense_amount", None)] for expense in expenses_by_month[month]]
+            a1_range = (f"{xl_col_to_name(month_date_column-1)}{next_empty_row}:"
+                        f"{xl_col_to_name(month_date_column+3)}{next_empty_row+len(rows)-1}")
+            data.append({"range": a1_range, "values": rows})
+            for i, expense in enumerate(expenses_by_month[month]):
+                year_cells[expense.get("id")] = (year, next_empty_row + i, month_date_column)
+        sheets_call(wksht.batch_update, data)
+        sheet_cells.update(year_cells)
+        if on_written is not None:
+            on_written(year_cells)
+    return sheet_cells
+
+
+@invalidate_cache_on_error
+@timed(SHEETS_SECONDS, operation="delete")
+def delete_from_sheet(expenses_list, gdrive_info, year=None, sheet_cells=None, expense_dates=None):
     """
+    Delete expenses given their IDs.
+    The expenses found in sheet_cells (written by insert_in_sheet) are cleared directly, in one
+    call per worksheet, after checking that the cells still contain those IDs.
+    The rest (not indexed or stale index) are searched in the worksheet of their year.
 
-    # Get sheet and worksheet
-    sht = get_sheet(gdrive_info.get("sheet_name"), gdrive_info.get("users_name"))
-    # The worksheet name is the year
-    if year is None:  year=date.today().strftime("%Y")
-    wksht = get_worksheet(sht, year)
+    :param list expenses_list: IDs of the expenses to delete
+    :param dict gdrive_info: gdrive section of the config
+    :param str year: Worksheet where the not indexed expenses without date are searched (default: current year)
+    :param dict sheet_cells: Dict expense ID -> (worksheet, row, ID column)
+    :param dict expense_dates: Dict expense ID -> date (yyyymmdd) of the expense
+    """
+    sheet_cells = sheet_cells or {}
+    expense_dates = expense_dates or {}
 
-    # Get the ID columns
-    id_columns = []
-    for i,v in enumerate( wksht.row_values(2)):
-        if v == "ID": id_columns.append(i+1)
+    # Get sheet
+    sht = get_sheet(gdrive_info.get("sheet_name"), gdrive_info.get("share_mails"), gdrive_info.get("credentials_file"))
 
+    # Group the indexed expenses by worksheet
+    not_indexed = []
+    cells_by_worksheet = {}
     for expense_id in expenses_list:
-        # Search the ID in the ID rows
-        value_found = False
-        value = []
-        for id_column in id_columns[::-1]:
-            for i,v in enumerate( wksht.col_values(id_column)):
-                # print(f"COUNT: {count}  -  ID COLUMN: {id_column}  -  VALUE: {v}")
-                # count += 1
-                if v == str(expense_id):
-                    value_found = True
-                    value = [id_column-1, i+1]
-                    break
-            if value_found: 
-                # Clear the cells
-                a1_range_orig = f"{xl_col_to_name(value[0])}{value[1]}"
-                a1_range_dest = f"{xl_col_to_name(value[0]+4)}{value[1]}"
-                wksht.update(range_name=f'{a1_range_orig}:{a1_range_dest}', values=[['', '', '', '', '']])
-                break
-    
-
-def update_cell(wksht, row, column, value=None):
-    """
-    Update a cell trying to not get the quota 429 error (60 req/min by default)
-    """
-    try:
-        wksht.update_cell(row, column, value)
-        time.sleep(2)
-    except Exception:
-        print("GDRIVE: Quota error detected. Sleeping a few seconds")
-        time.sleep(10)
-        wksht.update_cell(row, column, value)
+        if expense_id in sheet_cells:
+            worksheet_name, row, column = sheet_cells[expense_id]
+            cells_by_worksheet.setdefault(worksheet_name, []).append((expense_id, row, column))
+        else:
+            not_indexed.append(expense_id)
 
+    for worksheet_name, cells in cells_by_worksheet.items():
+        wksht = get_worksheet(sht, worksheet_name)
+        # Check that the index is not stale (e.g.: rows moved by hand)
+        id_values = sheets_call(wksht.batch_get, [f"{xl_col_to_name(column-1)}{row}" for _, row, column in cells])
+        ranges_to_clear = []
+        for (expense_id, row, column), value in zip(cells, id_values):
+            if len(value) > 0 and len(value[0]) > 0 and value[0][0] == str(expense_id):
+                ranges_to_clear.append(f"{xl_col_to_name(column-1)}{row}:{xl_col_to_name(column+3)}{row}")
+            else:
+                logger.warning(f"GDRIVE: Stale index for expense {expense_id}")
+                not_indexed.append(expense_id)
+        if ranges_to_clear:
+            sheets_call(wksht.batch_clear, ranges_to_clear)
 
-def update_values(wksht, row, column, new_values=[]):
+    # The worksheet name is the year
+    if year is None:  year=date.today().strftime("%Y")
+    not_indexed_by_year = {}
+    for expense_id in not_indexed:
+        expense_year = str(expense_dates[expense_id])[:4] if expense_id in expense_dates else year
+        not_indexed_by_year.setdefault(expense_year, []).append(expense_id)
+    for worksheet_name, expense_ids in not_indexed_by_year.items():
+        _scan_and_delete(get_worksheet(sht, worksheet_name), expense_ids)
+
+
+def _scan_and_delete(wksht, expenses_list):
     """
-    Update a cell trying to not get the quota 429 error (60 req/min by default)
+    Search the expenses in the ID columns of the worksheet (one read for all the columns) and clear them
     """
-    # Convert to A1 notation
-    a1_column_1 = xl_col_to_name(column-1)
-    a1_column_2 = xl_col_to_name(column+3)
-    a1_range = f"{a1_column_1}{row}:{a1_column_2}{row}"
-    try:
-        wksht.update(range_name=a1_range, values=[new_values])
-        # Sleep in order to avoid quota issues
-        time.sleep(1.5)
-    except Exception:
-        print("GDRIVE: Quota error detected. Sleeping a few seconds")
-        time.sleep(10)
-        wksht.update(range_name=a1_range, values=[new_values])
-
+    # Get the ID columns (from December to January: the latest expenses are the usual ones to delete)
+    id_columns = list(get_month_columns(wksht).values())[::-1]
+    columns_values = sheets_call(wksht.batch_get, [f"{xl_col_to_name(x-1)}:{xl_col_to_name(x-1)}" for x in id_columns])
 
-# Connect to Google Sheets
-scope = ['https://www.googleapis.com/auth/spreadsheets',
-         "https://www.googleapis.com/auth/drive"]
+    ids_to_delete = {str(x) for x in expenses_list}
+    ranges_to_clear = []
+    for id_column, column_values in zip(id_columns, columns_values):
+        for i,v in enumerate(column_values):
+            if len(v) > 0 and v[0] in ids_to_delete:
+                ids_to_delete.remove(v[0])
+                ranges_to_clear.append(f"{xl_col_to_name(id_column-1)}{i+1}:{xl_col_to_name(id_column+3)}{i+1}")
+    if ids_to_delete:
+        logger.warning(f"GDRIVE: Expenses {', '.join(ids_to_delete)} not found in worksheet {wksht.title}")
+    if ranges_to_clear:
+        sheets_call(wksht.batch_clear, ranges_to_clear)
 
-credentials = ServiceAccountCredentials.from_json_keyfile_name("conf/gdrive_credentials.json", scope)
-client = gspread.authorize(credentials)
@@ -1,7 +1,96 @@
 import sqlite3
 import os
+import collections
+import json
+import time
+import threading
 from pathlib import Path
 import logging
+from utils.metrics import Histogram, timed
+
+
+logger = logging.getLogger(__name__)
+DB_SECONDS = Histogram("household_expenses_db_seconds", "Time of the DB operations", ["operation"])
+
+
+# Pragmas applied to every pooled connection:
+# - WAL lets the readers (reports) work while a writer commits
+# - synchronous=NORMAL is durable enough with WAL and avoids an fsync per commit
+# - cache_size is in KiB when negative (~16MB), mmap_size in bytes (~64MB)
+CONNECTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 67108864,
+    "temp_store": "MEMORY",
+}
+
+# Compact record of an expense row (a tuple: no dict per row)
+ExpenseRow = collections.namedtuple("ExpenseRow", ["id", "date", "user", "expense_type",
+                                                   "expense_description", "expense_amount"])
+
+# One connection per (thread, db file). The registry keeps track of all of them
+# so they can be closed from the main thread on shutdown.
+_local = threading.local()
+_connections = {}
+_connections_lock = threading.Lock()
+# Connections inherited by a forked child: SQLite connections must not be used (nor closed) across fork()
+_forked_connections = []
+
+
+def _forget_connections_in_child():
+    """
+    Run in the child after a fork: it opens its own connections, and keeps the inherited ones unused
+    """
+    global _local, _connections, _connections_lock
+    _forked_connections.extend(_connections.values())
+    _local = threading.local()
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_connections_in_child)
+
+
+def get_connection(db_name='household_expenses.db'):
+    """
+    Get the long-lived connection of the current thread for the given database.
+    The connection is created (and configured) the first time it is requested.
+
+    :param str db_name: path of the database file
+    :return: sqlite3.Connection
+    """
+    thread_connections = getattr(_local, "connections", None)
+    if thread_connections is None:
+        thread_connections = _local.connections = {}
+    conn = thread_connections.get(db_name)
+    if conn is None:
+        conn = sqlite3.connect(db_name, check_same_thread=False)
+        for pragma, value in CONNECTION_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        thread_connections[db_name] = conn
+        with _connections_lock:
+            _connections[(threading.get_ident(), db_name)] = conn
+        logger.info(f"Opened pooled connection to {db_name} (thread {threading.get_ident()})")
+    return conn
+
+
+def close_connections():
+    """
+    Close every pooled connection. Meant to be called once, on shutdown.
+    """
+    with _connections_lock:
+        connections = list(_connections.items())
+        _connections.clear()
+    for (thread_id, db_name), conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Error closing connection to {db_name} (thread {thread_id}): {e}")
+    # Connections of the current thread are gone, forget them
+    _local.connections = {}
+    logger.info(f"Closed {len(connections)} pooled connections")
 
 
 def create_db_if_not_exist(db_name='household_expenses.db'):
@@ -19,7 +108,7 @@ def create_db_if_not_exist(db_name='household_expenses.db'):
             if not Path(db_path_directory).is_dir():
                 Path(db_path_directory).mkdir(parents=True, exist_ok=True)
         conn = sqlite3.connect(db_name)
-        logging.info("Opened database successfully")
+        logger.info("Opened database successfully")
         conn.close()
 
 
@@ -29,7 +118,7 @@ def create_table_if_not_exists(db_name='household_expenses.db'):
 
     :param str db_name: path of the database file
     """
-    conn = sqlite3.connect(db_name)
+    conn = get_connection(db_name)
     conn.execute('''CREATE TABLE IF NOT EXISTS EXPENSES
             (ID INTEGER PRIMARY KEY AUTOINCREMENT,
             DATE   INT    NOT NULL,
@@ -37,89 +126,560 @@ def create_table_if_not_exists(db_name='household_expenses.db'):
             EXPENSE_TYPE   TEXT    NOT NULL,
             EXPENSE_DESCRIPTION    TEXT    NOT NULL,
             EXPENSE_AMOUNT REAL    NOT NULL);''')
-    logging.info("Table created (OR NOT) successfully")
-    conn.close()
+    # Indexes used by the scoped reports (date range, expense type, user)
+    conn.execute("CREATE INDEX IF NOT EXISTS EXPENSES_DATE_IDX ON EXPENSES (DATE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS EXPENSES_EXPENSE_TYPE_IDX ON EXPENSES (EXPENSE_TYPE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS EXPENSES_USER_IDX ON EXPENSES (USER)")
+    conn.commit()
+    logger.info("Table created (OR NOT) successfully")
 
 
-def insert_in_db(expense_info, db_name='household_expenses.db'):
+INSERT_EXPENSE_QUERY = """
+    INSERT INTO EXPENSES (DATE, USER, EXPENSE_TYPE, EXPENSE_DESCRIPTION, EXPENSE_AMOUNT)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# IDs per DELETE ... WHERE ID IN (...): below the limit of host parameters of old SQLite versions (999)
+DELETE_BATCH_SIZE = 500
+
+# Operations of the Google Sheets queue (SHEETS_QUEUE table)
+INSERT_OPERATION = "insert"
+DELETE_OPERATION = "delete"
+
+
+def get_expense_parameters(expense_info):
+    """
+    :param dict expense_info: Dictionary with the expense info
+    :return: Tuple with the parameters of INSERT_EXPENSE_QUERY
+    """
+    return (expense_info["date"], expense_info["user"], expense_info["expense_type"],
+            expense_info["expense_description"], expense_info["expense_amount"])
+
+
+@timed(DB_SECONDS, operation="insert")
+def insert_in_db(expense_info, db_name='household_expenses.db', queue_sheet_operation=False):
     """
     Insert in table expenses
 
     :param dict expense_info: Dictionary with the expense info
     :param str db_name: path of the database file
+    :param bool queue_sheet_operation: Also queue its insert in Google Sheets, in the same transaction
     :return: Row ID of the new row, or -1 if something went wrong
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    logging.info("INSERT: Opened database successfully")
-    query = f"""
-        INSERT INTO EXPENSES (DATE,USER,EXPENSE_TYPE,EXPENSE_DESCRIPTION,EXPENSE_AMOUNT) 
-        VALUES ({expense_info["date"]}, '{expense_info["user"]}', '{expense_info["expense_type"]}', '{expense_info["expense_description"]}', {expense_info["expense_amount"]} )
-    """
-    logging.info(f"INSERT: Query: {query}")
-    cursor.execute(query)
-    conn.commit()
+    conn = get_connection(db_name)
+    parameters = get_expense_parameters(expense_info)
+    logger.debug("INSERT: Query: %s %s", INSERT_EXPENSE_QUERY, parameters)
+    with conn:
+        cursor = conn.execute(INSERT_EXPENSE_QUERY, parameters)
+        if queue_sheet_operation and cursor.rowcount > 0:
+            queue_operation(conn, INSERT_OPERATION, dict(expense_info, id=cursor.lastrowid))
     cursor.close()
-    conn.close()
     
     # Verify Insertion
     if cursor.rowcount <= 0:
-        logging.warn(f"INSERT: ERROR. rowcount: {cursor.rowcount}")
+        logger.warning(f"INSERT: ERROR. rowcount: {cursor.rowcount}")
         return -1
-    logging.info(f"INSERT: Successfully. ROW ID: {cursor.lastrowid}")
+    logger.info(f"INSERT: Successfully. ROW ID: {cursor.lastrowid}")
     return cursor.lastrowid
 
 
+@timed(DB_SECONDS, operation="insert_many")
+def insert_many(expenses, db_name='household_expenses.db', batch_size=500):
+    """
+    Insert several expenses in the table EXPENSES, with one commit per batch
 
-def delete_from_db(expenses_list, db_name='household_expenses.db'):
+    :param expenses: Iterable of dictionaries with the expense info
+    :param str db_name: path of the database file
+    :param int batch_size: Number of expenses inserted per transaction
+    :return: List with the Row IDs of the new rows, in the same order as the expenses
+    """
+    conn = get_connection(db_name)
+    expense_ids = []
+    batch = []
+    for expense_info in expenses:
+        batch.append(get_expense_parameters(expense_info))
+        if len(batch) >= batch_size:
+            expense_ids += insert_batch(conn, batch)
+            batch = []
+    if batch:
+        expense_ids += insert_batch(conn, batch)
+    return expense_ids
+
+
+def insert_batch(conn, batch):
+    """
+    Insert a batch of expenses in one transaction
+
+    :param conn: SQLite connection
+    :param list batch: List of tuples with the parameters of INSERT_EXPENSE_QUERY
+    :return: List with the Row IDs of the new rows
     """
-    Delete one or more rows from the table EXPENSES
+    with conn:
+        conn.executemany(INSERT_EXPENSE_QUERY, batch)
+        # executemany does not return the IDs. With AUTOINCREMENT and the write lock held by the
+        # transaction, the new IDs are consecutive and the last one is in sqlite_sequence
+        last_id = conn.execute("SELECT SEQ FROM SQLITE_SEQUENCE WHERE NAME = 'EXPENSES'").fetchone()[0]
+    logger.info(f"INSERT: {len(batch)} expenses inserted. Last ROW ID: {last_id}")
+    return list(range(last_id - len(batch) + 1, last_id + 1))
+
+
+@timed(DB_SECONDS, operation="delete")
+def delete_from_db(expenses_list, db_name='household_expenses.db', queue_sheet_operation=False):
+    """
+    Delete one or more rows from the table EXPENSES, in one single transaction
 
     :param list expenses_list: List with the IDs of the rows to delete
     :param str db_name: path of the database file
+    :param bool queue_sheet_operation: Also queue the delete of the deleted rows in Google Sheets,
+                                       with their dates (their worksheets), in the same transaction
     :return: List with the IDs that have not been deleted
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    wrong_deletions = []
-    for expense in expenses_list:
-        query = f"DELETE FROM EXPENSES WHERE ID={expense}"
-        cursor.execute(query)
+    conn = get_connection(db_name)
+    expense_ids = [int(x) for x in expenses_list]
+    # Deleted expense ID -> date
+    deleted = {}
+    # IMMEDIATE: nobody can write between the SELECT of the existing IDs and the DELETE
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for i in range(0, len(expense_ids), DELETE_BATCH_SIZE):
+            batch = expense_ids[i:i + DELETE_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            deleted.update(conn.execute(f"SELECT ID, DATE FROM EXPENSES WHERE ID IN ({placeholders})", batch))
+            conn.execute(f"DELETE FROM EXPENSES WHERE ID IN ({placeholders})", batch)
+        if queue_sheet_operation and deleted:
+            queue_operation(conn, DELETE_OPERATION, [{"id": k, "date": v} for k, v in deleted.items()])
         conn.commit()
-        if cursor.rowcount <= 0:
-            wrong_deletions.append(expense)
-            logging.warn(f"DELETE: Expense {expense} not deleted")
-        else:
-            logging.info(f"DELETE: Expense {expense} deleted")
-    cursor.close()
-    conn.close()
-    return wrong_deletions
+    except BaseException:
+        conn.rollback()
+        raise
 
+    wrong_deletions = [x for x, expense_id in zip(expenses_list, expense_ids) if expense_id not in deleted]
+    if deleted:
+        logger.info(f"DELETE: Expenses {sorted(deleted)} deleted")
+    if wrong_deletions:
+        logger.warning(f"DELETE: Expenses {wrong_deletions} not deleted")
+    return wrong_deletions
 
 
-def get_table_content(db_name='household_expenses.db', limit=20):
+@timed(DB_SECONDS, operation="get")
+def get_table_content(db_name='household_expenses.db', limit=20, date_from=None, date_to=None,
+                      expense_types=None, user=None):
     """
-    Get the last <limit> rows of the table EXPENSES
+    Get the last <limit> rows of the table EXPENSES, optionally filtered
 
     :param str db_name: path of the database file
-    :param int limit: Number of rows to retrieve
+    :param int limit: Number of rows to retrieve (0: all)
+    :param int date_from: First date (yyyymmdd) included
+    :param int date_to: Last date (yyyymmdd) included
+    :param list expense_types: Expense types included
+    :param str user: Only the expenses of this user
     :return: Dict of dicts with the info of those rows
     """
-    conn = sqlite3.connect(db_name)
-    query = f"SELECT * FROM EXPENSES ORDER BY ID DESC"
-    if limit > 0:
-        query += f" LIMIT {limit}"
-    logging.info(f"GET: Query: {query}")
-    cursor = conn.execute(query)
     json_content = {}
-    for row in cursor:
-        json_content[row[0]] = {
-            "date": row[1],
-            "user": row[2],
-            "expense_type": row[3],
-            "expense_description": row[4],
-            "expense_amount": row[5]
+    for row in iter_table_content(db_name, limit, date_from, date_to, expense_types, user):
+        json_content[row.id] = {
+            "date": row.date,
+            "user": row.user,
+            "expense_type": row.expense_type,
+            "expense_description": row.expense_description,
+            "expense_amount": row.expense_amount
         }
-        logging.info(f"GET: {row[0]}  {row[1]}  {row[2]}  {row[3]}  {row[4]}  {row[5]}")
-    conn.close()
     return json_content
+
+
+def iter_table_content(db_name='household_expenses.db', limit=0, date_from=None, date_to=None,
+                       expense_types=None, user=None, batch_size=1000):
+    """
+    Stream the last <limit> rows of the table EXPENSES, optionally filtered (see get_table_content).
+    The rows are fetched in batches, so the memory used does not depend on the size of the table
+
+    :param int batch_size: Number of rows fetched from SQLite at once
+    :return: Iterator of ExpenseRow
+    """
+    conn = get_connection(db_name)
+    query, parameters = build_expenses_query(limit, date_from, date_to, expense_types, user)
+    cursor = conn.execute(query, parameters)
+    rows_count = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            rows_count += len(rows)
+            for row in rows:
+                yield ExpenseRow._make(row)
+    finally:
+        cursor.close()
+        logger.info(f"GET: {rows_count} rows")
+        logger.debug("GET: Query: %s %s", query, parameters)
+
+
+def build_expenses_query(limit=0, date_from=None, date_to=None, expense_types=None, user=None):
+    """
+    Build the parameterized SELECT of the table EXPENSES (see get_table_content)
+
+    :return: Tuple (query, parameters)
+    """
+    conditions = []
+    parameters = []
+    if date_from is not None and date_to is not None:
+        conditions.append("DATE BETWEEN ? AND ?")
+        parameters += [int(date_from), int(date_to)]
+    elif date_from is not None:
+        conditions.append("DATE >= ?")
+        parameters.append(int(date_from))
+    elif date_to is not None:
+        conditions.append("DATE <= ?")
+        parameters.append(int(date_to))
+    if expense_types:
+        conditions.append(f"EXPENSE_TYPE IN ({', '.join('?' * len(expense_types))})")
+        parameters += list(expense_types)
+    if user is not None:
+        conditions.append("USER = ?")
+        parameters.append(user)
+
+    query = "SELECT ID, DATE, USER, EXPENSE_TYPE, EXPENSE_DESCRIPTION, EXPENSE_AMOUNT FROM EXPENSES"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY ID DESC"
+    if limit > 0:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    return query, parameters
+
+
+def create_sheets_queue_table_if_not_exists(db_name='household_expenses.db'):
+    """
+    Create the table used as a durable queue of the pending Google Sheets operations
+
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.execute('''CREATE TABLE IF NOT EXISTS SHEETS_QUEUE
+            (ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            OPERATION   TEXT    NOT NULL,
+            PAYLOAD   TEXT    NOT NULL,
+            ATTEMPTS   INT    NOT NULL DEFAULT 0,
+            NEXT_ATTEMPT   REAL    NOT NULL DEFAULT 0);''')
+    # Dead letters: operations given up (see fail_sheet_operations), kept to be reviewed by hand
+    conn.execute('''CREATE TABLE IF NOT EXISTS SHEETS_FAILED
+            (ID INTEGER PRIMARY KEY,
+            OPERATION   TEXT    NOT NULL,
+            PAYLOAD   TEXT    NOT NULL,
+            ATTEMPTS   INT    NOT NULL,
+            ERROR   TEXT    NOT NULL,
+            FAILED_AT   REAL    NOT NULL);''')
+    conn.commit()
+    logger.info("Sheets queue table created (OR NOT) successfully")
+
+
+@timed(DB_SECONDS, operation="enqueue")
+def enqueue_sheet_operation(operation, payload, db_name='household_expenses.db'):
+    """
+    Add an operation to the Google Sheets queue
+
+    :param str operation: "insert" (payload: expense dict) or "delete" (payload: list of {"id", "date"} of the expenses)
+    :param payload: JSON serializable payload of the operation
+    :param str db_name: path of the database file
+    :return: ID of the queued operation
+    """
+    conn = get_connection(db_name)
+    with conn:
+        operation_id = queue_operation(conn, operation, payload)
+    return operation_id
+
+
+def queue_operation(conn, operation, payload):
+    """
+    Add an operation to the Google Sheets queue, in the current transaction of conn (it is not committed):
+    the operation is queued only if the change of the expenses is committed
+
+    :param conn: SQLite connection
+    :param str operation: See enqueue_sheet_operation
+    :param payload: JSON serializable payload of the operation
+    :return: ID of the queued operation
+    """
+    cursor = conn.execute("INSERT INTO SHEETS_QUEUE (OPERATION, PAYLOAD) VALUES (?, ?)",
+                          (operation, json.dumps(payload)))
+    logger.debug("QUEUE: Operation %s queued with ID %s", operation, cursor.lastrowid)
+    return cursor.lastrowid
+
+
+@timed(DB_SECONDS, operation="enqueue_many")
+def enqueue_sheet_operations(operation, payloads, db_name='household_expenses.db'):
+    """
+    Add several operations to the Google Sheets queue, in one transaction (e.g.: bulk imports)
+
+    :param str operation: See enqueue_sheet_operation
+    :param list payloads: List of JSON serializable payloads, one per operation
+    :param str db_name: path of the database file
+    :return: Number of queued operations
+    """
+    conn = get_connection(db_name)
+    with conn:
+        conn.executemany("INSERT INTO SHEETS_QUEUE (OPERATION, PAYLOAD) VALUES (?, ?)",
+                         ((operation, json.dumps(payload)) for payload in payloads))
+    logger.info(f"QUEUE: {len(payloads)} operations {operation} queued")
+    return len(payloads)
+
+
+def get_pending_sheet_operations(db_name='household_expenses.db', limit=100, now=None):
+    """
+    Get the oldest queued operations that are ready to be (re)tried.
+    The operations are handled in order: the ones queued after a postponed operation wait for it
+    (e.g.: the delete of an expense whose insert failed)
+
+    :param str db_name: path of the database file
+    :param int limit: Max number of operations to retrieve
+    :param float now: Timestamp used to filter the postponed operations (default: current time)
+    :return: List of dicts with the keys id, operation, payload and attempts
+    """
+    if now is None:
+        now = time.time()
+    conn = get_connection(db_name)
+    cursor = conn.execute("""SELECT ID, OPERATION, PAYLOAD, ATTEMPTS FROM SHEETS_QUEUE
+                             WHERE ID < (SELECT COALESCE(MIN(ID), 9223372036854775807) FROM SHEETS_QUEUE
+                                         WHERE NEXT_ATTEMPT > ?)
+                             ORDER BY ID LIMIT ?""", (now, limit))
+    return [{"id": row[0], "operation": row[1], "payload": json.loads(row[2]), "attempts": row[3]}
+            for row in cursor]
+
+
+def remove_sheet_operations(operation_ids, db_name='household_expenses.db'):
+    """
+    Remove operations from the Google Sheets queue (once they are done)
+
+    :param list operation_ids: IDs of the queued operations
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.executemany("DELETE FROM SHEETS_QUEUE WHERE ID=?", [(x,) for x in operation_ids])
+    conn.commit()
+
+
+def postpone_sheet_operations(operation_ids, delay, db_name='household_expenses.db'):
+    """
+    Postpone failed operations of the Google Sheets queue
+
+    :param list operation_ids: IDs of the queued operations
+    :param float delay: Seconds to wait before the next attempt
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.executemany("UPDATE SHEETS_QUEUE SET ATTEMPTS=ATTEMPTS+1, NEXT_ATTEMPT=? WHERE ID=?",
+                     [(time.time() + delay, x) for x in operation_ids])
+    conn.commit()
+
+
+def fail_sheet_operations(operation_ids, error, db_name='household_expenses.db'):
+    """
+    Move operations that can not be done from the Google Sheets queue to the SHEETS_FAILED table,
+    so they no longer hold back the operations queued after them
+
+    :param list operation_ids: IDs of the queued operations
+    :param str error: Last error of the operations
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    with conn:
+        conn.executemany("""INSERT OR REPLACE INTO SHEETS_FAILED (ID, OPERATION, PAYLOAD, ATTEMPTS, ERROR, FAILED_AT)
+                            SELECT ID, OPERATION, PAYLOAD, ATTEMPTS+1, ?, ? FROM SHEETS_QUEUE WHERE ID=?""",
+                         [(error, time.time(), x) for x in operation_ids])
+        conn.executemany("DELETE FROM SHEETS_QUEUE WHERE ID=?", [(x,) for x in operation_ids])
+
+
+def get_failed_sheet_operations(db_name='household_expenses.db'):
+    """
+    Get the operations given up by the Google Sheets queue
+
+    :param str db_name: path of the database file
+    :return: List of dicts with the keys id, operation, payload, attempts and error
+    """
+    cursor = get_connection(db_name).execute("SELECT ID, OPERATION, PAYLOAD, ATTEMPTS, ERROR FROM SHEETS_FAILED ORDER BY ID")
+    return [{"id": row[0], "operation": row[1], "payload": json.loads(row[2]), "attempts": row[3], "error": row[4]}
+            for row in cursor]
+
+
+def count_sheet_operations(db_name='household_expenses.db'):
+    """
+    Get the number of operations waiting in the Google Sheets queue
+
+    :param str db_name: path of the database file
+    :return: Number of queued operations
+    """
+    return get_connection(db_name).execute("SELECT COUNT(*) FROM SHEETS_QUEUE").fetchone()[0]
+
+
+def create_sheet_cells_table_if_not_exists(db_name='household_expenses.db'):
+    """
+    Create the table with the Google Sheets cell where each expense was written
+
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.execute('''CREATE TABLE IF NOT EXISTS SHEET_CELLS
+            (EXPENSE_ID INTEGER PRIMARY KEY,
+            WORKSHEET   TEXT    NOT NULL,
+            ROW   INT    NOT NULL,
+            COL   INT    NOT NULL);''')
+    conn.commit()
+    logger.info("Sheet cells table created (OR NOT) successfully")
+
+
+def save_sheet_cells(sheet_cells, db_name='household_expenses.db'):
+    """
+    Save the Google Sheets cells where the expenses were written
+
+    :param dict sheet_cells: Dict expense ID -> (worksheet, row, ID column)
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.executemany("INSERT OR REPLACE INTO SHEET_CELLS (EXPENSE_ID, WORKSHEET, ROW, COL) VALUES (?, ?, ?, ?)",
+                     [(k, *v) for k, v in sheet_cells.items()])
+    conn.commit()
+
+
+def get_sheet_cells(expenses_list, db_name='household_expenses.db'):
+    """
+    Get the Google Sheets cells where the expenses were written
+
+    :param list expenses_list: List with the IDs of the expenses
+    :param str db_name: path of the database file
+    :return: Dict expense ID -> (worksheet, row, ID column). Only the expenses found
+    """
+    conn = get_connection(db_name)
+    placeholders = ", ".join("?" * len(expenses_list))
+    cursor = conn.execute(f"SELECT EXPENSE_ID, WORKSHEET, ROW, COL FROM SHEET_CELLS WHERE EXPENSE_ID IN ({placeholders})",
+                          list(expenses_list))
+    return {row[0]: tuple(row[1:]) for row in cursor}
+
+
+def remove_sheet_cells(expenses_list, db_name='household_expenses.db'):
+    """
+    Remove the Google Sheets cells of deleted expenses
+
+    :param list expenses_list: List with the IDs of the expenses
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.executemany("DELETE FROM SHEET_CELLS WHERE EXPENSE_ID=?", [(x,) for x in expenses_list])
+    conn.commit()
+
+
+def create_monthly_totals_table_if_not_exists(db_name='household_expenses.db'):
+    """
+    Create the MONTHLY_TOTALS table (total and number of expenses by month, type and user)
+    and the triggers that keep it consistent with the EXPENSES table.
+    If the table is new, it is filled with the existing expenses
+
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='MONTHLY_TOTALS'").fetchone() is None
+    # Table, triggers and initial fill in one transaction, so no expense is counted twice or missed
+    script = '''
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS MONTHLY_TOTALS
+            (MONTH   INT    NOT NULL,
+            EXPENSE_TYPE   TEXT    NOT NULL,
+            USER   TEXT    NOT NULL,
+            TOTAL_AMOUNT   REAL    NOT NULL,
+            EXPENSES_COUNT   INT    NOT NULL,
+            PRIMARY KEY (MONTH, EXPENSE_TYPE, USER)) WITHOUT ROWID;
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_INSERT_MONTHLY_TOTALS AFTER INSERT ON EXPENSES
+        BEGIN
+            INSERT INTO MONTHLY_TOTALS (MONTH, EXPENSE_TYPE, USER, TOTAL_AMOUNT, EXPENSES_COUNT)
+            VALUES (NEW.DATE / 100, NEW.EXPENSE_TYPE, NEW.USER, NEW.EXPENSE_AMOUNT, 1)
+            ON CONFLICT (MONTH, EXPENSE_TYPE, USER) DO UPDATE
+            SET TOTAL_AMOUNT = TOTAL_AMOUNT + excluded.TOTAL_AMOUNT, EXPENSES_COUNT = EXPENSES_COUNT + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_DELETE_MONTHLY_TOTALS AFTER DELETE ON EXPENSES
+        BEGIN
+            UPDATE MONTHLY_TOTALS
+            SET TOTAL_AMOUNT = TOTAL_AMOUNT - OLD.EXPENSE_AMOUNT, EXPENSES_COUNT = EXPENSES_COUNT - 1
+            WHERE MONTH = OLD.DATE / 100 AND EXPENSE_TYPE = OLD.EXPENSE_TYPE AND USER = OLD.USER;
+            DELETE FROM MONTHLY_TOTALS
+            WHERE MONTH = OLD.DATE / 100 AND EXPENSE_TYPE = OLD.EXPENSE_TYPE AND USER = OLD.USER AND EXPENSES_COUNT <= 0;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_UPDATE_MONTHLY_TOTALS
+        AFTER UPDATE OF DATE, USER, EXPENSE_TYPE, EXPENSE_AMOUNT ON EXPENSES
+        BEGIN
+            UPDATE MONTHLY_TOTALS
+            SET TOTAL_AMOUNT = TOTAL_AMOUNT - OLD.EXPENSE_AMOUNT, EXPENSES_COUNT = EXPENSES_COUNT - 1
+            WHERE MONTH = OLD.DATE / 100 AND EXPENSE_TYPE = OLD.EXPENSE_TYPE AND USER = OLD.USER;
+            DELETE FROM MONTHLY_TOTALS
+            WHERE MONTH = OLD.DATE / 100 AND EXPENSE_TYPE = OLD.EXPENSE_TYPE AND USER = OLD.USER AND EXPENSES_COUNT <= 0;
+            INSERT INTO MONTHLY_TOTALS (MONTH, EXPENSE_TYPE, USER, TOTAL_AMOUNT, EXPENSES_COUNT)
+            VALUES (NEW.DATE / 100, NEW.EXPENSE_TYPE, NEW.USER, NEW.EXPENSE_AMOUNT, 1)
+            ON CONFLICT (MONTH, EXPENSE_TYPE, USER) DO UPDATE
+            SET TOTAL_AMOUNT = TOTAL_AMOUNT + excluded.TOTAL_AMOUNT, EXPENSES_COUNT = EXPENSES_COUNT + 1;
+        END;'''
+    if is_new:
+        script += '''
+        INSERT INTO MONTHLY_TOTALS (MONTH, EXPENSE_TYPE, USER, TOTAL_AMOUNT, EXPENSES_COUNT)
+        SELECT DATE / 100, EXPENSE_TYPE, USER, SUM(EXPENSE_AMOUNT), COUNT(*)
+        FROM EXPENSES GROUP BY DATE / 100, EXPENSE_TYPE, USER;'''
+    conn.executescript(script + "\n        COMMIT;")
+    logger.info("Monthly totals table created (OR NOT) successfully")
+
+
+def create_expenses_version_table_if_not_exists(db_name='household_expenses.db'):
+    """
+    Create the EXPENSES_VERSION table (a counter of the changes of the EXPENSES table)
+    and the triggers that increase it on every insert, delete or update
+
+    :param str db_name: path of the database file
+    """
+    conn = get_connection(db_name)
+    conn.executescript('''
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS EXPENSES_VERSION
+            (ID   INTEGER PRIMARY KEY CHECK (ID = 1),
+            VERSION   INT    NOT NULL);
+        INSERT OR IGNORE INTO EXPENSES_VERSION (ID, VERSION) VALUES (1, 0);
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_INSERT_VERSION AFTER INSERT ON EXPENSES
+        BEGIN
+            UPDATE EXPENSES_VERSION SET VERSION = VERSION + 1 WHERE ID = 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_DELETE_VERSION AFTER DELETE ON EXPENSES
+        BEGIN
+            UPDATE EXPENSES_VERSION SET VERSION = VERSION + 1 WHERE ID = 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS EXPENSES_UPDATE_VERSION AFTER UPDATE ON EXPENSES
+        BEGIN
+            UPDATE EXPENSES_VERSION SET VERSION = VERSION + 1 WHERE ID = 1;
+        END;
+        COMMIT;''')
+    logger.info("Expenses version table created (OR NOT) successfully")
+
+
+def get_expenses_version(db_name='household_expenses.db'):
+    """
+    Get the change counter of the EXPENSES table: if it is the same, the expenses did not change
+
+    :param str db_name: path of the database file
+    :return int: Version
+    """
+    return get_connection(db_name).execute("SELECT VERSION FROM EXPENSES_VERSION WHERE ID = 1").fetchone()[0]
+
+
+@timed(DB_SECONDS, operation="monthly_totals")
+def get_monthly_totals(month, db_name='household_expenses.db'):
+    """
+    Get the totals of a month by expense type and user, from the MONTHLY_TOTALS table
+
+    :param int month: Month with the format yyyymm
+    :param str db_name: path of the database file
+    :return: List of dicts with the keys expense_type, user, total_amount and expenses_count
+    """
+    conn = get_connection(db_name)
+    cursor = conn.execute('''SELECT EXPENSE_TYPE, USER, TOTAL_AMOUNT, EXPENSES_COUNT FROM MONTHLY_TOTALS
+                             WHERE MONTH = ? ORDER BY EXPENSE_TYPE, USER''', (int(month),))
+    return [{"expense_type": row[0], "user": row[1], "total_amount": row[2], "expenses_count": row[3]}
+            for row in cursor]
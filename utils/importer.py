@@ -0,0 +1,263 @@
+import argparse
+import csv
+import logging
+import math
+import os
+import re
+import sys
+from datetime import date, datetime
+from utils.household_expenses_db import (create_db_if_not_exist, create_table_if_not_exists,
+                                         create_sheets_queue_table_if_not_exists, insert_many,
+                                         enqueue_sheet_operations, close_connections)
+from utils.sheets_sync import INSERT_OPERATION
+from utils.config import load_config
+
+
+"""
+Bulk import of expenses from CSV or XLSX files.
+The first row holds the column names: date, user, expense_type, expense_description, expense_amount
+(user and expense_description are optional). The files are streamed, so their size does not matter
+
+Run:
+    From the root: $ python -m utils.importer <file.csv|file.xlsx> [--user <user>] [--skip-invalid]
+
+"""
+logger = logging.getLogger(__name__)
+SUPPORTED_EXTENSIONS = (".csv", ".xlsx")
+REQUIRED_COLUMNS = ["date", "expense_type", "expense_amount"]
+# yyyymmdd, yyyy-mm-dd and dd/mm/yyyy. Matched with regexes: strptime is too slow for big files
+DATE_PATTERNS = [re.compile(r"^(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})$"),
+                 re.compile(r"^(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})$"),
+                 re.compile(r"^(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})$")]
+# Expenses inserted (and queued for Google Sheets) per transaction
+IMPORT_BATCH_SIZE = 5000
+# Wrong rows kept in the result, to be shown to the user
+MAX_REPORTED_ERRORS = 20
+
+
+def import_expenses(filename, db_name='household_expenses.db', default_user=None, sync_sheets=False,
+                    skip_invalid=False, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import the expenses of a CSV or XLSX file
+
+    :param str filename: CSV or XLSX file path
+    :param str db_name: path of the database file
+    :param str default_user: User of the rows without user
+    :param bool sync_sheets: Queue the imported expenses to be inserted in Google Sheets
+    :param bool skip_invalid: Import the valid rows even if there are wrong rows.
+                              If False, nothing is imported when any row is wrong
+    :param int batch_size: Expenses inserted per transaction
+    :return dict: e.g.: {'imported': 0, 'errors_count': 1, 'errors': [(3, 'Wrong date: 2024-13-01')]}
+                  The line numbers of the errors start at 1 (the header)
+    :raise ValueError: If the file type is not supported or its header is wrong
+    """
+    result = {'imported': 0, 'errors_count': 0, 'errors': []}
+    if not skip_invalid:
+        # First pass: only validation, so a wrong file is not half imported
+        for _ in iter_expenses(filename, default_user, result):
+            pass
+        if result['errors_count']:
+            logger.warning(f"IMPORT: {filename} not imported. {result['errors_count']} wrong rows")
+            return result
+
+    batch = []
+    for expense in iter_expenses(filename, default_user, result):
+        batch.append(expense)
+        if len(batch) >= batch_size:
+            result['imported'] += import_batch(batch, db_name, sync_sheets)
+            batch = []
+    if batch:
+        result['imported'] += import_batch(batch, db_name, sync_sheets)
+    logger.info(f"IMPORT: {result['imported']} expenses imported from {filename}. "
+                 f"{result['errors_count']} wrong rows skipped")
+    return result
+
+
+def import_batch(expenses, db_name, sync_sheets):
+    """
+    Insert a batch of expenses in one transaction, and queue them for Google Sheets
+
+    :return int: Number of imported expenses
+    """
+    expense_ids = insert_many(expenses, db_name, batch_size=len(expenses))
+    if sync_sheets:
+        enqueue_sheet_operations(INSERT_OPERATION, [dict(expense, id=expense_id)
+                                                    for expense, expense_id in zip(expenses, expense_ids)], db_name)
+    return len(expense_ids)
+
+
+def iter_expenses(filename, default_user=None, result=None):
+    """
+    Stream the valid expenses of a file. The wrong rows are counted in result
+
+    :param str filename: CSV or XLSX file path
+    :param str default_user: User of the rows without user
+    :param dict result: Dict with the keys errors_count and errors (see import_expenses)
+    :return: Iterator of expense dicts
+    """
+    result = result if result is not None else {'errors_count': 0, 'errors': []}
+    rows = iter_file_rows(filename)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("Empty file")
+    columns = get_columns(header)
+    for line, row in enumerate(rows, start=2):
+        # Blank lines
+        if all(x is None or str(x).strip() == "" for x in row):
+            continue
+        try:
+            yield parse_row(row, columns, default_user)
+        except ValueError as e:
+            result['errors_count'] += 1
+            if len(result['errors']) < MAX_REPORTED_ERRORS:
+                result['errors'].append((line, str(e)))
+
+
+def iter_file_rows(filename):
+    """
+    Stream the rows of a CSV or XLSX file
+
+    :param str filename: CSV or XLSX file path
+    :return: Iterator of lists of values. The first one is the header
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        with open(filename, newline="", encoding="utf-8-sig") as f:
+            # Comma, semicolon (spreadsheets of some locales) or tab separated
+            try:
+                dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            f.seek(0)
+            yield from csv.reader(f, dialect)
+    elif extension == ".xlsx":
+        # Only needed by the XLSX files
+        import openpyxl
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+    else:
+        raise ValueError(f"Unsupported file type: {extension}. Supported: {', '.join(SUPPORTED_EXTENSIONS)}")
+
+
+def get_columns(header):
+    """
+    :param list header: First row of the file
+    :return: List with the normalized column names
+    :raise ValueError: If any required column is missing
+    """
+    columns = [str(x).strip().lower() if x is not None else "" for x in header]
+    missing_columns = [x for x in REQUIRED_COLUMNS if x not in columns]
+    if missing_columns:
+        raise ValueError(f"Missing columns: {', '.join(missing_columns)}")
+    return columns
+
+
+def parse_row(row, columns, default_user=None):
+    """
+    Validate a row and build its expense, normalized like the ones added through the bot
+
+    :param list row: Values of the row
+    :param list columns: Column names (see get_columns)
+    :param str default_user: User of the rows without user
+    :return dict: Expense dict (see utils.household_expenses_db.insert_in_db)
+    :raise ValueError: If the row is not valid
+    """
+    values = dict(zip(columns, row))
+    expense = {
+        "date": parse_date(values.get("date")),
+        "user": str(values.get("user") or default_user or "").strip(),
+        "expense_type": str(values.get("expense_type") or "").strip().upper(),
+        "expense_description": str(values.get("expense_description") or "").strip().upper(),
+        "expense_amount": parse_amount(values.get("expense_amount"))
+    }
+    if not expense["user"]:
+        raise ValueError("Missing user")
+    if not expense["expense_type"]:
+        raise ValueError("Missing expense type")
+    return expense
+
+
+def parse_date(value):
+    """
+    :param value: Date as datetime/date (XLSX), yyyymmdd, yyyy-mm-dd or dd/mm/yyyy
+    :return int: yyyymmdd
+    :raise ValueError: If it is not a valid date
+    """
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return value.year * 10000 + value.month * 100 + value.day
+    # Numeric cells of the XLSX files
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    for date_pattern in DATE_PATTERNS:
+        match = date_pattern.match(text)
+        if match:
+            year, month, day = int(match.group("year")), int(match.group("month")), int(match.group("day"))
+            try:
+                # Validate the date
+                date(year, month, day)
+            except ValueError:
+                break
+            return year * 10000 + month * 100 + day
+    raise ValueError(f"Wrong date: {value}")
+
+
+def parse_amount(value):
+    """
+    :param value: Amount as number, or text with decimal point or comma (e.g.: "12,5")
+    :return float: Amount
+    :raise ValueError: If it is not a valid amount
+    """
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            amount = float(value)
+        else:
+            amount = float(str(value).strip().replace("€", "").replace(",", "."))
+    except ValueError:
+        raise ValueError(f"Wrong amount: {value}")
+    if not math.isfinite(amount):
+        raise ValueError(f"Wrong amount: {value}")
+    return amount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import of expenses from CSV or XLSX files")
+    parser.add_argument("filename", help="CSV or XLSX file")
+    parser.add_argument("--config", default="conf/config.json", help="Bot config file")
+    parser.add_argument("--user", help="User of the rows without user")
+    parser.add_argument("--skip-invalid", action="store_true", help="Import the valid rows even if there are wrong rows")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Expenses inserted per transaction")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    db_name = config.db_path
+    os.makedirs(config.output_folder, exist_ok=True)
+    create_db_if_not_exist(db_name)
+    create_table_if_not_exists(db_name)
+    create_sheets_queue_table_if_not_exists(db_name)
+
+    # The bot syncs the queued expenses with Google Sheets
+    try:
+        result = import_expenses(args.filename, db_name, default_user=args.user,
+                                 sync_sheets=config.gdrive.active,
+                                 skip_invalid=args.skip_invalid, batch_size=args.batch_size)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    finally:
+        close_connections()
+
+    for line, error in result['errors']:
+        print(f"Line {line}: {error}", file=sys.stderr)
+    print(f"{result['imported']} expenses imported. {result['errors_count']} wrong rows")
+    return 1 if result['errors_count'] and not result['imported'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import copy
+import dataclasses
+import itertools
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from utils.executor import get_mp_context
+
+
+"""
+Logging pipeline of the bot: the threads that log (the event loop, the I/O pool, the sheets worker) only put
+the records in a queue, and a background thread formats and writes them to the rotating log file.
+The worker processes (report rendering) put their records in a multiprocessing queue, written by another thread
+of the bot to the same file (see setup_worker_logging).
+Format, levels and sampling are set in the "logging" section of the config (see utils.config.LoggingConfig)
+"""
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+JSON_FORMAT = "json"
+
+# Loggers with a level set by set_log_levels, so the ones removed from the config can be reset
+_configured_loggers = set()
+# Arguments of setup_worker_logging for the worker processes started by this process. None: logging not set up
+_worker_logging_args = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, thread, message and exception (if any)
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread: the caller only builds the message
+    (its arguments may change later) and the traceback (it is lost once the except block ends)
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only 1 of every <rate> DEBUG records of some loggers (e.g.: one line per query).
+    The other levels always pass
+    """
+
+    def __init__(self, logger_names, rate):
+        """
+        :param logger_names: Names of the sampled loggers (their children are sampled too)
+        :param int rate: 1 of every <rate> records is kept. 1: no sampling
+        """
+        super().__init__()
+        self.logger_names = tuple(logger_names)
+        self.rate = rate
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if self.rate <= 1 or record.levelno > logging.DEBUG or not record.name.startswith(self.logger_names):
+            return True
+        return next(self._counter) % self.rate == 0
+
+
+def setup_logging(filename, logging_config):
+    """
+    Route the records of all the loggers to the log file, through a queue and a background thread.
+    The worker processes started afterwards log to the same file (see get_worker_logging_args)
+
+    :param str filename: Log file path
+    :param utils.config.LoggingConfig logging_config: Format, levels and sampling
+    :return LogListener: Threads writing the records. Stop it on exit to flush the queues
+    """
+    global _worker_logging_args
+    file_handler = RotatingFileHandler(filename, maxBytes=logging_config.max_bytes,
+                                       backupCount=logging_config.backup_count, encoding="utf-8")
+    if logging_config.format == JSON_FORMAT:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    add_queue_handler(log_queue, logging_config)
+
+    # The records of the worker processes: a queue that can be passed to them when they start
+    worker_queue = get_mp_context().Queue()
+    # Picklable config: the levels are a MappingProxyType
+    _worker_logging_args = (worker_queue, dataclasses.replace(logging_config, levels=dict(logging_config.levels)))
+
+    listener = LogListener(QueueListener(log_queue, file_handler), QueueListener(worker_queue, file_handler))
+    listener.start()
+    return listener
+
+
+def setup_worker_logging(log_queue, logging_config):
+    """
+    Send the records of a worker process to the log file of the bot.
+    Meant to be the initializer (or part of it) of the process pools (see get_worker_logging_args)
+
+    :param log_queue: multiprocessing queue read by the bot (see setup_logging)
+    :param utils.config.LoggingConfig logging_config: Levels and sampling
+    """
+    global _worker_logging_args
+    add_queue_handler(log_queue, logging_config)
+    # The pools started by the worker (e.g.: the render workers of a report) log to the same queue
+    _worker_logging_args = (log_queue, logging_config)
+
+
+def get_worker_logging_args():
+    """
+    :return: Arguments of setup_worker_logging for a new worker process. None if logging is not set up
+    """
+    return _worker_logging_args
+
+
+def add_queue_handler(log_queue, logging_config):
+    """
+    Replace the handlers of the root logger with one that puts the records in the queue, and set the levels
+    """
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(logging_config.sampled_loggers, logging_config.debug_sample_rate))
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    set_log_levels(logging_config)
+
+
+class LogListener:
+    """
+    Threads writing the records of the bot and of its worker processes
+    """
+
+    def __init__(self, *listeners):
+        self.listeners = listeners
+
+    def start(self):
+        for listener in self.listeners:
+            listener.start()
+
+    def stop(self):
+        """
+        Write the queued records and stop the threads
+        """
+        global _worker_logging_args
+        # Nobody would read the records of the workers started afterwards
+        _worker_logging_args = None
+        for listener in self.listeners:
+            listener.stop()
+
+
+def set_log_levels(logging_config):
+    """
+    Set the level of the root logger and the per module levels. The loggers no longer listed
+    go back to the level of the root logger
+
+    :param utils.config.LoggingConfig logging_config: Config with level and levels
+    """
+    logging.getLogger().setLevel(logging_config.level)
+    for logger_name in _configured_loggers - set(logging_config.levels):
+        logging.getLogger(logger_name).setLevel(logging.NOTSET)
+    for logger_name, level in logging_config.levels.items():
+        logging.getLogger(logger_name).setLevel(level)
+    _configured_loggers.clear()
+    _configured_loggers.update(logging_config.levels)
@@ -0,0 +1,301 @@
+import bisect
+import contextlib
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+"""
+Lightweight in-process metrics: latency histograms, counters and gauges, exposed in the Prometheus text format
+(see start_metrics_server) and summarized for the /stats command of the bot.
+Only the bot process is measured: the work sent to the process pool (utils.executor.run_cpu) is timed by the caller
+"""
+logger = logging.getLogger(__name__)
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Metric name -> metric
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    """
+    Base of the metrics: a value per combination of label values
+    """
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param str name: Metric name (e.g.: household_expenses_db_seconds)
+        :param str documentation: Help text
+        :param labels: Label names. Every observation gives a value for each of them
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name}: Labels {sorted(labels)} instead of {list(self.labels)}")
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def samples(self):
+        """
+        :return: List of (name, labels dict, value)
+        """
+        with self._lock:
+            return [(self.name, dict(zip(self.labels, k)), v) for k, v in self._values.items()]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackMetric(Metric):
+    """
+    Metric read when the metrics are collected (e.g.: the depth of a queue, counters kept by other objects)
+    """
+
+    def __init__(self, name, documentation, type_name, func):
+        """
+        :param str type_name: "counter" or "gauge"
+        :param func: func() -> number
+        """
+        super().__init__(name, documentation)
+        self.type_name = type_name
+        self.func = func
+
+    def samples(self):
+        return [(self.name, {}, self.func())]
+
+
+class Histogram(Metric):
+    """
+    Distribution of the observed values (e.g.: latencies) in cumulative buckets, with their count and sum
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # Counts per bucket (the last one is +Inf) and sum
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _get_states(self):
+        """
+        :return: Copy of the state of every label values: list of (key, counts per bucket, sum)
+        """
+        with self._lock:
+            return [(k, list(v[0]), v[1]) for k, v in self._values.items()]
+
+    def get_summary(self):
+        """
+        :return: List of (labels dict, count, average, 95th percentile). The percentile is the upper bound
+                 of its bucket (inf if it is over the last bucket)
+        """
+        states = self._get_states()
+        summary = []
+        for key, counts, total in states:
+            count = sum(counts)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                if cumulative >= 0.95 * count:
+                    break
+            summary.append((dict(zip(self.labels, key)), count, total / count if count else 0.0, bound))
+        return summary
+
+    def samples(self):
+        states = self._get_states()
+        samples = []
+        for key, counts, total in states:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", dict(labels, le=format_value(float(bound))), cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+def register(metric):
+    """
+    :raise ValueError: If there is already a metric with the same name
+    """
+    with _registry_lock:
+        if metric.name in _registry:
+            raise ValueError(f"Duplicated metric: {metric.name}")
+        _registry[metric.name] = metric
+
+
+def unregister(name):
+    with _registry_lock:
+        _registry.pop(name, None)
+
+
+def get_metrics():
+    with _registry_lock:
+        return list(_registry.values())
+
+
+def timed(histogram, **labels):
+    """
+    Decorator: observe the seconds every call of the function takes (coroutine functions included)
+
+    :param Histogram histogram: Histogram
+    :param labels: Label values of the observations
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_value(value):
+    """
+    :return str: Number in the Prometheus text format
+    """
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    """
+    :return str: e.g.: {operation="insert"}. Empty without labels
+    """
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def render_metrics():
+    """
+    :return str: All the metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in get_metrics():
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            logger.warning(f"METRICS: Error collecting {metric.name}: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+def format_stats():
+    """
+    :return str: Summary of the metrics to be read by a person: count, average and 95th percentile
+                 of the histograms (in ms when they are latencies), and the values of the rest
+    """
+    lines = []
+    for metric in get_metrics():
+        try:
+            if isinstance(metric, Histogram):
+                is_latency = metric.name.endswith("_seconds")
+                unit, factor = ("ms", 1000) if is_latency else ("", 1)
+                for labels, count, average, p95 in metric.get_summary():
+                    lines.append(f"{metric.name}{format_labels(labels)}: n={count} "
+                                 f"avg={average * factor:.1f}{unit} p95<={p95 * factor:g}{unit}")
+            else:
+                lines.extend(f"{name}{format_labels(labels)}: {format_value(value)}"
+                             for name, labels, value in metric.samples())
+        except Exception as e:
+            logger.warning(f"METRICS: Error collecting {metric.name}: {e}")
+    return "\n".join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("METRICS: " + format, *args)
+
+
+def start_metrics_server(listen="127.0.0.1", port=9464):
+    """
+    Serve the metrics on http://<listen>:<port>/metrics from a background thread.
+    One request at a time: the callbacks (e.g.: queue depths read from the DB) always run in the same thread
+
+    :return HTTPServer: Server. Stop it with shutdown()
+    """
+    server = HTTPServer((listen, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"METRICS: Serving on http://{listen}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,178 @@
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+
+"""
+Opt-in profiling of the report generation and of the handlers (see "profiling" in conf/README.md).
+A sample of the calls of the configured targets runs under cProfile (and optionally tracemalloc), and every
+profile is written to the profiles folder: <name>.prof (pstats, e.g.: $ python -m pstats <file> or snakeviz)
+and <name>.txt (summary of the CPU and allocation hotspots)
+"""
+logger = logging.getLogger(__name__)
+
+# Set by configure_profiling, in the bot and in every worker process of the pool
+_folder = None
+_sample_rate = 0.0
+_targets = frozenset()
+_memory = False
+_top = 30
+_max_profiles = 100
+# Only one profile at a time per process: cProfile can not be nested, and the handlers share the event loop thread
+_profile_lock = threading.Lock()
+
+
+def configure_profiling(folder, sample_rate=0.0, targets=(), memory=False, top=30, max_profiles=100):
+    """
+    :param str folder: Folder of the profiles
+    :param float sample_rate: Fraction of the calls of the targets that are profiled. 0: none
+    :param targets: Names of the profiled functions (see profiled)
+    :param bool memory: Trace the memory allocations too
+    :param int top: Lines of every section of the summaries
+    :param int max_profiles: Profiles kept in the folder. The oldest ones are removed
+    """
+    global _folder, _sample_rate, _targets, _memory, _top, _max_profiles
+    _folder, _sample_rate, _targets, _memory, _top, _max_profiles = (folder, sample_rate, frozenset(targets), memory,
+                                                                     top, max_profiles)
+
+
+def get_profiling_settings():
+    """
+    :return tuple: Arguments of configure_profiling with the current settings (e.g.: for a worker process)
+    """
+    return _folder, _sample_rate, tuple(_targets), _memory, _top, _max_profiles
+
+
+def should_profile(name):
+    return _sample_rate > 0 and name in _targets and random.random() < _sample_rate
+
+
+def profiled(name):
+    """
+    Decorator: profile a sample of the calls of the function (coroutine functions included), if name is a target.
+    The profiles of the coroutines include the rest of the work the event loop does while they wait
+
+    :param str name: Target name of the function
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not should_profile(name):
+                    return await func(*args, **kwargs)
+                with Profile(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not should_profile(name):
+                return func(*args, **kwargs)
+            with Profile(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_profiled(folder, name, func, *args, **kwargs):
+    """
+    Profile one call, CPU and memory, whatever the sample rate (e.g.: a report requested by an admin).
+    Module level, so it can be run in the process pool
+
+    :param str folder: Folder of the profile
+    :param str name: Profile name
+    :return: Tuple (value returned by func, path of the summary or None if another profile was running)
+    """
+    with Profile(name, folder=folder, memory=True) as profile:
+        result = func(*args, **kwargs)
+    return result, profile.summary_path
+
+
+class Profile:
+    """
+    Context manager: run the block under cProfile (and tracemalloc) and write the profile.
+    If another profile is running in the process, the block runs without profiling
+    """
+
+    def __init__(self, name, folder=None, memory=None):
+        self.name = name
+        self.folder = folder or _folder
+        self.memory = _memory if memory is None else memory
+        self.summary_path = None
+        self._profiler = None
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        if self.folder is None or not _profile_lock.acquire(blocking=False):
+            return self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._start = time.perf_counter()
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._profiler is None:
+            return False
+        try:
+            self._profiler.disable()
+            elapsed = time.perf_counter() - self._start
+            snapshot = tracemalloc.take_snapshot() if self.memory and tracemalloc.is_tracing() else None
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            self.summary_path = self.write(elapsed, snapshot)
+        except Exception as e:
+            logger.warning(f"PROFILING: Error writing the profile of {self.name}: {e}")
+        finally:
+            _profile_lock.release()
+        return False
+
+    def write(self, elapsed, snapshot=None):
+        """
+        Write the .prof and .txt files of the profile
+
+        :return str: Path of the summary
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        base_path = os.path.join(self.folder, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{self.name}-{os.getpid()}")
+        self._profiler.dump_stats(f"{base_path}.prof")
+
+        summary = io.StringIO()
+        summary.write(f"{self.name}: {elapsed:.3f} seconds (pid {os.getpid()})\n\n")
+        stats = pstats.Stats(self._profiler, stream=summary)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(_top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(_top)
+        if snapshot is not None:
+            summary.write(f"Top {_top} allocations (still allocated at the end):\n")
+            for statistic in snapshot.statistics("lineno")[:_top]:
+                summary.write(f"{statistic}\n")
+        with open(f"{base_path}.txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+
+        logger.info(f"PROFILING: {self.name} profiled ({elapsed:.3f} seconds): {base_path}.prof")
+        remove_old_profiles(self.folder, _max_profiles)
+        return f"{base_path}.txt"
+
+
+def remove_old_profiles(folder, max_profiles):
+    """
+    Keep only the last <max_profiles> profiles of the folder (their .prof and .txt files)
+    """
+    profiles = sorted(x[:-len(".prof")] for x in os.listdir(folder) if x.endswith(".prof"))
+    for base_name in profiles[:max(0, len(profiles) - max_profiles)]:
+        for extension in (".prof", ".txt"):
+            try:
+                os.remove(os.path.join(folder, base_name + extension))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,157 @@
+import collections
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Status codes worth retrying: quota exceeded and transient server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_status_code(exception):
+    """
+    Get the HTTP status code of an API exception (gspread.exceptions.APIError or similar)
+
+    :return: int status code, or None if the exception has no HTTP response
+    """
+    code = getattr(exception, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(exception, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def get_retry_after(exception):
+    """
+    Get the seconds to wait requested by the server (Retry-After header), if any
+
+    :return: float seconds, or None
+    """
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the calls to an API with a requests/period quota.
+    Instead of sleeping a fixed time after every call, a call only waits when the
+    bucket is empty, so the throughput reaches the real quota ceiling.
+    Quota errors (429) are retried honouring Retry-After, or with exponential backoff and jitter.
+    """
+
+    def __init__(self, rate=60, period=60.0, capacity=None, max_retries=5, base_backoff=1.0,
+                 max_backoff=64.0, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param int rate: Requests allowed per period
+        :param float period: Seconds of the quota period
+        :param int capacity: Max burst of requests (default: rate)
+        :param int max_retries: Max retries of a call that failed with a retryable status code
+        :param float base_backoff: Seconds to wait before the first retry
+        :param float max_backoff: Max seconds to wait between retries
+        :param clock: Monotonic clock function (tests)
+        :param sleep: Sleep function (tests)
+        """
+        self.rate = rate
+        self.period = period
+        self.capacity = capacity or rate
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._last_refill = clock()
+        self._calls = collections.deque()
+        self._stats = {"requests": 0, "throttled": 0, "quota_errors": 0, "retries": 0}
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate / self.period)
+        self._last_refill = now
+        # Forget the calls out of the current period
+        while self._calls and self._calls[0] <= now - self.period:
+            self._calls.popleft()
+
+    def acquire(self):
+        """
+        Take one token from the bucket, waiting until there is one available
+        """
+        throttled = False
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._calls.append(now)
+                    self._stats["requests"] += 1
+                    if throttled:
+                        self._stats["throttled"] += 1
+                    return
+                wait = (1 - self._tokens) * self.period / self.rate
+            throttled = True
+            self._sleep(wait)
+
+    def penalize(self, wait):
+        """
+        Empty the bucket after a quota error, so every caller slows down and not only the one that failed
+
+        :param float wait: Seconds until the quota is expected to be available again
+        """
+        with self._lock:
+            self._refill(self._clock())
+            self._tokens = min(self._tokens, -wait * self.rate / self.period + 1)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func through the rate limiter, retrying the quota and transient errors
+
+        :return: The value returned by func
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status_code = get_status_code(e)
+                if status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise
+                wait = get_retry_after(e)
+                if wait is None:
+                    wait = min(self.max_backoff, self.base_backoff * (2 ** attempt)) * random.uniform(1.0, 1.5)
+                with self._lock:
+                    self._stats["retries"] += 1
+                    if status_code == 429:
+                        self._stats["quota_errors"] += 1
+                logger.warning(f"RATE LIMITER: Error {status_code}. Retry {attempt + 1} in {wait:.1f} seconds")
+                if status_code == 429:
+                    # The wait happens in acquire(), shared with the rest of the callers
+                    self.penalize(wait)
+                else:
+                    self._sleep(wait)
+                attempt += 1
+
+    def usage(self):
+        """
+        Current quota usage
+
+        :return: dict with the requests done in the last period, the available tokens and the counters
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            return {"requests_last_period": len(self._calls),
+                    "quota": self.rate,
+                    "period": self.period,
+                    "available_tokens": max(0, int(self._tokens)),
+                    **self._stats}
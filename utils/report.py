@@ -1,12 +1,26 @@
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, PageBreak, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.graphics.shapes import Drawing
 from reportlab.graphics.charts.piecharts import Pie
 from reportlab.graphics.charts.barcharts import HorizontalBarChart
+from pypdf import PdfReader, PdfWriter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
 from datetime import date
 from math import ceil
+import glob
+import hashlib
+import io
+import json
+import os
+import threading
+from utils.aggregation import aggregate_expenses, iter_expense_rows
+from utils.expenses_frame import get_expenses_frame
+from utils.profiling import profiled
+from utils.executor import get_mp_context, init_worker, get_worker_initargs
 
 
 EXPENSES_TABLE_HEADERS = ['ID', 'Date', 'Type', 'Description', 'Amount']
@@ -18,10 +32,23 @@ TABLE_STYLE = [('BACKGROUND', (0, 0), (-1, 0), colors.grey),
                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
                ('GRID', (0, 0), (-1, -1), 1, colors.black)]
 
+# Change it when the layout of the month pages changes, so the cached fragments are rendered again
+REPORT_VERSION = 1
+# Cached fragments kept per month: one per filter (all, mine, one type...) and version of the month expenses
+MONTH_CACHE_VERSIONS = 8
 
-def create_report(filename, expenses):
+# Render workers of the current process (see get_render_executor): (pid, number of workers, ProcessPoolExecutor)
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+@profiled("create_report")
+def create_report(filename, expenses, cache_folder=None, workers=1):
     """
-    Create a PDF expenses Report
+    Create a PDF expenses Report.
+    Every month is rendered as an independent PDF fragment. If cache_folder is set, the fragments
+    are cached there, keyed by a hash of the month expenses, so only the months that changed
+    since the last report are rendered again. With several workers, the months are rendered in parallel
     
     :param str filename: Report file path
     :param dict expenses: Dict of expenses dicts. e.g.:
@@ -41,92 +68,138 @@ def create_report(filename, expenses):
             'expense_amount': 12.0
         }
     }
+    The expenses can also be a DataFrame (see utils.expenses_frame) or an iterable of ExpenseRow
+    :param str cache_folder: Folder of the cached month fragments (None: no cache)
+    :param int workers: Processes rendering the months (see render_month_fragments)
+    """
+    # Group the expenses by month (and type) and compute the totals in one pass
+    render_report(filename, aggregate_expenses(expenses), cache_folder, workers)
+
+
+@profiled("create_report")
+def create_report_from_db(filename, db_name, cache_folder=None, workers=1, **filters):
+    """
+    Create a PDF expenses Report straight from the DB.
+    The expenses are loaded in one bulk read into a columnar DataFrame and aggregated with groupby
+
+    :param str filename: Report file path
+    :param str db_name: DB file path
+    :param str cache_folder: Folder of the cached month fragments (None: no cache)
+    :param int workers: Processes rendering the months (see render_month_fragments)
+    :param filters: date_from, date_to, expense_types and user (see utils.household_expenses_db.get_table_content)
+    :return int: Number of expenses of the report. 0: there are no expenses and the report is not created
+    """
+    expenses = get_expenses_frame(db_name, limit=0, **filters)
+    if len(expenses):
+        render_report(filename, aggregate_expenses(expenses), cache_folder, workers)
+    return len(expenses)
+
+
+def render_report(filename, months, cache_folder=None, workers=1):
+    """
+    Render the report of the aggregated expenses
+
+    :param str filename: Report file path
+    :param dict months: Expenses and totals by month (see utils.aggregation.aggregate_expenses)
+    :param str cache_folder: Folder of the cached month fragments (None: no cache)
+    :param int workers: Processes rendering the months (see render_month_fragments)
     """
     bar_chart_expense = []
     bar_chart_date = []
-    # Get different expense_types
-    expense_types = set()
+
+    # The report is the concatenation of the title, one fragment per month and the history
+    fragments = [render_title()]
+    fragments.extend(get_month_fragments(months, cache_folder, workers))
+    for k, v in months.items():
+        # Save the total and the month in order to use it in the bar chart
+        # Saving it in inverted order to represent a historical evolution towards today
+        # The date will have the format yyyy-mm
+        total_amount = ceil(v.get('total_amount'))
+        bar_chart_date.insert(0, f"{k[:4]}-{k[-2:]} - {total_amount}€")
+        bar_chart_expense.insert(0, total_amount)
+    fragments.append(render_history(bar_chart_date, bar_chart_expense))
+
+    merge_fragments(filename, fragments)
+
+
+def render_title():
+    """
+    Render the title page of the report
+
+    :return: bytes of the PDF fragment
+    """
+    title_style = getSampleStyleSheet()['Title']
+    story = [Paragraph(f"{date.today().strftime('%Y %m %d')}", title_style),
+             Paragraph("Expenses Report", title_style)]
+    return build_fragment(story)
+
+
+@profiled("render_month_section")
+def render_month_section(month, month_summary):
+    """
+    Render the pages of one month: all the expenses, the expenses by type and the pie chart
     
-    # Create a new dict sorting the expenses by month
-    month_dict = {}
-    for k, v in expenses.items():
-        month = str(v.get('date'))[:6]
-        # Initialize an empty dict if there is no entry in the output_dict
-        if month not in month_dict:
-            month_dict[month] = {}
-        month_dict[month][k] = v
-        expense_types.add(v.get('expense_type'))
-
-    # Create a PDF document
-    doc = SimpleDocTemplate(filename, pagesize=letter)    
-
-    # Styles for paragraphs
+    :param str month: Month with the format yyyymm
+    :param dict month_summary: Expenses and totals of the month (see utils.aggregation.aggregate_expenses)
+    :return: bytes of the PDF fragment
+    """
     styles = getSampleStyleSheet()
     title_style = styles['Title']
-
-    # Create Story with the title of the Report
     story = []
-    story.append(
-        Paragraph(f"{date.today().strftime('%Y %m %d')}", title_style))
-    story.append(Paragraph("Expenses Report", title_style))
-    story.append(PageBreak())
-    
-    # Iterate through the elements in order to create a the differnt tables and charts
-    for k, v in month_dict.items():
-        # All expenses of the month K
-        story.append(Paragraph(f"Expenses {k[:4]}-{k[4:6]}:",
-                               styles['Heading2']))
-        table_dict = create_table(month_dict[k])
-        table = Table(table_dict.get('table'))
+
+    # All expenses of the month. The rows are reused by the tables of every type
+    story.append(Paragraph(f"Expenses {month[:4]}-{month[4:6]}:",
+                           styles['Heading2']))
+    rows = {key: create_row(value) for key, value in month_summary.get('expenses').items()}
+    table = Table([EXPENSES_TABLE_HEADERS] + list(rows.values()))
+    table.setStyle(TableStyle(TABLE_STYLE))
+    story.append(table)
+    total_amount = ceil(month_summary.get('total_amount'))
+    story.append(Paragraph(f"Total: {total_amount} €",
+                           styles['Heading3']))
+    # Add blank space
+    story.append(Spacer(1, 12))
+
+    # Expenses by type
+    pie_labels = []
+    pie_data = []
+    for e_type, type_summary in sorted(month_summary.get('types').items()):
+        story.append(Paragraph(f"{e_type}:", styles['Heading2']))
+        table = Table([EXPENSES_TABLE_HEADERS] + [rows[x] for x in type_summary.get('ids')])
         table.setStyle(TableStyle(TABLE_STYLE))
         story.append(table)
-        total_amount = ceil(table_dict.get('total_amount'))
-        story.append(Paragraph(f"Total: {total_amount} €",
+        type_total_expense = ceil(type_summary.get('total_amount'))
+        story.append(Paragraph(f"Total: {type_total_expense} €", 
                                styles['Heading3']))
-        # Add blank space
         story.append(Spacer(1, 12))
         
-        # Save the total and the month in order to use it in the bar chart
-        # Saving it in inverted order to represent a historical evolution towards today
-        # The date will have the format yyyy-mm
-        bar_chart_date.insert(0, f"{k[:4]}-{k[-2:]} - {total_amount}€")
-        bar_chart_expense.insert(0, total_amount)
-
-        # Expenses by type
-        pie_labels = []
-        pie_data = []
-        for e_type in expense_types:
-            filtered_expenses = {key: value for key, value in v.items() if value.get('expense_type') == e_type}
-            type_table_dict = create_table(filtered_expenses)
-            if len(type_table_dict.get('table')) > 1:
-                story.append(Paragraph(f"{e_type}:", styles['Heading2']))
-                table = Table(type_table_dict.get('table'))
-                table.setStyle(TableStyle(TABLE_STYLE))
-                story.append(table)
-                type_total_expense = ceil(type_table_dict.get('total_amount'))
-                story.append(Paragraph(f"Total: {type_total_expense} €", 
-                                       styles['Heading3']))
-                story.append(Spacer(1, 12))
-                
-                # Save the data to use it in the pie chart
-                pie_labels.append(f"{e_type} \n{type_total_expense} €")
-                pie_data.append(type_total_expense)
-        
-        # Create a Pie chart with the month expenses by type
-        pie_chart = Pie()
-        pie_chart.data = pie_data
-        pie_chart.labels = pie_labels
-        pie_chart.width = 400
-        pie_chart.height = 200
-        pie_chart.slices.strokeWidth = 0.5
-        story.append(Paragraph("Expenses By Type:", title_style))
-        drawing = Drawing(400, 220)
-        drawing.add(pie_chart)
-        story.append(drawing)
-        
-        story.append(PageBreak())
+        # Save the data to use it in the pie chart
+        pie_labels.append(f"{e_type} \n{type_total_expense} €")
+        pie_data.append(type_total_expense)
     
-    # Create a Bar Chart to show all months expenses history
+    # Create a Pie chart with the month expenses by type
+    pie_chart = Pie()
+    pie_chart.data = pie_data
+    pie_chart.labels = pie_labels
+    pie_chart.width = 400
+    pie_chart.height = 200
+    pie_chart.slices.strokeWidth = 0.5
+    story.append(Paragraph("Expenses By Type:", title_style))
+    drawing = Drawing(400, 220)
+    drawing.add(pie_chart)
+    story.append(drawing)
+    return build_fragment(story)
+
+
+def render_history(bar_chart_date, bar_chart_expense):
+    """
+    Render the bar chart with all months expenses history
+
+    :param list bar_chart_date: Labels of the months
+    :param list bar_chart_expense: Total amount of the months
+    :return: bytes of the PDF fragment
+    """
+    title_style = getSampleStyleSheet()['Title']
     bar_chart = HorizontalBarChart()
     bar_chart.data = [bar_chart_expense]
     bar_chart.categoryAxis.categoryNames = bar_chart_date
@@ -134,21 +207,179 @@ def create_report(filename, expenses):
     bar_chart.width = 400
     bar_chart_height = 15 * len(bar_chart_expense)
     bar_chart.height = bar_chart_height
-    story.append(Paragraph("Expense History:", title_style))
     drawing = Drawing(400, bar_chart_height+20)
     drawing.add(bar_chart)
-    story.append(drawing)
+    return build_fragment([Paragraph("Expense History:", title_style), drawing])
+
+
+def get_month_fragments(months, cache_folder=None, workers=1):
+    """
+    Get the PDF fragments of the months from the cache, rendering the ones that are not there
+    
+    :param dict months: Expenses and totals by month (see utils.aggregation.aggregate_expenses)
+    :param str cache_folder: Folder of the cached month fragments (None: no cache)
+    :param int workers: Processes rendering the months (see render_month_fragments)
+    :return: List of bytes of the PDF fragments, in the order of the months
+    """
+    fragments = dict.fromkeys(months)
+    cache_files = {}
+    if cache_folder is not None:
+        for k, v in months.items():
+            cache_files[k] = os.path.join(cache_folder, f"{k}-{get_month_hash(v.get('expenses'))}.pdf")
+            try:
+                with open(cache_files[k], 'rb') as f:
+                    fragments[k] = f.read()
+                # Recently used: the oldest versions of the month are the ones removed
+                os.utime(cache_files[k])
+            except FileNotFoundError:
+                # Not cached, or removed by a concurrent report in the meantime: rendered again
+                pass
+
+    missing_months = [k for k, v in fragments.items() if v is None]
+    rendered_fragments = render_month_fragments([(k, months[k]) for k in missing_months], workers)
+    for month, fragment in zip(missing_months, rendered_fragments):
+        fragments[month] = fragment
+        if cache_folder is not None:
+            store_month_fragment(month, fragment, cache_files[month])
+    return list(fragments.values())
+
+
+def render_month_fragments(months, workers=1):
+    """
+    Render the PDF fragments of several months, in parallel if there are several workers
+    (see get_render_executor). Only the months go to the workers, and only the fragments come back
+
+    :param list months: List of (month, month summary) (see utils.aggregation.aggregate_expenses)
+    :param int workers: Max number of processes. 1: render them in the calling process
+    :return: List of bytes of the PDF fragments, in the order of the months
+    """
+    if min(workers, len(months)) <= 1:
+        return [render_month_section(k, v) for k, v in months]
+    try:
+        return list(get_render_executor(workers).map(render_month_section, *zip(*months)))
+    except BrokenProcessPool:
+        # A worker died (e.g.: killed): the next report starts new ones
+        shutdown_render_executor(wait=False)
+        raise
+
+
+def get_render_executor(workers):
+    """
+    Get the pool of render workers of the current process, which can itself be a worker of the bot CPU pool
+    (utils.executor): the pool processes are not daemonic, so they can start their own.
+    It is started with the first parallel report and kept for the next ones, so only the first one pays
+    the start of the fork server and of the workers. They log and profile like the process that started them
+
+    :param int workers: Number of processes
+    :return ProcessPoolExecutor: Pool of render workers
+    """
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is not None:
+            pid, executor_workers, executor = _render_executor
+            # Inherited by a forked child: the workers are not its own
+            if pid == os.getpid() and executor_workers == workers:
+                return executor
+            if pid == os.getpid():
+                executor.shutdown()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_mp_context(["__main__", __name__]),
+                                       initializer=init_worker, initargs=get_worker_initargs())
+        if _render_executor is None or _render_executor[0] != os.getpid():
+            # A process of a pool (e.g.: the bot CPU pool) waits for its children when it exits, before the atexit
+            # handlers that would stop them: they are stopped first, while the queues that reach them
+            # are still working (their finalizers have exitpriority 10)
+            Finalize(None, shutdown_render_executor, exitpriority=100)
+        _render_executor = (os.getpid(), workers, executor)
+        return executor
+
+
+def shutdown_render_executor(wait=True):
+    """
+    Stop the render workers of the current process, if they were started (also done when the process exits)
+
+    :param bool wait: Wait for the pending renders to finish
+    """
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is not None and _render_executor[0] == os.getpid():
+            _render_executor[2].shutdown(wait=wait)
+        _render_executor = None
+
+
+def store_month_fragment(month, fragment, cache_file):
+    """
+    Cache the PDF fragment of a month. Only the last used MONTH_CACHE_VERSIONS versions of the month are kept
+    (e.g.: the "all" and "mine" reports of the month, before and after a new expense)
+
+    :param str month: Month with the format yyyymm
+    :param bytes fragment: PDF fragment
+    :param str cache_file: Path of the cached fragment (in the cache folder, see get_month_fragments)
+    """
+    cache_folder = os.path.dirname(cache_file)
+    os.makedirs(cache_folder, exist_ok=True)
+    # Remove the least recently used versions of the month
+    old_files = []
+    for old_file in glob.glob(os.path.join(cache_folder, f"{month}-*.pdf")):
+        try:
+            old_files.append((os.path.getmtime(old_file), old_file))
+        except FileNotFoundError:
+            pass
+    for _, old_file in sorted(old_files, reverse=True)[MONTH_CACHE_VERSIONS - 1:]:
+        try:
+            os.remove(old_file)
+        except FileNotFoundError:
+            pass
+    # Write + rename, so a concurrent report never reads a half written file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(fragment)
+    os.replace(tmp_file, cache_file)
+
+
+def get_month_hash(month_expenses):
+    """
+    Hash of the content of a month. It changes if any expense of the month is added, deleted or modified
 
-    # Add story to document
+    :param dict month_expenses: Dict of the ExpenseRow of the month
+    :return: str hex digest
+    """
+    content = json.dumps([REPORT_VERSION, sorted(month_expenses.values())], default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def build_fragment(story):
+    """
+    Build a story into an in-memory PDF
+
+    :param list story: List of flowables
+    :return: bytes of the PDF
+    """
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
     doc.build(story)
+    return buffer.getvalue()
+
+
+def merge_fragments(filename, fragments):
+    """
+    Write the concatenation of several PDF fragments into a file
+
+    :param str filename: Report file path
+    :param list fragments: List of PDF bytes
+    """
+    writer = PdfWriter()
+    for fragment in fragments:
+        writer.append(PdfReader(io.BytesIO(fragment)))
+    with open(filename, 'wb') as f:
+        writer.write(f)
 
 
 def create_table(expenses_dict, table_headers=EXPENSES_TABLE_HEADERS):
     """
     Create table rows from the expenses dict
     
-    :param str filename: Report file path
-    :param dict expenses: Dict of expenses dicts
+    :param expenses_dict: Dict of expenses dicts, or DataFrame of expenses (see utils.expenses_frame)
+    :param list table_headers: Headers of the table
     :return dict return_dict: Dict with the table rows and the total amount. e.g.:
     {
         'table': [
@@ -161,13 +392,22 @@ def create_table(expenses_dict, table_headers=EXPENSES_TABLE_HEADERS):
     """    
     # Create one total expenses table per month
     return_dict = {'table': [table_headers], 'total_amount': 0.0}
-    for key, value in expenses_dict.items():
-        expense = [key,
-                   value.get('date'),
-                   value.get('expense_type'),
-                   # Limit the description to 15 chars
-                   value.get('expense_description')[:15],
-                   round(value.get('expense_amount'), 2)]
-        return_dict['table'].append(expense)
-        return_dict['total_amount'] += value.get('expense_amount')
+    for expense in iter_expense_rows(expenses_dict):
+        return_dict['table'].append(create_row(expense))
+        return_dict['total_amount'] += expense.expense_amount
     return return_dict
+
+
+def create_row(expense):
+    """
+    Create the table row of an expense
+
+    :param ExpenseRow expense: Expense (see utils.household_expenses_db.ExpenseRow)
+    :return list: e.g.: [2, 20200102, 'TYPE_2','DESCRIPTION 2', 21.0 ]
+    """
+    return [expense.id,
+            expense.date,
+            expense.expense_type,
+            # Limit the description to 15 chars
+            expense.expense_description[:15],
+            round(expense.expense_amount, 2)]
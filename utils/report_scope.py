@@ -0,0 +1,65 @@
+import calendar
+import re
+from datetime import date
+
+
+THIS_MONTH = "this_month"
+LAST_MONTH = "last_month"
+THIS_YEAR = "this_year"
+ALL = "all"
+
+PERIOD_PATTERN = re.compile(r"^\s*(\d{8})\s*-\s*(\d{8})\s*$")
+
+
+def get_period_range(period, today=None):
+    """
+    Get the dates range of a predefined period
+
+    :param str period: THIS_MONTH, LAST_MONTH, THIS_YEAR or ALL
+    :param date today: Reference date (default: today)
+    :return: Tuple (date_from, date_to) as yyyymmdd ints. (None, None) for ALL
+    """
+    today = today or date.today()
+    if period == THIS_MONTH:
+        return month_range(today.year, today.month)
+    if period == LAST_MONTH:
+        if today.month == 1:
+            return month_range(today.year - 1, 12)
+        return month_range(today.year, today.month - 1)
+    if period == THIS_YEAR:
+        return today.year * 10000 + 101, today.year * 10000 + 1231
+    return None, None
+
+
+def month_range(year, month):
+    """
+    :return: Tuple (first day, last day) of the month as yyyymmdd ints
+    """
+    last_day = calendar.monthrange(year, month)[1]
+    return year * 10000 + month * 100 + 1, year * 10000 + month * 100 + last_day
+
+
+def parse_period(text):
+    """
+    Parse a period written by the user: yyyy, yyyymm or yyyymmdd-yyyymmdd
+
+    :param str text: Period
+    :return: Tuple (date_from, date_to) as yyyymmdd ints, or None if the text is not a valid period
+    """
+    text = text.strip()
+    try:
+        if len(text) == 4 and text.isdigit():
+            return int(text) * 10000 + 101, int(text) * 10000 + 1231
+        if len(text) == 6 and text.isdigit() and 1 <= int(text[4:]) <= 12:
+            return month_range(int(text[:4]), int(text[4:]))
+        match = PERIOD_PATTERN.match(text)
+        if match:
+            date_from, date_to = (int(x) for x in match.groups())
+            # Validate both dates
+            for x in (date_from, date_to):
+                date(x // 10000, x // 100 % 100, x % 100)
+            if date_from <= date_to:
+                return date_from, date_to
+    except ValueError:
+        pass
+    return None
@@ -0,0 +1,121 @@
+import asyncio
+import collections
+import dataclasses
+import hashlib
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+from utils.metrics import Counter
+
+
+"""
+Reuse of the generated reports: the requests of the same report (same filters and same version of the expenses)
+share one render while it is running, and its PDF afterwards. The reports folder keeps only the last used reports
+"""
+logger = logging.getLogger(__name__)
+REPORTS_TOTAL = Counter("household_expenses_reports_total", "Report requests by result", ["result"])
+
+
+@dataclasses.dataclass
+class StoredReport:
+    path: str
+    expenses_count: int
+    # Telegram file_id of the uploaded PDF: it is sent again without uploading it
+    file_id: Optional[str] = None
+
+
+class ReportStore:
+    """
+    Index of the reports of a folder, by key (e.g.: version of the expenses and filters).
+    Only used from the event loop thread
+    """
+
+    def __init__(self, folder, max_files=50, max_bytes=100000000):
+        """
+        :param str folder: Reports folder
+        :param int max_files: Reports kept in the folder (the least recently used ones are removed)
+        :param int max_bytes: Total size of the reports kept in the folder
+        """
+        self.folder = folder
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._reports = collections.OrderedDict()
+        self._renders = {}
+
+    async def get_report(self, key, render):
+        """
+        Get the report of a key: the stored one, the one being rendered, or a new one
+
+        :param key: Hashable key of the report. It must change when the content of the report would change
+        :param render: async func(path) -> number of expenses. Renders the report to path (nothing if 0)
+        :return StoredReport: Report. No file if expenses_count is 0
+        """
+        report = self._reports.get(key)
+        if report is not None and os.path.exists(report.path):
+            self._reports.move_to_end(key)
+            # Recently used: the retention goes by modification time
+            os.utime(report.path)
+            REPORTS_TOTAL.inc(result="reused")
+            return report
+
+        render_future = self._renders.get(key)
+        if render_future is not None:
+            REPORTS_TOTAL.inc(result="coalesced")
+            return await asyncio.shield(render_future)
+
+        render_future = asyncio.get_running_loop().create_future()
+        self._renders[key] = render_future
+        try:
+            path = self.get_report_path(key)
+            report = StoredReport(path, await render(path))
+            if report.expenses_count:
+                self._reports[key] = report
+                self.remove_old_reports()
+            REPORTS_TOTAL.inc(result="rendered")
+            render_future.set_result(report)
+            return report
+        except asyncio.CancelledError:
+            render_future.cancel()
+            raise
+        except Exception as e:
+            render_future.set_exception(e)
+            # Retrieved here, so there is no warning if nobody else was waiting
+            render_future.exception()
+            raise
+        finally:
+            del self._renders[key]
+
+    def get_report_path(self, key):
+        """
+        :return str: New path for the report of the key
+        """
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.folder, datetime.now().strftime(f"%Y%m%d-EXPENSES REPORT-%H%M%S-{digest}.pdf"))
+
+    def remove_old_reports(self):
+        """
+        Keep only the last used <max_files> reports of the folder, up to <max_bytes> (the last one is always kept).
+        The PDFs of the folder that are not in the index (e.g.: from before a restart) are removed the same way
+        """
+        reports = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                reports.append((stat.st_mtime, stat.st_size, entry.path))
+        reports.sort(reverse=True)
+
+        total_bytes = 0
+        removed_paths = set()
+        for index, (_, size, path) in enumerate(reports):
+            total_bytes += size
+            if index > 0 and (index >= self.max_files or total_bytes > self.max_bytes):
+                try:
+                    os.remove(path)
+                    removed_paths.add(path)
+                except OSError as e:
+                    logger.warning(f"REPORTS: Error removing {path}: {e}")
+        if removed_paths:
+            for key in [k for k, v in self._reports.items() if v.path in removed_paths]:
+                del self._reports[key]
+            logger.info(f"REPORTS: {len(removed_paths)} old reports removed")
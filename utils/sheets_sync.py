@@ -0,0 +1,276 @@
+import logging
+import random
+import threading
+import time
+from datetime import date
+from utils.household_expenses_db import (INSERT_OPERATION, DELETE_OPERATION, get_pending_sheet_operations,
+                                         remove_sheet_operations, postpone_sheet_operations, fail_sheet_operations,
+                                         save_sheet_cells, get_sheet_cells, remove_sheet_cells)
+
+
+logger = logging.getLogger(__name__)
+# HTTP status codes of the errors that may go away on their own (timeout, quota, server errors)
+RETRYABLE_STATUS_CODES = {408, 429}
+
+
+def is_retryable(error):
+    """
+    Whether an operation that failed with error can succeed later:
+    network errors, HTTP 408/429/5xx and unknown errors are retried,
+    the other HTTP errors (e.g.: 400, 403) and the errors of the payload (ValueError, KeyError...) are not
+
+    :param Exception error: Error of the Google Sheets call (gspread APIError, requests or network errors...)
+    :return bool: True if the operation should be retried
+    """
+    # gspread.exceptions.APIError and requests.HTTPError have the HTTP response
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return not isinstance(error, (ValueError, TypeError, LookupError))
+
+
+class SheetsSyncWorker:
+    """
+    Background worker that drains the Google Sheets queue (SHEETS_QUEUE table).
+    The bot only queues the operations, so the user gets the confirmation as soon as
+    the expense is in the DB. The worker:
+    - handles the operations in the order they were queued, a postponed one holding back the ones queued after it
+    - coalesces the pending inserts and deletes into one batched call of each kind
+    - keeps the index of the cells where every expense was written (SHEET_CELLS table),
+      so the deletes go straight to the right cells
+    - creates the next year worksheet in December, and refreshes the Google access token, when it is idle
+    - retries the failed operations with exponential backoff (they stay in the DB,
+      so nothing is lost on restart), up to max_attempts. The ones that can not succeed (see is_retryable)
+      or run out of attempts go to the SHEETS_FAILED table, so the rest of the queue keeps moving
+    """
+
+    def __init__(self, db_name, gdrive_info, batch_size=200, idle_interval=10,
+                 base_backoff=5, max_backoff=600, max_attempts=20, insert_func=None, delete_func=None,
+                 prepare_func=None, refresh_func=None):
+        """
+        :param str db_name: path of the database file
+        :param dict gdrive_info: gdrive section of the config
+        :param int batch_size: Max number of queued operations handled per round
+        :param float idle_interval: Seconds to wait for new operations when the queue is empty
+        :param float base_backoff: Seconds to wait after the first failure
+        :param float max_backoff: Max seconds to wait between retries
+        :param int max_attempts: Attempts of an operation before giving it up (~2 hours with the default backoff)
+        :param insert_func: func(expenses_list, gdrive_info, on_written=func(cells)) -> {expense_id: cell}.
+                            Default: utils.gdrive.insert_many_in_sheet
+        :param delete_func: func(expense_ids, gdrive_info, sheet_cells=cells, expense_dates=dates).
+                            Default: utils.gdrive.delete_from_sheet
+        :param prepare_func: func(gdrive_info, worksheet_name). Default: utils.gdrive.prepare_worksheet
+        :param refresh_func: func(gdrive_info). Default: utils.gdrive.refresh_token
+        """
+        self.db_name = db_name
+        self.gdrive_info = gdrive_info
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._insert_func = insert_func
+        self._delete_func = delete_func
+        self._prepare_func = prepare_func
+        self._refresh_func = refresh_func
+        self._prepared_worksheets = set()
+        # Failed attempts to prepare the next year worksheet, and when it can be tried again (time.monotonic)
+        self._prepare_failures = 0
+        self._prepare_retry_at = 0.0
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _get_backends(self):
+        # Imported here: gspread is only loaded when the sync is enabled
+        if self._insert_func is None or self._delete_func is None:
+            from utils.gdrive import insert_many_in_sheet, delete_from_sheet
+            self._insert_func = self._insert_func or insert_many_in_sheet
+            self._delete_func = self._delete_func or delete_from_sheet
+        return self._insert_func, self._delete_func
+
+    def run_maintenance(self, today=None):
+        """
+        Background tasks done when there is nothing in the queue:
+        refresh the access token if it is about to expire, and in December, create the worksheet of the next year
+
+        :param date today: Current date (default: today)
+        """
+        try:
+            if self._refresh_func is None:
+                from utils.gdrive import refresh_token
+                self._refresh_func = refresh_token
+            self._refresh_func(self.gdrive_info)
+        except Exception as e:
+            logger.warning(f"SHEETS SYNC: Error refreshing the access token: {e}")
+
+        today = today or date.today()
+        next_year = str(today.year + 1)
+        if today.month != 12 or next_year in self._prepared_worksheets or time.monotonic() < self._prepare_retry_at:
+            return
+        try:
+            if self._prepare_func is None:
+                from utils.gdrive import prepare_worksheet
+                self._prepare_func = prepare_worksheet
+            self._prepare_func(self.gdrive_info, next_year)
+            self._prepared_worksheets.add(next_year)
+            self._prepare_failures = 0
+            logger.info(f"SHEETS SYNC: Worksheet {next_year} ready")
+        except Exception as e:
+            # Retried with backoff, like the queued operations: every attempt spends quota
+            delay = self._backoff(self._prepare_failures)
+            self._prepare_failures += 1
+            self._prepare_retry_at = time.monotonic() + delay
+            logger.warning(f"SHEETS SYNC: Error preparing the worksheet {next_year}, retrying in {delay:.0f}s: {e}")
+
+    def start(self):
+        """
+        Start the worker thread
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sheets-sync", daemon=True)
+        self._thread.start()
+        logger.info("SHEETS SYNC: Worker started")
+
+    def notify(self):
+        """
+        Wake up the worker: there are new operations in the queue
+        """
+        self._wake_event.set()
+
+    def stop(self, timeout=30):
+        """
+        Stop the worker thread after a last round.
+        The operations that could not be synced stay in the queue
+
+        :param float timeout: Max seconds to wait for the current round to finish
+        """
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        logger.info("SHEETS SYNC: Worker stopped")
+
+    def _run(self):
+        # The last round runs after stop() is called, so the ready operations are flushed
+        while True:
+            try:
+                processed = self.run_once()
+            except Exception:
+                logger.exception("SHEETS SYNC: Unexpected error")
+                processed = 0
+            if self._stop_event.is_set():
+                break
+            if processed == 0:
+                self.run_maintenance()
+                self._wake_event.wait(self.idle_interval)
+                self._wake_event.clear()
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempts))
+        # Jitter, so the retries of different operations do not hit the quota at the same time
+        return delay * random.uniform(0.5, 1.0)
+
+    def run_once(self):
+        """
+        Handle one batch of pending operations
+
+        :return: Number of queued operations removed from the queue
+        """
+        operations = get_pending_sheet_operations(self.db_name, limit=self.batch_size)
+        if not operations:
+            return 0
+
+        # Coalesce: one list of expenses to insert and one list of IDs to delete.
+        # An expense inserted and deleted in the same batch never reaches the sheet
+        inserts = {}
+        deletes = {}
+        expense_dates = {}
+        done = []
+        for operation in operations:
+            if operation["operation"] == INSERT_OPERATION:
+                inserts[operation["payload"]["id"]] = operation
+            elif operation["operation"] == DELETE_OPERATION:
+                expense_ids = []
+                for expense in operation["payload"]:
+                    # {"id", "date"}, or only the ID (operations queued by previous versions)
+                    expense_id = expense["id"] if isinstance(expense, dict) else expense
+                    if isinstance(expense, dict) and expense.get("date"):
+                        expense_dates[expense_id] = expense["date"]
+                    if expense_id in inserts:
+                        done.append(inserts.pop(expense_id)["id"])
+                    else:
+                        expense_ids.append(expense_id)
+                if expense_ids:
+                    deletes[operation["id"]] = (operation, expense_ids)
+                else:
+                    done.append(operation["id"])
+            else:
+                logger.warning(f"SHEETS SYNC: Unknown operation {operation}. Discarded")
+                done.append(operation["id"])
+
+        insert_func, delete_func = self._get_backends()
+        failed = []
+        # Retried inserts: the expenses already in the cells index were written by a failed attempt that
+        # wrote some worksheets (years) and not others. They are not written twice
+        for expense_id in get_sheet_cells(list(inserts), self.db_name):
+            done.append(inserts.pop(expense_id)["id"])
+        if inserts:
+            def insert(operations):
+                sheet_cells = insert_func([x["payload"] for x in operations], self.gdrive_info,
+                                          on_written=lambda cells: save_sheet_cells(cells, self.db_name))
+                save_sheet_cells(sheet_cells or {}, self.db_name)
+            inserted, insert_errors = self._call(insert, list(inserts.values()), "inserting")
+            done.extend(x["id"] for x in inserted)
+            failed.extend(insert_errors)
+        if deletes:
+            def delete(operations):
+                expense_ids = [x for operation in operations for x in deletes[operation["id"]][1]]
+                delete_func(expense_ids, self.gdrive_info, sheet_cells=get_sheet_cells(expense_ids, self.db_name),
+                            expense_dates={k: v for k, v in expense_dates.items() if k in expense_ids})
+                remove_sheet_cells(expense_ids, self.db_name)
+            deleted, delete_errors = self._call(delete, [operation for operation, _ in deletes.values()], "deleting")
+            done.extend(x["id"] for x in deleted)
+            failed.extend(delete_errors)
+
+        if done:
+            remove_sheet_operations(done, self.db_name)
+        given_up = 0
+        for operation, error in failed:
+            attempts = operation["attempts"] + 1
+            if is_retryable(error) and attempts < self.max_attempts:
+                postpone_sheet_operations([operation["id"]], self._backoff(operation["attempts"]), self.db_name)
+            else:
+                fail_sheet_operations([operation["id"]], str(error), self.db_name)
+                given_up += 1
+                logger.error(f"SHEETS SYNC: Operation {operation['operation']} {operation['id']} given up after "
+                             f"{attempts} attempts: {error}. Moved to SHEETS_FAILED: {operation['payload']}")
+        logger.info(f"SHEETS SYNC: {len(done)} operations done, {len(failed) - given_up} postponed, {given_up} failed")
+        # The failed ones left the queue too: the next ones can be handled right away
+        return len(done) + given_up
+
+    def _call(self, func, operations, action):
+        """
+        Run func(operations). If it fails with an error that is not retryable, the operations are run one by one:
+        the error is usually about one of them, and the others should not fail with it
+
+        :param func: func(operations)
+        :param list operations: Queued operations
+        :param str action: Description of func, for the logs
+        :return: (operations done, list of (failed operation, error))
+        """
+        try:
+            func(operations)
+            return operations, []
+        except Exception as e:
+            logger.warning(f"SHEETS SYNC: Error {action} {len(operations)} operations: {e}")
+            if len(operations) == 1 or is_retryable(e):
+                return [], [(x, e) for x in operations]
+        done = []
+        failed = []
+        for operation in operations:
+            operation_done, operation_failed = self._call(func, [operation], action)
+            done.extend(operation_done)
+            failed.extend(operation_failed)
+        return done, failed
@@ -0,0 +1,84 @@
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+from utils.config import load_config
+
+
+"""
+Post synthetic Telegram updates to the embedded webhook server of the bot (see "webhook" in conf/README.md),
+to try the webhook mode locally without Telegram.
+The bot handles them as real updates: its answers are sent to the Telegram chat of the user id
+
+Run:
+    From the root, with the bot running: $ python -m utils.webhook "/summary" --user-id <your_user_id>
+
+"""
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def build_text_update(text, user_id, first_name="local", update_id=None):
+    """
+    Build the JSON of the update Telegram sends for a text message of a user in a private chat
+
+    :param str text: Message text. Commands (e.g.: /start) are marked as such
+    :param int user_id: Telegram user id
+    :param str first_name: User name
+    :param int update_id: Update id (default: the current timestamp)
+    :return dict: Update
+    """
+    now = int(time.time())
+    user = {"id": user_id, "is_bot": False, "first_name": first_name}
+    message = {"message_id": now, "date": now, "chat": {"id": user_id, "type": "private", "first_name": first_name},
+               "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id if update_id is not None else now, "message": message}
+
+
+def post_update(url, update, secret_token=None, timeout=10):
+    """
+    Post an update as Telegram does
+
+    :param str url: Webhook URL
+    :param dict update: Update (see build_text_update)
+    :param str secret_token: Secret token of the webhook
+    :param float timeout: Seconds
+    :return int: HTTP status
+    """
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+    request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Post a synthetic text message to the webhook of the bot")
+    parser.add_argument("text", help="Message text, e.g.: /start")
+    parser.add_argument("--user-id", type=int, required=True, help="Telegram user id")
+    parser.add_argument("--first-name", default="local", help="User name")
+    parser.add_argument("--config", default="conf/config.json", help="Bot config file")
+    parser.add_argument("--url", help="Webhook URL (default: the local server of the config)")
+    args = parser.parse_args(argv)
+
+    webhook_config = load_config(args.config).webhook
+    url = args.url or webhook_config.local_url
+    try:
+        status = post_update(url, build_text_update(args.text, args.user_id, args.first_name),
+                             webhook_config.secret_token)
+    except OSError as e:
+        print(f"ERROR: {url} not reachable: {e}", file=sys.stderr)
+        return 1
+    print(f"{url}: HTTP {status}")
+    return 0 if status == 200 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())